@@ -0,0 +1,47 @@
+import argparse
+import json
+
+def print_report(name: str, report):
+    print(name)
+    for key, value in report.items():
+        print(f"    {key:<20} {value:.3f}" if isinstance(value, float) else f"    {key:<20} {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks on a fake llama_cpp backend")
+    parser.add_argument("--json", action="store_true", help="Print results as one JSON object")
+    commands = parser.add_subparsers(dest="command", required=True)
+    scenarios = commands.add_parser("scenarios", help="Run the inference scenarios")
+    scenarios.add_argument("names", nargs="*", help="Scenarios to run (default: all)")
+    load = commands.add_parser("load", help="Stream completions from the HTTP server")
+    load.add_argument("--requests", type=int, default=64)
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--max-tokens", type=int, default=32)
+    load.add_argument("--decode-latency", type=float, default=0.0, help="Simulated seconds per llama_decode")
+    load.add_argument("--token-latency", type=float, default=0.0, help="Simulated seconds per decoded token")
+    load.add_argument("--port", type=int, default=8899)
+    args = parser.parse_args()
+
+    # Importing these installs the fake backend, so it happens after parsing
+    if args.command == "scenarios":
+        from .scenarios import SCENARIOS
+        names = args.names or list(SCENARIOS)
+        results = {name: SCENARIOS[name]() for name in names}
+    else:
+        from .load import run_load
+        results = {"load": run_load(
+            requests=args.requests,
+            concurrency=args.concurrency,
+            max_tokens=args.max_tokens,
+            decode_latency=args.decode_latency,
+            token_latency=args.token_latency,
+            port=args.port,
+        )}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, report in results.items():
+            print_report(name, report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+import ctypes
+import sys
+import time
+import zlib
+from typing import Dict, List, Set
+
+import numpy as np
+
+# Deterministic stand-in for the parts of llama_cpp that the inference
+# package calls. Text is tokenized byte by byte, the KV cache is tracked cell
+# by cell like llama.cpp does, and the logits for a token only depend on the
+# token and its position, so runs are reproducible and cost almost nothing
+# compared to the Python code being measured.
+
+llama_token = ctypes.c_int32
+llama_pos = ctypes.c_int32
+llama_seq_id = ctypes.c_int32
+llama_model_p = ctypes.c_void_p
+llama_context_p = ctypes.c_void_p
+
+N_VOCAB = 32064
+TOKEN_BOS = 1
+TOKEN_EOS = 2
+BYTE_OFFSET = 3
+SPECIAL_TOKENS = {
+    "<|end|>": 32007,
+    "<|system|>": 32006,
+    "<|user|>": 32010,
+    "<|assistant|>": 32001,
+}
+SPECIAL_BY_ID = {token_id: name for name, token_id in SPECIAL_TOKENS.items()}
+
+# Number of distinct logits rows; a token's row is picked by hashing it with
+# its position
+LOGITS_TABLE_ROWS = 256
+
+class llama_batch(ctypes.Structure):
+    _fields_ = [
+        ("n_tokens", ctypes.c_int32),
+        ("token", ctypes.POINTER(llama_token)),
+        ("embd", ctypes.POINTER(ctypes.c_float)),
+        ("pos", ctypes.POINTER(llama_pos)),
+        ("n_seq_id", ctypes.POINTER(ctypes.c_int32)),
+        ("seq_id", ctypes.POINTER(ctypes.POINTER(llama_seq_id))),
+        ("logits", ctypes.POINTER(ctypes.c_int8)),
+        ("all_pos_0", llama_pos),
+        ("all_pos_1", llama_pos),
+        ("all_seq_id", llama_seq_id),
+    ]
+
+class llama_model_params(object):
+    def __init__(self):
+        self.n_gpu_layers = 0
+        self.use_mmap = True
+        self.vocab_only = False
+
+class llama_context_params(object):
+    def __init__(self):
+        self.seed = 0
+        self.n_ctx = 512
+        self.n_batch = 2048
+        self.n_ubatch = 512
+        self.n_seq_max = 1
+        self.n_threads = 4
+        self.n_threads_batch = 4
+
+class BackendStats(object):
+    # Time spent inside the fake backend, so benchmarks can subtract it
+    def __init__(self):
+        self.decode_calls = 0
+        self.decoded_tokens = 0
+        self.output_rows = 0
+        self.seconds = 0.0
+        # Simulated model cost of each llama_decode call
+        self.decode_latency = 0.0
+        self.token_latency = 0.0
+
+    def reset(self):
+        self.decode_calls = 0
+        self.decoded_tokens = 0
+        self.output_rows = 0
+        self.seconds = 0.0
+
+stats = BackendStats()
+
+class _Model(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.n_vocab = N_VOCAB
+        rng = np.random.default_rng(zlib.crc32(path.encode("utf-8")))
+        self.table = rng.standard_normal((LOGITS_TABLE_ROWS, N_VOCAB), dtype=np.float32) * 2.0
+        # Make the letters stand out, and end of sequence rare but possible
+        self.table[:, BYTE_OFFSET + ord("a"):BYTE_OFFSET + ord("z") + 1] += 4.0
+        self.table[:, TOKEN_EOS] += 2.0
+
+class _Context(object):
+    def __init__(self, model: _Model, params: llama_context_params):
+        self.model = model
+        self.n_ctx = params.n_ctx
+        self.n_seq_max = params.n_seq_max
+        self.pos = np.full(self.n_ctx, -1, dtype=np.int32)
+        self.token = np.zeros(self.n_ctx, dtype=np.int32)
+        self.cell_seqs: List[Set[int]] = [set() for _ in range(self.n_ctx)]
+        self.free = list(range(self.n_ctx - 1, -1, -1))
+        self.seq_cells: Dict[int, Set[int]] = {}
+        self.logits = np.zeros((1, model.n_vocab), dtype=np.float32)
+        self.output_rows: Dict[int, int] = {}
+
+    def add_seq(self, cell: int, seq_id: int):
+        self.cell_seqs[cell].add(seq_id)
+        self.seq_cells.setdefault(seq_id, set()).add(cell)
+
+    def remove_seq(self, cell: int, seq_id: int):
+        seqs = self.cell_seqs[cell]
+        seqs.discard(seq_id)
+        self.seq_cells[seq_id].discard(cell)
+        if len(seqs) == 0:
+            self.pos[cell] = -1
+            self.free.append(cell)
+
+    def cells_in_range(self, seq_id: int, p0: int, p1: int) -> List[int]:
+        p0 = 0 if p0 < 0 else p0
+        p1 = 1 << 30 if p1 < 0 else p1
+        return [cell for cell in self.seq_cells.get(seq_id, ()) if p0 <= self.pos[cell] < p1]
+
+_models: Dict[int, _Model] = {}
+_contexts: Dict[int, _Context] = {}
+_batches: Dict[int, list] = {}
+
+def _model(model) -> _Model:
+    return _models[model if isinstance(model, int) else model.value]
+
+def _ctx(ctx) -> _Context:
+    return _contexts[ctx if isinstance(ctx, int) else ctx.value]
+
+def llama_backend_init(numa: bool = False):
+    pass
+
+def llama_model_default_params() -> llama_model_params:
+    return llama_model_params()
+
+def llama_context_default_params() -> llama_context_params:
+    return llama_context_params()
+
+def llama_load_model_from_file(path: bytes, params: llama_model_params):
+    model = _Model(path.decode("utf-8"))
+    _models[id(model)] = model
+    return ctypes.c_void_p(id(model))
+
+def llama_free_model(model):
+    _models.pop(model.value, None)
+
+def llama_new_context_with_model(model, params: llama_context_params):
+    ctx = _Context(_model(model), params)
+    _contexts[id(ctx)] = ctx
+    return ctypes.c_void_p(id(ctx))
+
+def llama_free(ctx):
+    _contexts.pop(ctx.value, None)
+
+def llama_n_vocab(model) -> int:
+    return _model(model).n_vocab
+
+def llama_n_ctx(ctx) -> int:
+    return _ctx(ctx).n_ctx
+
+def llama_batch_init(n_tokens: int, embd: int, n_seq_max: int) -> llama_batch:
+    token = (llama_token * n_tokens)()
+    pos = (llama_pos * n_tokens)()
+    n_seq_id = (ctypes.c_int32 * n_tokens)()
+    seq_rows = [(llama_seq_id * n_seq_max)() for _ in range(n_tokens)]
+    seq_id = (ctypes.POINTER(llama_seq_id) * n_tokens)(
+        *[ctypes.cast(row, ctypes.POINTER(llama_seq_id)) for row in seq_rows])
+    logits = (ctypes.c_int8 * n_tokens)()
+    batch = llama_batch(
+        0,
+        ctypes.cast(token, ctypes.POINTER(llama_token)),
+        None,
+        ctypes.cast(pos, ctypes.POINTER(llama_pos)),
+        ctypes.cast(n_seq_id, ctypes.POINTER(ctypes.c_int32)),
+        ctypes.cast(seq_id, ctypes.POINTER(ctypes.POINTER(llama_seq_id))),
+        ctypes.cast(logits, ctypes.POINTER(ctypes.c_int8)),
+        0, 0, 0,
+    )
+    # Keep the arrays alive for as long as the batch
+    _batches[ctypes.addressof(batch)] = [token, pos, n_seq_id, seq_rows, seq_id, logits]
+    return batch
+
+def llama_batch_free(batch: llama_batch):
+    _batches.pop(ctypes.addressof(batch), None)
+
+def llama_decode(ctx, batch: llama_batch) -> int:
+    start = time.perf_counter()
+    c = _ctx(ctx)
+    n = batch.n_tokens
+    if len(c.free) < n:
+        return 1
+    for i in range(n):
+        for j in range(batch.n_seq_id[i]):
+            if batch.seq_id[i][j] < 0 or batch.seq_id[i][j] >= c.n_seq_max:
+                return -1
+
+    rows = []
+    c.output_rows = {}
+    for i in range(n):
+        cell = c.free.pop()
+        token = batch.token[i]
+        pos = batch.pos[i]
+        c.pos[cell] = pos
+        c.token[cell] = token
+        for j in range(batch.n_seq_id[i]):
+            c.add_seq(cell, batch.seq_id[i][j])
+        if batch.logits[i]:
+            c.output_rows[i] = len(rows)
+            rows.append((token * 7919 + pos * 104729) % LOGITS_TABLE_ROWS)
+    c.logits = c.model.table[rows] if len(rows) > 0 else c.logits
+
+    stats.decode_calls += 1
+    stats.decoded_tokens += n
+    stats.output_rows += len(rows)
+    if stats.decode_latency > 0 or stats.token_latency > 0:
+        time.sleep(stats.decode_latency + stats.token_latency * n)
+    stats.seconds += time.perf_counter() - start
+    return 0
+
+def llama_get_logits(ctx):
+    return _ctx(ctx).logits.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+def llama_get_logits_ith(ctx, i: int):
+    c = _ctx(ctx)
+    row = c.output_rows[i] if i >= 0 else len(c.output_rows) + i
+    return c.logits[row].ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+def llama_kv_cache_clear(ctx):
+    c = _ctx(ctx)
+    for seq_id in list(c.seq_cells):
+        llama_kv_cache_seq_rm(ctx, seq_id, -1, -1)
+
+def llama_kv_cache_seq_rm(ctx, seq_id: int, p0: int, p1: int) -> bool:
+    c = _ctx(ctx)
+    seq_ids = list(c.seq_cells) if seq_id < 0 else [seq_id]
+    for s in seq_ids:
+        for cell in c.cells_in_range(s, p0, p1):
+            c.remove_seq(cell, s)
+    return True
+
+def llama_kv_cache_seq_cp(ctx, seq_id_src: int, seq_id_dst: int, p0: int, p1: int):
+    c = _ctx(ctx)
+    for cell in c.cells_in_range(seq_id_src, p0, p1):
+        c.add_seq(cell, seq_id_dst)
+
+def llama_get_kv_cache_used_cells(ctx) -> int:
+    c = _ctx(ctx)
+    return c.n_ctx - len(c.free)
+
+def _seq_state(c: _Context, seq_id: int) -> bytes:
+    cells = sorted(c.seq_cells.get(seq_id, ()), key=lambda cell: c.pos[cell])
+    return np.array([(c.pos[cell], c.token[cell]) for cell in cells], dtype=np.int32).reshape(-1, 2).tobytes()
+
+def llama_state_seq_get_size(ctx, seq_id: int) -> int:
+    return len(_seq_state(_ctx(ctx), seq_id))
+
+def llama_state_seq_get_data(ctx, dst, size: int, seq_id: int) -> int:
+    data = _seq_state(_ctx(ctx), seq_id)
+    if len(data) > size:
+        return 0
+    ctypes.memmove(dst, data, len(data))
+    return len(data)
+
+def llama_state_seq_set_data(ctx, src, size: int, dest_seq_id: int) -> int:
+    c = _ctx(ctx)
+    llama_kv_cache_seq_rm(ctx, dest_seq_id, -1, -1)
+    cells = np.frombuffer(ctypes.string_at(src, size), dtype=np.int32).reshape(-1, 2)
+    if len(c.free) < len(cells):
+        return 0
+    for pos, token in cells:
+        cell = c.free.pop()
+        c.pos[cell] = pos
+        c.token[cell] = token
+        c.add_seq(cell, dest_seq_id)
+    return max(size, 1)
+
+def llama_token_is_eog(model, token: int) -> bool:
+    return token == TOKEN_EOS or token == SPECIAL_TOKENS["<|end|>"]
+
+def llama_tokenize(model, text: bytes, text_len: int, tokens, n_tokens_max: int, add_special: bool, parse_special: bool) -> int:
+    result = [TOKEN_BOS] if add_special else []
+    i = 0
+    while i < text_len:
+        special = None
+        if parse_special:
+            for name, token_id in SPECIAL_TOKENS.items():
+                if text.startswith(name.encode("utf-8"), i):
+                    special = (name, token_id)
+                    break
+        if special is not None:
+            result.append(special[1])
+            i += len(special[0])
+        else:
+            result.append(BYTE_OFFSET + text[i])
+            i += 1
+    if len(result) > n_tokens_max:
+        return -len(result)
+    for i, token in enumerate(result):
+        tokens[i] = token
+    return len(result)
+
+def llama_token_to_piece(model, token: int, buf, length: int, lstrip: int, special: bool) -> int:
+    if token in SPECIAL_BY_ID:
+        piece = SPECIAL_BY_ID[token].encode("utf-8")
+    elif BYTE_OFFSET <= token < BYTE_OFFSET + 256:
+        piece = bytes([token - BYTE_OFFSET])
+    elif token < BYTE_OFFSET:
+        piece = b""
+    else:
+        piece = f"<t{token}>".encode("utf-8")
+    if len(piece) > length:
+        return -len(piece)
+    ctypes.memmove(buf, piece, len(piece))
+    return len(piece)
+
+def install():
+    # Must run before anything imports the inference package
+    existing = sys.modules.get("llama_cpp")
+    if existing is not None and existing is not sys.modules[__name__]:
+        raise RuntimeError("llama_cpp was already imported; install the fake backend first")
+    sys.modules["llama_cpp"] = sys.modules[__name__]
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import time
+from typing import Any, Dict, List
+
+from . import fake_llama_cpp
+fake_llama_cpp.install()
+
+import tornado.httpclient
+
+from inference.llama import Llama
+from inference.worker import InferenceWorker
+from server.server import make_app
+from .scenarios import StepTimer, make_config, percentile, prompt_text
+
+def request_body(llama: Llama, i: int, max_tokens: int) -> str:
+    return json.dumps({"operations": [
+        {"id": "prompt", "name": "feed_tokens", "feed_tokens": {
+            "role": "user", "tokens": llama.tokenize(prompt_text(100 + 10 * (i % 16))), "top_p": 10}},
+        {"id": "answer", "name": "completion", "completion": {
+            "role": "assistant", "max_tokens": max_tokens, "top_p": 10}},
+    ]})
+
+async def _stream(client: tornado.httpclient.AsyncHTTPClient, url: str, body: str) -> Dict[str, float]:
+    start = time.perf_counter()
+    first = []
+    lines = [0]
+    def on_chunk(chunk: bytes):
+        if len(first) == 0:
+            first.append(time.perf_counter())
+        lines[0] += chunk.count(b"\n")
+    await client.fetch(url, method="POST", body=body, streaming_callback=on_chunk, request_timeout=600)
+    end = time.perf_counter()
+    return {
+        "latency": end - start,
+        "ttft": (first[0] if len(first) > 0 else end) - start,
+        "tokens": lines[0],
+    }
+
+async def _load(port: int, bodies: List[str], concurrency: int) -> List[Dict[str, float]]:
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+    url = f"http://127.0.0.1:{port}/streaming_completion"
+    queue = list(reversed(bodies))
+    results = []
+    async def client_loop():
+        while len(queue) > 0:
+            results.append(await _stream(client, url, queue.pop()))
+    await asyncio.gather(*[client_loop() for _ in range(concurrency)])
+    return results
+
+def run_load(
+        requests: int = 64,
+        concurrency: int = 16,
+        max_tokens: int = 32,
+        decode_latency: float = 0.0,
+        token_latency: float = 0.0,
+        port: int = 8899,
+    ) -> Dict[str, Any]:
+    # Serves make_app on the fake backend in this process and streams
+    # NDJSON completions from it with a fixed number of clients
+    fake_llama_cpp.stats.decode_latency = decode_latency
+    fake_llama_cpp.stats.token_latency = token_latency
+    llama = Llama(make_config(max_sequences=max(64, concurrency * 2)))
+    timer = StepTimer()
+    step = llama.step
+    llama.step = lambda interpreters: timer.measure(step, interpreters)
+    worker = InferenceWorker(llama)
+    app = make_app(llama.tokenizer, worker)
+    bodies = [request_body(llama, i, max_tokens) for i in range(requests)]
+
+    async def main():
+        server = app.listen(port, "127.0.0.1")
+        worker.start()
+        start = time.perf_counter()
+        results = await _load(port, bodies, concurrency)
+        elapsed = time.perf_counter() - start
+        worker.stop()
+        server.stop()
+        return results, elapsed
+
+    fake_llama_cpp.stats.reset()
+    results, elapsed = asyncio.run(main())
+    llama.stop()
+
+    latencies = [result["latency"] for result in results]
+    ttfts = [result["ttft"] for result in results]
+    tokens = sum(result["tokens"] for result in results)
+    report = timer.report()
+    report.update({
+        "requests": len(results),
+        "seconds": elapsed,
+        "tokens": tokens,
+        "tokens_per_second": tokens / elapsed if elapsed > 0 else 0.0,
+        "latency_ms_p50": percentile(latencies, 50) * 1000,
+        "latency_ms_p99": percentile(latencies, 99) * 1000,
+        "ttft_ms_p50": percentile(ttfts, 50) * 1000,
+        "ttft_ms_p99": percentile(ttfts, 99) * 1000,
+    })
+    return report
@@ -0,0 +1,145 @@
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+from . import fake_llama_cpp
+fake_llama_cpp.install()
+
+from inference.interpreter import Interpreter, Operation
+from inference.llama import Llama
+from inference.model_config import ModelConfig
+
+def make_config(**kwargs) -> ModelConfig:
+    config = dict(
+        name="fake",
+        model_filename="fake.gguf",
+        context_size=16384,
+        temperature=1.0,
+        batch_size=512,
+        batch_max_tokens=2048,
+    )
+    config.update(kwargs)
+    return ModelConfig(**config)
+
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if len(values) > 0 else 0.0
+
+class StepTimer(object):
+    # Times every Llama.step, splitting it into time spent in the backend and
+    # the Python overhead around it
+    def __init__(self):
+        self.step_seconds: List[float] = []
+        self.overhead_seconds: List[float] = []
+
+    def step(self, llama: Llama, interpreters: List[Interpreter]):
+        self.measure(llama.step, interpreters)
+
+    def measure(self, step: Callable[[List[Interpreter]], None], interpreters: List[Interpreter]):
+        backend = fake_llama_cpp.stats.seconds
+        start = time.perf_counter()
+        step(interpreters)
+        elapsed = time.perf_counter() - start
+        self.step_seconds.append(elapsed)
+        self.overhead_seconds.append(elapsed - (fake_llama_cpp.stats.seconds - backend))
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "steps": len(self.step_seconds),
+            "step_ms_p50": percentile(self.step_seconds, 50) * 1000,
+            "step_ms_p99": percentile(self.step_seconds, 99) * 1000,
+            "overhead_ms_p50": percentile(self.overhead_seconds, 50) * 1000,
+            "overhead_ms_p99": percentile(self.overhead_seconds, 99) * 1000,
+            "overhead_fraction": sum(self.overhead_seconds) / sum(self.step_seconds) if len(self.step_seconds) > 0 else 0.0,
+        }
+
+def run_interpreters(llama: Llama, operations: List[List[Dict[str, Any]]], max_steps: int = 100000) -> Dict[str, Any]:
+    # Runs one interpreter per operation list, all sharing each step, and
+    # returns timing and throughput figures
+    reported = []
+    interpreters = [Interpreter([Operation(**operation) for operation in ops], reported.append) for ops in operations]
+    timer = StepTimer()
+    fake_llama_cpp.stats.reset()
+    start = time.perf_counter()
+    running = list(interpreters)
+    while len(running) > 0 and len(timer.step_seconds) < max_steps:
+        timer.step(llama, running)
+        running = [interpreter for interpreter in running if not interpreter.is_done()]
+    for interpreter in interpreters:
+        llama.release_interpreter(interpreter)
+    elapsed = time.perf_counter() - start
+
+    result = timer.report()
+    result.update({
+        "seconds": elapsed,
+        "tokens": len(reported),
+        "tokens_per_second": len(reported) / elapsed if elapsed > 0 else 0.0,
+        "decode_calls": fake_llama_cpp.stats.decode_calls,
+        "decoded_tokens": fake_llama_cpp.stats.decoded_tokens,
+        "backend_seconds": fake_llama_cpp.stats.seconds,
+    })
+    return result
+
+def feed(id: str, role: str, tokens: List[int], top_p: int = 10) -> Dict[str, Any]:
+    return {"id": id, "name": "feed_tokens", "feed_tokens": {"role": role, "tokens": tokens, "top_p": top_p}}
+
+def completion(id: str, role: str, max_tokens: int, top_p: int = 10) -> Dict[str, Any]:
+    return {"id": id, "name": "completion", "completion": {"role": role, "max_tokens": max_tokens, "top_p": top_p}}
+
+def branch(id: str, forks: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    return {"id": id, "name": "branch", "branch": {"forks": forks}}
+
+def prompt_text(n_chars: int) -> str:
+    words = "the quick brown fox jumps over the lazy dog while the cat sleeps".split()
+    text = []
+    length = 0
+    i = 0
+    while length < n_chars:
+        text.append(words[i % len(words)])
+        length += len(text[-1]) + 1
+        i += 1
+    return " ".join(text)[:n_chars]
+
+def long_prompt_scoring(prompt_chars: int = 8000, top_p: int = 10) -> Dict[str, Any]:
+    # Scores every token of one long prompt, reporting the top alternatives
+    llama = Llama(make_config())
+    tokens = llama.tokenize(prompt_text(prompt_chars))
+    result = run_interpreters(llama, [[feed("prompt", "user", tokens, top_p)]])
+    llama.stop()
+    return result
+
+def wide_branch_tree(width: int = 8, depth: int = 2, max_tokens: int = 16) -> Dict[str, Any]:
+    # A prompt followed by nested branches, width ** depth leaves in total
+    llama = Llama(make_config(max_sequences=max(64, width ** depth + 8)))
+    def subtree(level: int, prefix: str) -> List[Dict[str, Any]]:
+        if level == depth:
+            return [completion(prefix, "assistant", max_tokens)]
+        return [
+            completion(prefix, "assistant", max_tokens),
+            branch(prefix + "b", [subtree(level + 1, f"{prefix}.{i}") for i in range(width)]),
+        ]
+    operations = [feed("prompt", "user", llama.tokenize(prompt_text(400)))] + \
+        [branch("root", [subtree(1, str(i)) for i in range(width)])]
+    result = run_interpreters(llama, [operations])
+    llama.stop()
+    return result
+
+def concurrent_streams(streams: int = 32, max_tokens: int = 64) -> Dict[str, Any]:
+    # Many independent requests decoding side by side
+    llama = Llama(make_config(max_sequences=streams * 2))
+    operations = [
+        [
+            feed("prompt", "user", llama.tokenize(prompt_text(200 + 10 * i))),
+            completion("answer", "assistant", max_tokens),
+        ]
+        for i in range(streams)
+    ]
+    result = run_interpreters(llama, operations)
+    llama.stop()
+    return result
+
+SCENARIOS: Dict[str, Callable[[], Dict[str, Any]]] = {
+    "long_prompt_scoring": long_prompt_scoring,
+    "wide_branch_tree": wide_branch_tree,
+    "concurrent_streams": concurrent_streams,
+}
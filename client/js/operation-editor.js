@@ -91,14 +91,9 @@ class OperationEditorText extends OperationEditor {
         indicator.classList.add("loading");
         indicator.textContent = "...";
 
-        fetch("/tokenize", {
-            method: "POST",
-            body: JSON.stringify({ text: value }),
-        })
-            .then(response => response.json())
-            .then(data => {
-                this.updateTokenized(data);
-            });
+        tokenizer.tokenize(value).then(data => {
+            this.updateTokenized(data);
+        });
     }
 
     updateText(text) {
@@ -5,3 +5,128 @@ function debounce(fn, delay) {
         timeout = setTimeout(() => fn(...args), delay);
     };
 }
+
+// Collects the texts tokenized within the same tick into a single
+// /tokenize_batch request
+class TokenizeBatcher {
+    constructor() {
+        this.pending = [];
+    }
+
+    tokenize(text) {
+        return new Promise((resolve, reject) => {
+            this.pending.push({ text, resolve, reject });
+            if (this.pending.length === 1) {
+                setTimeout(() => this.flush(), 0);
+            }
+        });
+    }
+
+    flush() {
+        const pending = this.pending;
+        this.pending = [];
+        fetch("/tokenize_batch", {
+            method: "POST",
+            body: JSON.stringify({ texts: pending.map(request => request.text) }),
+        })
+            .then(response => response.json())
+            .then(results => {
+                pending.forEach((request, i) => request.resolve(results[i]));
+            })
+            .catch(error => {
+                pending.forEach(request => request.reject(error));
+            });
+    }
+}
+
+const tokenizer = new TokenizeBatcher();
+
+// Decodes the /token_map.bin format: "TMAP", version, token count, count + 1
+// offsets into the UTF-8 string data, then the string data itself.
+function decodeTokenMap(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== "TMAP" || view.getUint32(4, true) !== 1) {
+        throw new Error("Unsupported token map");
+    }
+    const count = view.getUint32(8, true);
+    const base = 12 + 4 * (count + 1);
+    const data = new Uint8Array(buffer, base);
+    const decoder = new TextDecoder("utf-8");
+    const tokenMap = new Array(count);
+    for (let i = 0; i < count; i++) {
+        const start = view.getUint32(12 + 4 * i, true);
+        const end = view.getUint32(16 + 4 * i, true);
+        tokenMap[i] = decoder.decode(data.subarray(start, end));
+    }
+    return tokenMap;
+}
+
+// Decodes the binary /streaming_completion format. Frames are a uint32
+// length followed by records: operation ID definitions (kind 0), tokens
+// (kind 1) and a final error (kind 2), see inference/stream.py. Chunks may
+// split frames anywhere.
+class TokenStreamDecoder {
+    constructor(onToken, onError) {
+        this.onToken = onToken;
+        this.onError = onError;
+        this.buffer = new Uint8Array(0);
+        this.operationIds = [];
+        this.textDecoder = new TextDecoder("utf-8");
+    }
+
+    push(chunk) {
+        const buffer = new Uint8Array(this.buffer.length + chunk.length);
+        buffer.set(this.buffer);
+        buffer.set(chunk, this.buffer.length);
+
+        const view = new DataView(buffer.buffer);
+        let offset = 0;
+        while (offset + 4 <= buffer.length) {
+            const length = view.getUint32(offset, true);
+            if (offset + 4 + length > buffer.length) {
+                break;
+            }
+            this.decodeFrame(view, offset + 4, offset + 4 + length);
+            offset += 4 + length;
+        }
+        this.buffer = buffer.slice(offset);
+    }
+
+    decodeFrame(view, offset, end) {
+        while (offset < end) {
+            const kind = view.getUint8(offset);
+            if (kind === 2) {
+                const length = view.getUint16(offset + 1, true);
+                const bytes = new Uint8Array(view.buffer, offset + 3, length);
+                this.onError(this.textDecoder.decode(bytes));
+                offset += 3 + length;
+                continue;
+            }
+            const ref = view.getUint32(offset + 1, true);
+            if (kind === 0) {
+                const length = view.getUint32(offset + 5, true);
+                const bytes = new Uint8Array(view.buffer, offset + 9, length);
+                this.operationIds[ref] = this.textDecoder.decode(bytes);
+                offset += 9 + length;
+                continue;
+            }
+            const index = view.getUint32(offset + 5, true);
+            const token = view.getInt32(offset + 9, true);
+            const count = view.getUint32(offset + 13, true);
+            const flags = view.getUint8(offset + 17);
+            offset += 18;
+            const logits = new Array(count);
+            for (let i = 0; i < count; i++) {
+                logits[i] = [view.getInt32(offset, true), view.getFloat32(offset + 4, true)];
+                offset += 8;
+            }
+            const data = [this.operationIds[ref], index, token, logits];
+            if (flags & 1) {
+                data.push(view.getFloat32(offset, true), view.getUint32(offset + 4, true));
+                offset += 8;
+            }
+            this.onToken(...data);
+        }
+    }
+}
@@ -43,10 +43,11 @@ class AppState {
         });
 
         this.tokenMap = null;
-        fetch("/token_map").then(response => {
-            return response.json();
-        }).then(tokenMap => {
-            this.tokenMap = tokenMap;
+        // The browser keeps the binary token map and revalidates it by ETag
+        fetch("/token_map.bin").then(response => {
+            return response.arrayBuffer();
+        }).then(buffer => {
+            this.tokenMap = decodeTokenMap(buffer);
         });
     }
 
@@ -142,21 +143,20 @@ class AppState {
 
         fetch("/streaming_completion", {
             method: "POST",
+            headers: { "Accept": "application/vnd.token-stream" },
             body: JSON.stringify({ operations }),
         }).then(response => {
             const reader = response.body.getReader();
+            const decoder = new TokenStreamDecoder(
+                (...data) => this.results.addToken(...data),
+                error => console.error("Completion failed:", error),
+            );
 
             const readChunk = async () => {
                 const {done, value} = await reader.read();
                 if (done) return;
-                
-                const lines = new TextDecoder().decode(value).split('\n');
-                for (const line of lines) {
-                    if (line) {
-                        const data = JSON.parse(line);
-                        this.results.addToken(...data);
-                    }
-                }
+
+                decoder.push(value);
                 readChunk();
             };
 
@@ -0,0 +1,93 @@
+import logging
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class AdmissionRequest(object):
+    def __init__(self, key: int, tokens: int, priority: int, client: str, order: int):
+        self.key = key
+        # Upper bound on the KV cache cells the request can occupy
+        self.tokens = tokens
+        self.priority = priority
+        self.client = client
+        self.order = order
+        self.queued_time = time.perf_counter()
+
+class AdmissionController(object):
+    # Admits requests only while the KV cache tokens reserved by everything
+    # admitted stay within kv_tokens; the rest wait in a queue. The next
+    # request admitted is the oldest of the highest priority, from the client
+    # holding the fewest reserved tokens. Requests are never skipped for
+    # being too large, so none starves: a request that does not fit holds up
+    # the queue until enough is released, and one larger than kv_tokens runs
+    # alone.
+    def __init__(self, kv_tokens: int):
+        self.kv_tokens = kv_tokens
+        self.queue: Dict[int, AdmissionRequest] = {}
+        self.admitted: Dict[int, AdmissionRequest] = {}
+        self.reserved = 0
+        self.client_reserved: Dict[str, int] = {}
+        self.order = 0
+        self.admitted_total = 0
+        self.wait_seconds = 0.0
+
+    def __contains__(self, key: int) -> bool:
+        return key in self.queue or key in self.admitted
+
+    def is_admitted(self, key: int) -> bool:
+        return key in self.admitted
+
+    def submit(self, key: int, tokens: int, priority: int = 0, client: str = ""):
+        self.order += 1
+        self.queue[key] = AdmissionRequest(key, tokens, priority, client, self.order)
+
+    def _next(self) -> Optional[AdmissionRequest]:
+        best = None
+        for request in self.queue.values():
+            if best is None or self._rank(request) < self._rank(best):
+                best = request
+        return best
+
+    def _rank(self, request: AdmissionRequest):
+        return (-request.priority, self.client_reserved.get(request.client, 0), request.order)
+
+    def admit(self) -> List[AdmissionRequest]:
+        # Admits as much of the queue as fits, returning what was admitted
+        admitted = []
+        while len(self.queue) > 0:
+            request = self._next()
+            if self.reserved + request.tokens > self.kv_tokens and len(self.admitted) > 0:
+                break
+            del self.queue[request.key]
+            self.admitted[request.key] = request
+            self.reserved += request.tokens
+            self.client_reserved[request.client] = self.client_reserved.get(request.client, 0) + request.tokens
+            self.admitted_total += 1
+            wait = time.perf_counter() - request.queued_time
+            self.wait_seconds += wait
+            logger.debug("Admitted request of %d tokens from %r after %.3fs", request.tokens, request.client, wait)
+            admitted.append(request)
+        return admitted
+
+    def release(self, key: int):
+        self.queue.pop(key, None)
+        request = self.admitted.pop(key, None)
+        if request is None:
+            return
+        self.reserved -= request.tokens
+        remaining = self.client_reserved[request.client] - request.tokens
+        if remaining > 0:
+            self.client_reserved[request.client] = remaining
+        else:
+            del self.client_reserved[request.client]
+
+    def stats(self):
+        return {
+            "queued": len(self.queue),
+            "admitted": len(self.admitted),
+            "reserved_tokens": self.reserved,
+            "kv_tokens": self.kv_tokens,
+            "admitted_total": self.admitted_total,
+            "mean_wait_seconds": self.wait_seconds / self.admitted_total if self.admitted_total > 0 else 0.0,
+        }
@@ -0,0 +1,116 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import llama_cpp
+import numpy as np
+
+from .interpreter import Operation, ScoreContext
+from .scoring import score_tokens
+from .stream import TokenRecord
+
+class CandidateScoring(object):
+    # Decoding state of a score operation. Candidate k runs on seq_nums[k].
+    # The shared tokens go into the batch once, tagged with every candidate's
+    # sequence, followed by the candidates themselves, so that scoring them
+    # all takes as few llama_decode calls as the batch allows.
+    def __init__(self, shared: List[int], candidates: List[List[int]], start: int, seq_nums: List[int]):
+        self.shared = shared
+        self.candidates = candidates
+        self.candidate_start = start + len(shared)
+        self.seq_nums = seq_nums
+        # Batch entries in decode order: token, position, candidate (None for
+        # all of them) and whether its logits are needed. The last token of a
+        # candidate predicts nothing, so it is never decoded.
+        self.entries: List[Tuple[int, int, Optional[int], bool]] = []
+        for i, token in enumerate(shared):
+            self.entries.append((token, start + i, None, i == len(shared) - 1))
+        for k, candidate in enumerate(candidates):
+            for j, token in enumerate(candidate[:-1]):
+                self.entries.append((token, self.candidate_start + j, k, True))
+        self.next = 0
+
+    def is_done(self) -> bool:
+        return self.next == len(self.entries)
+
+    def begin(self, logits: np.ndarray, context: ScoreContext, top_n: int) -> int:
+        # Without shared tokens, the logits the operation starts from predict
+        # the first token of every candidate. Returns how many were scored.
+        if len(self.shared) > 0:
+            return 0
+        n = len(self.candidates)
+        self._report(np.broadcast_to(logits, (n, len(logits))), list(range(n)), [candidate[0] for candidate in self.candidates], context, top_n)
+        return n
+
+    def fill_batch(self, batch: llama_cpp.llama_batch, max_tokens: int) -> int:
+        # Puts the next entries into batch and returns how many
+        end = min(self.next + max_tokens, len(self.entries))
+        for i, (token, pos, candidate, output) in enumerate(self.entries[self.next:end]):
+            batch.token[i] = token
+            batch.pos[i] = pos
+            seq_nums = self.seq_nums if candidate is None else [self.seq_nums[candidate]]
+            batch.n_seq_id[i] = len(seq_nums)
+            for j, seq_num in enumerate(seq_nums):
+                batch.seq_id[i][j] = seq_num
+            batch.logits[i] = output
+        batch.n_tokens = end - self.next
+        return end - self.next
+
+    def n_outputs(self, n_entries: int) -> int:
+        return sum(1 for entry in self.entries[self.next:self.next + n_entries] if entry[3])
+
+    def decoded(self, n_entries: int, logits: np.ndarray, context: ScoreContext, top_n: int) -> int:
+        # Scores the candidate tokens predicted by the rows of logits, one per
+        # entry that needed them, and returns how many were scored
+        rows = []
+        candidates = []
+        targets = []
+        row = 0
+        for token, pos, candidate, output in self.entries[self.next:self.next + n_entries]:
+            if not output:
+                continue
+            if candidate is None:
+                for k, tokens in enumerate(self.candidates):
+                    rows.append(row)
+                    candidates.append(k)
+                    targets.append(tokens[0])
+            else:
+                rows.append(row)
+                candidates.append(candidate)
+                targets.append(self.candidates[candidate][pos - self.candidate_start + 1])
+            row += 1
+        self.next += n_entries
+        if len(rows) > 0:
+            self._report(logits[rows], candidates, targets, context, top_n)
+        return len(rows)
+
+    def _report(self, logits: np.ndarray, candidates: List[int], targets: List[int], context: ScoreContext, top_n: int):
+        scores = score_tokens(logits, targets, top_n)
+        for row, candidate in enumerate(candidates):
+            context.report_candidate_token(candidate, int(scores.tokens[row]), scores.report(row), float(scores.logprobs[row]), int(scores.ranks[row]))
+
+def collect_scores(operations: List[Operation], records: List[TokenRecord]) -> Dict[str, List[Dict[str, Any]]]:
+    # Every candidate's total logprob and its tokens' logprobs and ranks, by
+    # score operation ID, from the records reported for operations
+    scores = {}
+    def add(operations: List[Operation]):
+        for operation in operations:
+            if operation.name == "score":
+                scores[operation.id] = [
+                    {"logprob": 0.0, "tokens": [], "logprobs": [], "ranks": []}
+                    for _ in operation.score.candidates
+                ]
+            elif operation.name == "branch":
+                for fork in operation.branch.forks:
+                    add(fork)
+    add(operations)
+    for record in records:
+        # Candidate tokens are always reported with their logprob and rank
+        score_id, _, candidate = record[0].rpartition("/")
+        if score_id not in scores or not candidate.isdigit():
+            continue
+        token, logprob, rank = record[2], record[4], record[5]
+        result = scores[score_id][int(candidate)]
+        result["logprob"] += logprob
+        result["tokens"].append(token)
+        result["logprobs"].append(logprob)
+        result["ranks"].append(rank)
+    return scores
@@ -0,0 +1,554 @@
+import json
+import os
+import re
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+
+from .util import LRUCache
+
+# JSON value grammars for json_schema_to_regex. Output is compact: no
+# whitespace between tokens, so that the punctuation and property names are
+# forced rather than sampled.
+JSON_STRING = r'"(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"'
+JSON_INTEGER = r"-?(?:0|[1-9][0-9]*)"
+JSON_NUMBER = JSON_INTEGER + r"(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?"
+JSON_BOOLEAN = r"(?:true|false)"
+JSON_NULL = r"null"
+
+# No DFA state, i.e. the text can no longer match
+DEAD_STATE = -1
+
+# Largest {m,n} count, since the NFA repeats its fragment that many times
+MAX_REPEAT_COUNT = 1000
+# Largest NFA a pattern may expand to, since nested repeats multiply
+MAX_AUTOMATON_STATES = 100000
+
+def _literal(value: Any) -> str:
+    return re.escape(json.dumps(value, separators=(",", ":")))
+
+def json_schema_to_regex(schema: Dict[str, Any]) -> str:
+    # Supports const, enum, anyOf, string, integer, number, boolean, null,
+    # arrays of one item schema, objects and lists of types. Every property
+    # of an object is emitted, in schema order.
+    if "const" in schema:
+        return _literal(schema["const"])
+    if "enum" in schema:
+        return "(?:" + "|".join(_literal(value) for value in schema["enum"]) + ")"
+    if "anyOf" in schema:
+        return "(?:" + "|".join(json_schema_to_regex(option) for option in schema["anyOf"]) + ")"
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        return "(?:" + "|".join(json_schema_to_regex(dict(schema, type=t)) for t in schema_type) + ")"
+    if schema_type == "string":
+        # A raw pattern could match quotes, backslashes or control characters
+        # inside the JSON string
+        if "pattern" in schema:
+            raise ValueError("Unsupported JSON schema: string pattern")
+        return JSON_STRING
+    if schema_type == "integer":
+        return JSON_INTEGER
+    if schema_type == "number":
+        return JSON_NUMBER
+    if schema_type == "boolean":
+        return JSON_BOOLEAN
+    if schema_type == "null":
+        return JSON_NULL
+    if schema_type == "array":
+        item = json_schema_to_regex(schema.get("items", {"type": "string"}))
+        return r"\[(?:" + item + "(?:," + item + r")*)?\]"
+    if schema_type == "object":
+        properties = schema.get("properties", {})
+        fields = [_literal(name) + ":" + json_schema_to_regex(value) for name, value in properties.items()]
+        return r"\{" + ",".join(fields) + r"\}"
+    raise ValueError(f"Unsupported JSON schema: {json.dumps(schema)}")
+
+# Parsed patterns are nested tuples: ("char", predicate), ("concat", nodes),
+# ("alt", nodes) and ("repeat", low, high or None, node)
+_parsed_patterns = LRUCache(256)
+
+_categories: Dict[str, Callable[[str], bool]] = {
+    "d": lambda ch: ch.isdecimal(),
+    "D": lambda ch: not ch.isdecimal(),
+    "s": lambda ch: ch.isspace(),
+    "S": lambda ch: not ch.isspace(),
+    "w": lambda ch: ch.isalnum() or ch == "_",
+    "W": lambda ch: not (ch.isalnum() or ch == "_"),
+}
+
+_control_escapes = {"a": "\a", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v", "0": "\0"}
+_hex_escapes = {"x": 2, "u": 4, "U": 8}
+
+class _PatternParser(object):
+    # Parses the subset of Python regular expression syntax that has a
+    # finite automaton: literals and escapes, ".", character classes,
+    # \d \s \w and their negations, groups, alternation and greedy, lazy or
+    # possessive quantifiers. Anchors, lookarounds, backreferences, atomic
+    # groups and inline flags raise ValueError, as does invalid syntax.
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self._alternation()
+        if self.pos < len(self.pattern):
+            # Only an unbalanced ")" stops the top level early
+            self._fail("unbalanced parenthesis")
+        return node
+
+    def _fail(self, message: str):
+        raise ValueError(f"Invalid pattern: {message} at position {self.pos}")
+
+    def _unsupported(self, what: str):
+        raise ValueError(f"Unsupported pattern: {what} at position {self.pos}")
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.pos >= len(self.pattern):
+            self._fail("unexpected end of pattern")
+        ch = self.pattern[self.pos]
+        self.pos += 1
+        return ch
+
+    def _alternation(self):
+        branches = [self._concatenation()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._concatenation())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _concatenation(self):
+        items = []
+        while self._peek() not in (None, "|", ")"):
+            items.append(self._quantified(self._atom()))
+        return items[0] if len(items) == 1 else ("concat", items)
+
+    def _quantified(self, node):
+        bounds = self._quantifier()
+        if bounds is None:
+            return node
+        # Lazy and possessive repeats match the same strings in full
+        if self._peek() in ("?", "+"):
+            self.pos += 1
+        if self._peek() in ("*", "+", "?") or (self._peek() == "{" and self._bounds() is not None):
+            self._fail("multiple repeat")
+        return ("repeat", bounds[0], bounds[1], node)
+
+    def _quantifier(self) -> Optional[Tuple[int, Optional[int]]]:
+        ch = self._peek()
+        if ch == "*":
+            self.pos += 1
+            return 0, None
+        if ch == "+":
+            self.pos += 1
+            return 1, None
+        if ch == "?":
+            self.pos += 1
+            return 0, 1
+        if ch == "{":
+            bounds = self._bounds()
+            if bounds is not None:
+                self.pos = bounds[2]
+                return bounds[0], bounds[1]
+        return None
+
+    def _bounds(self) -> Optional[Tuple[int, Optional[int], int]]:
+        # {m}, {m,}, {,n} or {m,n} at pos, and the position after it. Anything
+        # else is a literal "{", as in Python.
+        end = self.pattern.find("}", self.pos)
+        if end < 0:
+            return None
+        low, comma, high = self.pattern[self.pos + 1:end].partition(",")
+        if not (low == "" or low.isdigit()) or not (high == "" or high.isdigit()) or (low == "" and not comma):
+            return None
+        if not low.isascii() or not high.isascii():
+            return None
+        low_value = int(low) if low != "" else 0
+        high_value = int(high) if high != "" else (None if comma else low_value)
+        if high_value is not None and high_value < low_value:
+            self._fail("min repeat greater than max repeat")
+        if max(low_value, high_value or 0) > MAX_REPEAT_COUNT:
+            self._unsupported(f"repeat counts over {MAX_REPEAT_COUNT}")
+        return low_value, high_value, end + 1
+
+    def _atom(self):
+        ch = self._next()
+        if ch == "(":
+            return self._group()
+        if ch == "[":
+            return ("char", self._char_class())
+        if ch == ".":
+            return ("char", lambda c: c != "\n")
+        if ch == "\\":
+            return ("char", self._escape(in_class=False))
+        if ch in ("^", "$"):
+            self._unsupported("anchors, since patterns always match the whole completion")
+        if ch in ("*", "+", "?") or (ch == "{" and self._bounds_at(self.pos - 1)):
+            self._fail("nothing to repeat")
+        return ("char", _equals(ch))
+
+    def _bounds_at(self, pos: int) -> bool:
+        saved = self.pos
+        self.pos = pos
+        try:
+            return self._bounds() is not None
+        finally:
+            self.pos = saved
+
+    def _group(self):
+        if self._peek() == "?":
+            self.pos += 1
+            kind = self._next()
+            if kind == "P" and self._peek() == "<":
+                end = self.pattern.find(">", self.pos)
+                if end < 0 or not self.pattern[self.pos + 1:end].isidentifier():
+                    self._fail("bad group name")
+                self.pos = end + 1
+            elif kind != ":":
+                self._unsupported("lookarounds, backreferences, atomic groups, conditionals, comments and inline flags")
+        node = self._alternation()
+        if self._peek() != ")":
+            self._fail("missing ), unterminated subpattern")
+        self.pos += 1
+        return node
+
+    def _escape(self, in_class: bool) -> Callable[[str], bool]:
+        ch = self._next()
+        if ch in _categories:
+            return _categories[ch]
+        return _equals(self._escaped_char(ch, in_class))
+
+    def _escaped_char(self, ch: str, in_class: bool) -> str:
+        if ch in _control_escapes:
+            if ch == "0" and self._peek() is not None and self._peek() in "01234567":
+                self._unsupported("octal escapes")
+            return _control_escapes[ch]
+        if ch in _hex_escapes:
+            digits = self.pattern[self.pos:self.pos + _hex_escapes[ch]]
+            if len(digits) != _hex_escapes[ch] or any(d not in "0123456789abcdefABCDEF" for d in digits):
+                self._fail(f"incomplete escape \\{ch}")
+            self.pos += len(digits)
+            code = int(digits, 16)
+            if code > 0x10FFFF:
+                self._fail(f"bad escape \\{ch}{digits}")
+            return chr(code)
+        if ch == "b" and in_class:
+            return "\b"
+        if ch.isdigit():
+            self._unsupported("backreferences")
+        if ch in "AZbBN":
+            self._unsupported(f"escape \\{ch}")
+        if ch.isascii() and ch.isalpha():
+            self._fail(f"bad escape \\{ch}")
+        return ch
+
+    def _char_class(self) -> Callable[[str], bool]:
+        negate = False
+        if self._peek() == "^":
+            negate = True
+            self.pos += 1
+        chars = set()
+        ranges = []
+        predicates = []
+        first = True
+        while True:
+            if self._peek() is None:
+                self._fail("unterminated character set")
+            ch = self._next()
+            if ch == "]" and not first:
+                break
+            first = False
+            if ch == "\\":
+                escaped = self._next()
+                if escaped in _categories:
+                    predicates.append(_categories[escaped])
+                    continue
+                ch = self._escaped_char(escaped, in_class=True)
+            if self._peek() == "-" and self.pos + 1 < len(self.pattern) and self.pattern[self.pos + 1] != "]":
+                self.pos += 1
+                high = self._next()
+                if high == "\\":
+                    escaped = self._next()
+                    if escaped in _categories:
+                        self._fail("bad character range")
+                    high = self._escaped_char(escaped, in_class=True)
+                if high < ch:
+                    self._fail("bad character range")
+                ranges.append((ch, high))
+            else:
+                chars.add(ch)
+        def matches(c: str) -> bool:
+            found = c in chars or any(lo <= c <= hi for lo, hi in ranges) or any(p(c) for p in predicates)
+            return found != negate
+        return matches
+
+def _equals(ch: str) -> Callable[[str], bool]:
+    return lambda c: c == ch
+
+def _automaton_size(node) -> int:
+    # Number of NFA states PatternAutomaton._build adds for a parsed node
+    kind = node[0]
+    if kind == "char":
+        return 1
+    if kind == "concat":
+        return sum(_automaton_size(item) for item in node[1])
+    if kind == "alt":
+        return 1 + sum(1 + _automaton_size(item) for item in node[1])
+    _, low, high, item = node
+    size = _automaton_size(item)
+    if high is None:
+        return (low + 1) * size + 1
+    return high * size + 1
+
+def parse_pattern(pattern: str):
+    # Raises ValueError for invalid or unsupported patterns. Parses are
+    # cached, since the same patterns and schemas tend to come back.
+    parsed = _parsed_patterns.get(pattern)
+    if parsed is None:
+        parsed = _PatternParser(pattern).parse()
+        if _automaton_size(parsed) > MAX_AUTOMATON_STATES:
+            raise ValueError(f"Unsupported pattern: expands to over {MAX_AUTOMATON_STATES} states")
+        _parsed_patterns.put(pattern, parsed)
+    return parsed
+
+class PatternAutomaton(object):
+    # Thompson NFA for a parsed pattern, matched in full, with a DFA built
+    # from it lazily one transition at a time. DFA states are small integers,
+    # so per-state results can be memoized; the generated text itself never
+    # has to be matched again.
+    def __init__(self, pattern: str):
+        self.epsilon: List[List[int]] = []
+        self.edges: List[List[Tuple[Callable[[str], bool], int]]] = []
+        start = self._state()
+        end = self._build(parse_pattern(pattern), start)
+        self.accept = end
+        # DFA: the NFA state set of each DFA state and its transitions so far
+        self.state_sets: List[FrozenSet[int]] = []
+        self.state_ids: Dict[FrozenSet[int], int] = {}
+        self.transitions: List[Dict[str, int]] = []
+        self.accepting: List[bool] = []
+        self.start = self._dfa_state(self._closure({start}))
+
+    def _state(self) -> int:
+        self.epsilon.append([])
+        self.edges.append([])
+        return len(self.epsilon) - 1
+
+    def _build(self, node, start: int) -> int:
+        # Adds the NFA fragment for a parsed node from start, returning its
+        # end state
+        kind = node[0]
+        if kind == "char":
+            end = self._state()
+            self.edges[start].append((node[1], end))
+            return end
+        if kind == "concat":
+            state = start
+            for item in node[1]:
+                state = self._build(item, state)
+            return state
+        if kind == "alt":
+            end = self._state()
+            for item in node[1]:
+                branch = self._state()
+                self.epsilon[start].append(branch)
+                self.epsilon[self._build(item, branch)].append(end)
+            return end
+        _, low, high, item = node
+        state = start
+        for _ in range(low):
+            state = self._build(item, state)
+        if high is None:
+            loop = self._state()
+            self.epsilon[state].append(loop)
+            self.epsilon[self._build(item, loop)].append(loop)
+            return loop
+        end = self._state()
+        for _ in range(high - low):
+            self.epsilon[state].append(end)
+            state = self._build(item, state)
+        self.epsilon[state].append(end)
+        return end
+
+    def _closure(self, states) -> FrozenSet[int]:
+        closure = set(states)
+        stack = list(states)
+        while len(stack) > 0:
+            for state in self.epsilon[stack.pop()]:
+                if state not in closure:
+                    closure.add(state)
+                    stack.append(state)
+        return frozenset(closure)
+
+    def _dfa_state(self, states: FrozenSet[int]) -> int:
+        if len(states) == 0:
+            return DEAD_STATE
+        state = self.state_ids.get(states)
+        if state is None:
+            state = len(self.state_sets)
+            self.state_ids[states] = state
+            self.state_sets.append(states)
+            self.transitions.append({})
+            self.accepting.append(self.accept in states)
+        return state
+
+    def step(self, state: int, ch: str) -> int:
+        transitions = self.transitions[state]
+        next_state = transitions.get(ch)
+        if next_state is None:
+            next_state = self._dfa_state(self._closure({
+                end for nfa_state in self.state_sets[state] for matches, end in self.edges[nfa_state] if matches(ch)
+            }))
+            transitions[ch] = next_state
+        return next_state
+
+    def advance(self, state: int, text: str) -> int:
+        for ch in text:
+            if state == DEAD_STATE:
+                break
+            state = self.step(state, ch)
+        return state
+
+class TokenTrie(object):
+    # Character trie over the token strings of the vocabulary. Tokens that are
+    # empty, e.g. control tokens, or not valid UTF-8 on their own, e.g. byte
+    # fallback tokens, are left out.
+    def __init__(self, pieces: List[bytes]):
+        self.vocab_size = len(pieces)
+        self.strings: List[Optional[str]] = []
+        # Per node: child node by character, and the tokens ending there
+        self.children: List[Dict[str, int]] = [{}]
+        self.tokens: List[List[int]] = [[]]
+        for token_id, piece in enumerate(pieces):
+            try:
+                string = piece.decode("utf-8")
+            except UnicodeDecodeError:
+                string = ""
+            if string == "":
+                self.strings.append(None)
+                continue
+            self.strings.append(string)
+            node = 0
+            for ch in string:
+                child = self.children[node].get(ch)
+                if child is None:
+                    child = len(self.children)
+                    self.children.append({})
+                    self.tokens.append([])
+                    self.children[node][ch] = child
+                node = child
+            self.tokens[node].append(token_id)
+
+    def longest_token(self, text: str, start: int) -> Tuple[Optional[int], int]:
+        # The longest token that text[start:] starts with, and its length
+        node = 0
+        best = None
+        length = 0
+        for i in range(start, len(text)):
+            node = self.children[node].get(text[i])
+            if node is None:
+                break
+            if len(self.tokens[node]) > 0:
+                best = self.tokens[node][0]
+                length = i + 1 - start
+        return best, length
+
+class RegexConstraint(object):
+    # Restricts generated text to strings matching pattern in full. The
+    # allowed tokens for each automaton state are found once, by walking the
+    # token trie and pruning every branch that leads to the dead state.
+    # End-of-generation tokens are allowed in accepting states.
+    def __init__(self, pattern: str, trie: TokenTrie, eog_tokens: List[int], cache_entries: int = 4096, mask_cache_entries: int = 256):
+        self.automaton = PatternAutomaton(pattern)
+        self.trie = trie
+        self.eog_tokens = np.asarray(eog_tokens, dtype=np.int64)
+        self.allowed_tokens = LRUCache(cache_entries)
+        # Vocabulary-sized, so fewer of them are kept
+        self.blocked_tokens = LRUCache(mask_cache_entries)
+        self.forced = LRUCache(cache_entries)
+
+    @property
+    def start(self) -> int:
+        return self.automaton.start
+
+    def advance(self, state: int, token: int) -> int:
+        return self.automaton.advance(state, self.trie.strings[token] or "")
+
+    def is_complete(self, state: int) -> bool:
+        return state != DEAD_STATE and self.automaton.accepting[state]
+
+    def _allowed(self, state: int) -> np.ndarray:
+        allowed = self.allowed_tokens.get(state)
+        if allowed is not None:
+            return allowed
+        ids = []
+        if state != DEAD_STATE:
+            children = self.trie.children
+            tokens = self.trie.tokens
+            step = self.automaton.step
+            stack = [(0, state)]
+            while len(stack) > 0:
+                node, node_state = stack.pop()
+                for ch, child in children[node].items():
+                    child_state = step(node_state, ch)
+                    if child_state == DEAD_STATE:
+                        continue
+                    ids.extend(tokens[child])
+                    if len(children[child]) > 0:
+                        stack.append((child, child_state))
+        allowed = np.asarray(ids, dtype=np.int64)
+        self.allowed_tokens.put(state, allowed)
+        return allowed
+
+    def blocked(self, state: int) -> np.ndarray:
+        # Read-only mask of the tokens that cannot follow state, shared by
+        # every row sampled in that state
+        blocked = self.blocked_tokens.get(state)
+        if blocked is not None:
+            return blocked
+        blocked = np.ones(self.trie.vocab_size, dtype=bool)
+        allowed = self._allowed(state)
+        blocked[allowed] = False
+        # A dead end, e.g. a character no token can produce, ends generation
+        # rather than sampling from nothing
+        if self.is_complete(state) or len(allowed) == 0:
+            blocked[self.eog_tokens] = False
+        blocked.flags.writeable = False
+        self.blocked_tokens.put(state, blocked)
+        return blocked
+
+    def forced_text(self, state: int, max_length: int = 256) -> str:
+        # Text every continuation from state starts with: until an accepting
+        # state, the longest common prefix of all allowed tokens
+        forced = self.forced.get(state)
+        if forced is not None:
+            return forced
+        forced = ""
+        current = state
+        while len(forced) < max_length and current != DEAD_STATE and not self.automaton.accepting[current]:
+            allowed = self._allowed(current)
+            if len(allowed) == 0:
+                break
+            prefix = os.path.commonprefix([self.trie.strings[token] for token in allowed.tolist()])
+            if prefix == "":
+                break
+            forced += prefix
+            current = self.automaton.advance(current, prefix)
+        self.forced.put(state, forced)
+        return forced
+
+    def forced_tokens(self, state: int, max_tokens: int) -> Tuple[List[int], int]:
+        # The forced text from state tokenized greedily by longest match, up
+        # to max_tokens, and the state after them
+        forced = self.forced_text(state)
+        tokens = []
+        covered = 0
+        while covered < len(forced) and len(tokens) < max_tokens:
+            token, length = self.trie.longest_token(forced, covered)
+            if token is None:
+                break
+            tokens.append(token)
+            covered += length
+        return tokens, self.automaton.advance(state, forced[:covered])
@@ -1,20 +1,59 @@
-import json
-import uuid
+import itertools
 from pydantic import BaseModel
-from typing import List, Optional, Any, Tuple, Callable
+from typing import Dict, List, Optional, Any, Tuple, Callable
+
+from .constraint import json_schema_to_regex, parse_pattern
+from .stream import TokenRecord
+
+# Context IDs only need to be unique within the process
+_context_ids = itertools.count()
+
+def _new_context_id() -> str:
+    return str(next(_context_ids))
 
 class FeedTokensOperation(BaseModel):
     role: str
     tokens: List[int]
     top_p: int
+    # Only report the fed token's own logit and logprob, skipping the top_p
+    # alternatives
+    selected_only: bool = False
+
+class CompletionConstraint(BaseModel):
+    # Exactly one of a pattern the completion has to match in full, or a JSON
+    # schema its compact JSON has to conform to
+    regex: Optional[str] = None
+    json_schema: Optional[Dict[str, Any]] = None
+
+    def get_pattern(self) -> str:
+        if self.regex is not None:
+            return self.regex
+        return json_schema_to_regex(self.json_schema)
 
 class CompletionOperation(BaseModel):
     role: str
     max_tokens: int
     top_p: int
+    temperature: Optional[float] = None
+    constrained: Optional[CompletionConstraint] = None
+
+class ScoreOperation(BaseModel):
+    # Feeds tokens, then scores every candidate as their continuation, all in
+    # role. Candidate k reports its tokens as operation "<id>/<k>". What comes
+    # next continues from before the tokens, as if nothing was fed.
+    role: str
+    candidates: List[List[int]]
+    tokens: List[int] = []
+    top_p: int = 0
 
 class BranchOperation(BaseModel):
     forks: List[List["Operation"]]
+    # Beam mode: keep only the beam_width most probable forks, and drop any
+    # fork whose logprob falls more than beam_threshold below the best one.
+    # Forks are compared by mean logprob per token, since they may be at
+    # different lengths.
+    beam_width: Optional[int] = None
+    beam_threshold: Optional[float] = None
 
 class Operation(BaseModel):
     id: str
@@ -23,12 +62,15 @@ class Operation(BaseModel):
     feed_tokens: Optional[FeedTokensOperation] = None
     completion: Optional[CompletionOperation] = None
     branch: Optional[BranchOperation] = None
+    score: Optional[ScoreOperation] = None
 
     def get_role(self):
         if self.name == "feed_tokens":
             return self.feed_tokens.role
         elif self.name == "completion":
             return self.completion.role
+        elif self.name == "score":
+            return self.score.role
         return None
 
     def get_top_p(self):
@@ -36,116 +78,356 @@ class Operation(BaseModel):
             return self.completion.top_p
         elif self.name == "feed_tokens":
             return self.feed_tokens.top_p
+        elif self.name == "score":
+            return self.score.top_p
         return 1
 
+    def get_temperature(self, default: float) -> float:
+        if self.name == "completion" and self.completion.temperature is not None:
+            return self.completion.temperature
+        return default
+
+class ReadyQueue(object):
+    # Shared by the contexts of an interpreter: the operation contexts that
+    # became runnable since the runner last looked, and the beam branches
+    # that are still running, which are pruned before every step
+    def __init__(self):
+        self.contexts: List["OperationContext"] = []
+        self.beams: List["BranchContext"] = []
+
 class OperationContext(object):
-    def __init__(self, id: str, operation: Operation, reporting_callback: Callable[[str], None], parent_id: Optional[str] = None):
+    __slots__ = ("id", "operation", "parent_id", "token_index", "completed", "cancelled", "logprob", "reporting_callback", "owner")
+
+    def __init__(
+            self,
+            id: str,
+            operation: Operation,
+            reporting_callback: Callable[[TokenRecord], None],
+            parent_id: Optional[str] = None,
+            owner: Optional["SequenceContext"] = None,
+        ):
         self.id = id
         self.operation = operation
         self.parent_id = parent_id
         self.token_index = 0
         self.completed = False
+        self.cancelled = False
+        self.logprob = 0.0
         self.reporting_callback = reporting_callback
+        self.owner = owner
 
-    def loop(self):
+    def complete(self):
+        # Called by the runner once the operation has finished. The owning
+        # sequence moves on right away.
         if self.completed:
-            return []
-        return [self]
-
-    def report_token(self, token: int, logits: List[Tuple[int, float]]):
-        self.reporting_callback((json.dumps([
-            self.operation.id,
-            self.token_index,
-            token,
-            logits,
-        ]) + "\n").encode("utf-8"))
+            return
+        self.completed = True
+        if self.owner is not None:
+            self.owner.child_completed(self)
+
+    def cancel(self):
+        # The LlamaOperation for a cancelled context is dropped on the next step
+        self.cancelled = True
+        self.complete()
+
+    def get_logprob(self) -> float:
+        return self.logprob
+
+    def get_token_count(self) -> int:
+        return self.token_index
+
+    def report_token(self, token: int, logits: List[Tuple[int, float]], logprob: Optional[float] = None, rank: Optional[int] = None):
+        self.reporting_callback((self.operation.id, self.token_index, token, logits, logprob, rank))
         self.token_index += 1
+        if logprob is not None:
+            self.logprob += logprob
 
     def is_completed(self) -> Optional[str]:
         if self.completed:
             return self.id
         return None
 
+class ScoreContext(OperationContext):
+    __slots__ = ("candidate_token_index",)
+
+    def __init__(
+            self,
+            id: str,
+            operation: Operation,
+            reporting_callback: Callable[[TokenRecord], None],
+            parent_id: Optional[str] = None,
+            owner: Optional["SequenceContext"] = None,
+        ):
+        super().__init__(id, operation, reporting_callback, parent_id, owner)
+        self.candidate_token_index = [0] * len(operation.score.candidates)
+
+    def report_candidate_token(self, candidate: int, token: int, logits: List[Tuple[int, float]], logprob: float, rank: int):
+        index = self.candidate_token_index[candidate]
+        self.reporting_callback((f"{self.operation.id}/{candidate}", index, token, logits, logprob, rank))
+        self.candidate_token_index[candidate] = index + 1
+
 class SequenceContext(object):
-    def __init__(self, id: str, operations: List[Operation], reporting_callback: Callable[[str], None], parent_id: Optional[str] = None):
+    def __init__(
+            self,
+            id: str,
+            operations: List[Operation],
+            reporting_callback: Callable[[TokenRecord], None],
+            queue: ReadyQueue,
+            parent_id: Optional[str] = None,
+            owner: Optional["BranchContext"] = None,
+        ):
         self.id = id
         self.completed = False
         self.operations = operations
         self.operation_index = 0
         self.reporting_callback = reporting_callback
-        self.current_context = OperationContext(str(uuid.uuid4()), operations[0], reporting_callback, parent_id)
+        self.queue = queue
+        self.owner = owner
+        self.pruned = False
+        # Cumulative logprob and token count of the contexts already finished
+        self.finished_logprob = 0.0
+        self.finished_tokens = 0
+        self.current_context = self._make_context(operations[0], parent_id)
 
-    def loop(self):
-        if self.completed:
-            return []
-        next_parent = self.current_context.is_completed()
-        if next_parent is not None:
-            if self.operation_index < len(self.operations)-1:
-                next_operation = self.operations[self.operation_index+1]
-                self.operation_index += 1
-                if next_operation.name == "branch":
-                    self.current_context = BranchContext(str(uuid.uuid4()), next_operation.branch.forks, self.reporting_callback, next_parent)
-                else:
-                    self.current_context = OperationContext(str(uuid.uuid4()), next_operation, self.reporting_callback, next_parent)
-            else:
-                self.completed = True
-                return []
-        return self.current_context.loop()
+    def _make_context(self, operation: Operation, parent_id: Optional[str]):
+        if operation.name == "branch":
+            return BranchContext(
+                _new_context_id(),
+                operation.branch.forks,
+                self.reporting_callback,
+                self.queue,
+                parent_id,
+                operation.branch.beam_width,
+                operation.branch.beam_threshold,
+                self,
+            )
+        if operation.name == "score":
+            context = ScoreContext(_new_context_id(), operation, self.reporting_callback, parent_id, self)
+        else:
+            context = OperationContext(_new_context_id(), operation, self.reporting_callback, parent_id, self)
+        self.queue.contexts.append(context)
+        return context
+
+    def child_completed(self, context):
+        # The current operation or branch finished, so the next one starts
+        # from where it left off
+        if self.completed or context is not self.current_context:
+            return
+        if self.operation_index < len(self.operations)-1:
+            self.operation_index += 1
+            self.finished_logprob += context.get_logprob()
+            self.finished_tokens += context.get_token_count()
+            self.current_context = self._make_context(self.operations[self.operation_index], context.is_completed())
+        else:
+            self.completed = True
+            if self.owner is not None:
+                self.owner.child_completed(self)
 
     def is_completed(self) -> Optional[str]:
         if self.completed:
             return self.current_context.id
         return None
 
+    def cancel(self):
+        self.pruned = True
+        if self.completed:
+            return
+        self.completed = True
+        self.current_context.cancel()
+        if self.owner is not None:
+            self.owner.child_completed(self)
+
+    def get_logprob(self) -> float:
+        return self.finished_logprob + self.current_context.get_logprob()
+
+    def get_token_count(self) -> int:
+        return self.finished_tokens + self.current_context.get_token_count()
+
+def _beam_score(fork: SequenceContext) -> float:
+    # Mean logprob per token. Cumulative logprob would favor whichever forks
+    # are behind.
+    return fork.get_logprob() / max(fork.get_token_count(), 1)
+
 class BranchContext(object):
-    def __init__(self, id: str, forks: List[List[Operation]], reporting_callback: Callable[[str], None], parent_id: str):
+    def __init__(
+            self,
+            id: str,
+            forks: List[List[Operation]],
+            reporting_callback: Callable[[TokenRecord], None],
+            queue: ReadyQueue,
+            parent_id: str,
+            beam_width: Optional[int] = None,
+            beam_threshold: Optional[float] = None,
+            owner: Optional[SequenceContext] = None,
+        ):
         self.id = id
+        self.owner = owner
+        self.beam_width = beam_width
+        self.beam_threshold = beam_threshold
+        self.completed = False
+        self.running_forks = len(forks)
         self.forks = [
-            SequenceContext(str(uuid.uuid4()), fork, reporting_callback, parent_id)
+            SequenceContext(_new_context_id(), fork, reporting_callback, queue, parent_id, self)
             for fork in forks
         ]
-        self.completed = False
+        if self.is_beam():
+            queue.beams.append(self)
 
-    def loop(self):
-        running_contexts = []
-        all_done = True
-        for fork in self.forks:
-            running_contexts.extend(fork.loop())
-            if fork.is_completed() is None:
-                all_done = False
-        if all_done:
+    def child_completed(self, fork: SequenceContext):
+        self.running_forks -= 1
+        if self.running_forks == 0:
             self.completed = True
-        return running_contexts
+            if self.owner is not None:
+                self.owner.child_completed(self)
+
+    def is_beam(self) -> bool:
+        return self.beam_width is not None or self.beam_threshold is not None
+
+    def prune(self):
+        # Forks that have not reported any tokens yet cannot be compared
+        ranked = sorted(
+            (fork for fork in self.forks if not fork.pruned and fork.get_token_count() > 0),
+            key=_beam_score,
+            reverse=True,
+        )
+        if len(ranked) == 0:
+            return
+        best = _beam_score(ranked[0])
+        for i, fork in enumerate(ranked):
+            if (self.beam_width is not None and i >= self.beam_width) or \
+                    (self.beam_threshold is not None and _beam_score(fork) < best - self.beam_threshold):
+                fork.cancel()
+
+    def _best_fork(self) -> SequenceContext:
+        # Highest cumulative logprob, or in beam mode the best beam score,
+        # preferring earlier forks on ties
+        score = _beam_score if self.is_beam() else lambda fork: fork.get_logprob()
+        best = None
+        candidates = [fork for fork in self.forks if not fork.pruned] or self.forks
+        for fork in candidates:
+            if best is None or score(fork) > score(best):
+                best = fork
+        return best
+
+    def cancel(self):
+        for fork in self.forks:
+            fork.cancel()
+
+    def get_logprob(self) -> float:
+        return self._best_fork().get_logprob()
+
+    def get_token_count(self) -> int:
+        return self._best_fork().get_token_count()
 
     def is_completed(self) -> Optional[str]:
-        # TODO: Return the highest probability fork
+        # The next operation continues from the most probable fork
         if self.completed:
-            return self.forks[0].is_completed()
+            return self._best_fork().is_completed()
         return None
 
-class Interpreter(object):
-    def __init__(self, operations: List[Operation], reporting_callback: Callable[[str], None]):
-        self._validate(operations)
-        self.root = SequenceContext("root", operations, reporting_callback)
+class OperationPlan(object):
+    # Validated operations, with the most KV cache cells they can take worked
+    # out in the same pass: tokens fed, scored or generated, plus a role
+    # switch before each operation. Forks share the KV cache of what came
+    # before them.
+    def __init__(self, operations: List[Operation]):
+        self.operations = operations
+        self.tokens = 0
+        self.role_switches = 0
+        self._add(operations)
 
-    def _validate(self, operations: List[Operation]):
+    def _add(self, operations: List[Operation]):
         for operation in operations:
             if operation.name == "feed_tokens":
                 if operation.feed_tokens is None:
                     raise ValueError("feed_tokens cannot be None")
                 if len(operation.feed_tokens.tokens) == 0:
                     raise ValueError("feed_tokens cannot be empty")
+                self.tokens += len(operation.feed_tokens.tokens)
+                self.role_switches += 1
             elif operation.name == "completion":
                 if operation.completion is None:
                     raise ValueError("completion cannot be None")
+                constrained = operation.completion.constrained
+                if constrained is not None:
+                    if (constrained.regex is None) == (constrained.json_schema is None):
+                        raise ValueError("constrained needs exactly one of regex or json_schema")
+                    parse_pattern(constrained.get_pattern())
+                self.tokens += operation.completion.max_tokens
+                self.role_switches += 1
+            elif operation.name == "score":
+                if operation.score is None:
+                    raise ValueError("score cannot be None")
+                if len(operation.score.candidates) == 0:
+                    raise ValueError("score needs at least one candidate")
+                candidate_tokens = 0
+                for candidate in operation.score.candidates:
+                    if len(candidate) == 0:
+                        raise ValueError("score candidates cannot be empty")
+                    candidate_tokens += len(candidate)
+                self.tokens += len(operation.score.tokens) + candidate_tokens
+                self.role_switches += 1
             elif operation.name == "branch":
                 if operation.branch is None:
                     raise ValueError("branch cannot be None")
+                if len(operation.branch.forks) == 0:
+                    raise ValueError("branch needs at least one fork")
+                if operation.branch.beam_width is not None and operation.branch.beam_width < 1:
+                    raise ValueError("beam_width must be at least 1")
                 for fork in operation.branch.forks:
-                    self._validate(fork)
+                    if len(fork) == 0:
+                        raise ValueError("branch forks cannot be empty")
+                    self._add(fork)
+
+    def kv_tokens(self, role_switch_tokens: int) -> int:
+        return self.tokens + self.role_switches * role_switch_tokens
+
+class Interpreter(object):
+    # Runs the operation tree as the runner completes its operations: each
+    # completion starts whatever comes next, and loop() only hands out the
+    # operations that became runnable, so a step costs time in proportion to
+    # the work running rather than to the size of the tree
+    def __init__(
+            self,
+            operations: List[Operation],
+            reporting_callback: Callable[[TokenRecord], None],
+            priority: int = 0,
+            client: str = "",
+            session_id: Optional[str] = None,
+            new_session: bool = False,
+        ):
+        if len(operations) == 0:
+            raise ValueError("operations cannot be empty")
+        # Compiled once per request: validated, and sized for admission
+        self.plan = OperationPlan(operations)
+        self.operations = operations
+        # Higher priorities are admitted first and preempted last; admission
+        # is shared fairly between clients of the same priority
+        self.priority = priority
+        self.client = client
+        # Operations continue the session's conversation, or start it over
+        # if new_session
+        self.session_id = session_id
+        self.new_session = new_session
+        self.queue = ReadyQueue()
+        self.root = SequenceContext("root", self.operations, reporting_callback, self.queue)
 
     def loop(self):
-        return self.root.loop()
-    
+        # Prunes beams, then returns the contexts that became runnable since
+        # the last call
+        queue = self.queue
+        if len(queue.beams) > 0:
+            for branch in queue.beams:
+                if not branch.completed:
+                    branch.prune()
+            queue.beams = [branch for branch in queue.beams if not branch.completed]
+        contexts = [context for context in queue.contexts if not context.completed]
+        queue.contexts = []
+        return contexts
+
+    def cancel(self):
+        # Every running operation is dropped on the next step
+        self.root.cancel()
+
     def is_done(self):
-        return self.root.is_completed() is not None
+        return self.root.completed
@@ -1,11 +1,31 @@
+import logging
+import time
+
 import llama_cpp
+import numpy as np
 
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 
+from .admission import AdmissionController
+from .candidates import CandidateScoring
+from .constraint import RegexConstraint, TokenTrie
 from .model_config import ModelConfig
-from .interpreter import Interpreter
-from .llama_operation import LlamaOperation
-from .util import token_to_string
+from .interpreter import Interpreter, Operation
+from .llama_operation import LlamaOperation, replayable_length
+from .metrics import InferenceMetrics
+from .preemption import PreemptionManager
+from .prefix_cache import PrefixCache
+from .sampler import Sampler
+from .scoring import score_tokens
+from .seq_pool import SeqIdPool
+from .sessions import Session, SessionBusy, SessionNotFound, SessionStore
+from .snapshots import Snapshot, SnapshotStore
+from .speculative import DraftModelSpeculator, PromptLookupSpeculator, SpeculationStats
+from .token_map import TokenMap
+from .tokenizer import Tokenizer
+from .util import LRUCache, get_logits
+
+logger = logging.getLogger(__name__)
 
 class Llama(object):
     def __init__(self, config: ModelConfig):
@@ -14,27 +34,90 @@ class Llama(object):
         self.model_params.n_gpu_layers = 33
         self.params = llama_cpp.llama_context_default_params()
         self.params.n_ctx = config.context_size
+        self.params.n_seq_max = config.max_sequences
+        if config.n_threads is not None:
+            self.params.n_threads = config.n_threads
+            self.params.n_threads_batch = config.n_threads
         self.context_size = self.params.n_ctx
         self.temperature = config.temperature
         self.batch_size = config.batch_size
         self.batch_max_tokens = config.batch_max_tokens
+        self.prefill_chunk_tokens = config.prefill_chunk_tokens
+        self.step_token_budget = min(self.batch_size, self.batch_max_tokens)
+        self.admission = AdmissionController(config.admission_kv_tokens or self.context_size)
+        self.sessions = SessionStore(config.max_sessions, config.session_idle_seconds)
+        # Session of each running interpreter that has one
+        self.session_bindings: Dict[int, Session] = {}
         self.model_filename = config.model_filename
-        self.next_seq_num = 0
+        self.seq_ids = SeqIdPool(config.max_sequences)
+        # Every operation of a running interpreter, by context ID
         self.operations = {}
+        # The subset of operations that still need scheduling or decoding
+        self.active_operations = {}
+        # Context IDs of the operations created for each running interpreter
+        self.interpreter_operations = {}
+        # Creation counter, used to preempt the newest operations first
+        self.operation_order = 0
+        # Number of tokens sampled for each running interpreter
+        self.generated_tokens: Dict[int, int] = {}
+        # Interpreters whose final prompt is to be saved as a snapshot: the
+        # snapshot name and a callback told whether it was saved
+        self.snapshot_requests: Dict[int, Tuple[str, Callable[[bool], None]]] = {}
 
         self.model = llama_cpp.llama_load_model_from_file(self.model_filename.encode('utf-8'), self.model_params)
         self.ctx = llama_cpp.llama_new_context_with_model(self.model, self.params)
         self.vocab_size = llama_cpp.llama_n_vocab(self.model)
+        self.tokenizer = Tokenizer(self.model, config.tokenize_cache_entries)
+        # Constraints by pattern, sharing a trie over the vocabulary that is
+        # built when the first constrained completion arrives
+        self.constraints = LRUCache(64)
+        self.token_trie = None
+        self.eog_tokens = None
 
-        _arr = (llama_cpp.llama_token_data * self.vocab_size)(
-            *[
-                llama_cpp.llama_token_data(token_id, 0.0, 0.0)
-                for token_id in range(self.vocab_size)
-            ]
-        )
-        self.candidates_p = llama_cpp.ctypes.pointer(llama_cpp.llama_token_data_array(_arr, len(_arr), False))
+        # Tokens shared by score candidates are tagged with every sequence
+        self.batch = llama_cpp.llama_batch_init(self.batch_size, 0, config.max_sequences)
+        self.sampler = Sampler(self.vocab_size)
+        # Zero-copy view of the logits produced by the last _decode_batch, and
+        # the operations whose logits are rows of it
+        self.batch_logits = None
+        self.batch_logits_operations = []
+        self.prefix_cache = PrefixCache(config.prefix_cache_tokens, config.prefix_cache_entries)
+        self.preemption = PreemptionManager(self.ctx)
+        self.speculative_tokens = config.speculative_tokens
+        self.speculation = SpeculationStats()
+        self.speculator = None
+        if config.draft_model_filename is not None:
+            self.speculator = DraftModelSpeculator(config.draft_model_filename, self.model_params, self.params, self.batch_size, self.vocab_size)
+        elif config.prompt_lookup_ngram > 0:
+            self.speculator = PromptLookupSpeculator(config.prompt_lookup_ngram)
+
+        self.metrics = InferenceMetrics(self.batch_size)
+        self.metrics.kv_cells_total.set(self.context_size)
+        # Time spent sampling during the current step
+        self.step_sample_seconds = 0.0
+        registry = self.metrics.registry
+        registry.gauge("prefix_cache_entries", "Prompts kept in the prefix cache", lambda: len(self.prefix_cache))
+        registry.gauge("prefix_cache_token_hit_ratio", "Fraction of looked up prompt tokens found in the prefix cache",
+            lambda: self.prefix_cache.stats()["token_hit_rate"])
+        registry.gauge("tokenize_cache_hit_ratio", "Fraction of tokenize calls answered from the cache",
+            lambda: self.tokenizer.cache.stats()["hit_rate"])
+        registry.counter("preemptions_total", "Operations swapped out of the KV cache", lambda: self.preemption.swapped_out)
+        registry.gauge("swapped_bytes", "KV cache state held in host memory for preempted operations",
+            lambda: self.preemption.resident_bytes)
+        registry.counter("speculative_drafted_tokens_total", "Draft tokens verified", lambda: self.speculation.drafted)
+        registry.counter("speculative_accepted_tokens_total", "Draft tokens accepted", lambda: self.speculation.accepted)
+        registry.gauge("admission_queue_depth", "Requests waiting for admission", lambda: len(self.admission.queue))
+        registry.gauge("admission_reserved_tokens", "KV cache tokens reserved by admitted requests", lambda: self.admission.reserved)
+        registry.gauge("sessions", "Conversations kept between requests", lambda: len(self.sessions))
 
-        self.batch = llama_cpp.llama_batch_init(self.batch_size, 0, 1)
+        self.snapshots = None
+        if config.snapshot_dir is not None:
+            self.snapshots = SnapshotStore(config.snapshot_dir, self.model_filename, self.ctx)
+            registry.counter("snapshot_loads_total", "Prompt snapshots loaded from disk", lambda: self.snapshots.loaded)
+            registry.counter("snapshot_loaded_bytes_total", "KV cache state loaded from snapshots", lambda: self.snapshots.loaded_bytes)
+            if config.preload_snapshots:
+                for snapshot in list(self.snapshots.snapshots.values()):
+                    self._load_snapshot(snapshot)
 
         self.tokens_for_role = {
             "null_system": self.tokenize("<|system|>\n"),
@@ -44,33 +127,215 @@ class Llama(object):
             "end_user": self.tokenize("<|end|>\n<|user|>\n"),
             "end_assistant": self.tokenize("<|end|>\n<|assistant|>\n"),
         }
+        # Longest role switch, counted before every operation when sizing
+        # requests for admission
+        self.role_switch_tokens = max(len(tokens) for tokens in self.tokens_for_role.values())
 
     def stop(self):
+        if self.speculator is not None:
+            self.speculator.stop()
         llama_cpp.llama_batch_free(self.batch)
         llama_cpp.llama_kv_cache_clear(self.ctx)
         llama_cpp.llama_free(self.ctx)
 
-    def token_map(self):
-        return { token_id: token_to_string(self.model, token_id) for token_id in range(self.vocab_size) }
+    def token_map(self) -> TokenMap:
+        return self.tokenizer.token_map()
 
     def tokenize(self, text: str) -> List[int]:
-        encoded = text.encode('utf-8')
-        tokens = (llama_cpp.llama_token * int(4096))()
-        n_tokens = llama_cpp.llama_tokenize(self.model, encoded, len(encoded), tokens, 4096, True, False)
-        return list(tokens[:n_tokens])
+        # Safe to call from any thread
+        return self.tokenizer.tokenize(text)
+
+    def stats(self):
+        return {
+            "prefix_cache": self.prefix_cache.stats(),
+            "preemption": self.preemption.stats(),
+            "tokenize_cache": self.tokenizer.cache.stats(),
+            "speculation": self.speculation.stats(),
+            "snapshots": self.snapshots.stats() if self.snapshots is not None else None,
+            "admission": self.admission.stats(),
+            "sessions": self.sessions.stats(),
+        }
+
+    def open_session(self, interpreter: Interpreter):
+        # Binds an interpreter with a session_id to its session. Raises
+        # SessionNotFound if the session is unknown, e.g. expired, or
+        # SessionBusy if another request is running on it.
+        if interpreter.session_id is None or id(interpreter) in self.session_bindings:
+            return
+        session = self.sessions.get(interpreter.session_id)
+        if session is not None and session.is_busy():
+            raise SessionBusy(f"Session {interpreter.session_id} is busy")
+        if interpreter.new_session:
+            if session is not None:
+                self._drop_session(self.sessions.remove(session.id))
+            session = self.sessions.create(interpreter.session_id)
+        elif session is None:
+            raise SessionNotFound(f"Unknown or expired session {interpreter.session_id}")
+        else:
+            self.sessions.resumed += 1
+        session.interpreter_key = id(interpreter)
+        self.sessions.touch(session)
+        self.session_bindings[id(interpreter)] = session
+
+    def _drop_session(self, session: Session):
+        operation = session.operation
+        session.operation = None
+        if operation is None:
+            return
+        logger.debug("Dropping session %s", session.id)
+        if operation.seq_num >= 0:
+            self._free_seq_num(operation.seq_num)
+            operation.seq_num = -1
+        self.preemption.discard(operation)
+
+    def _release_idle_session(self) -> bool:
+        # Frees the sequence of the least recently used idle session. Its
+        # history is decoded again, from the prefix cache if possible, when
+        # it is resumed.
+        session = self.sessions.idle_resident()
+        if session is None:
+            return False
+        logger.info("Releasing the KV cache of idle session %s", session.id)
+        self._free_seq_num(session.operation.seq_num)
+        session.operation.seq_num = -1
+        return True
+
+    def _session_operation(self, interpreter: Interpreter) -> Optional[LlamaOperation]:
+        # The operation a successfully finished request leaves the
+        # conversation in
+        if not interpreter.is_done():
+            return None
+        operation = self.operations.get(interpreter.root.is_completed())
+        if operation is None or operation.context.cancelled or not operation.is_done:
+            return None
+        if operation.seq_num < 0 and len(operation.tokens) == 0:
+            return None
+        return operation
+
+    def _end_session_request(self, session: Session, operation: Optional[LlamaOperation]):
+        session.interpreter_key = None
+        self.sessions.touch(session)
+        if operation is None:
+            # A failed or cancelled request leaves the conversation as it was
+            if session.operation is None:
+                self.sessions.remove(session.id)
+            return
+        previous = session.operation
+        if previous is not None:
+            self._drop_session(session)
+        self.preemption.discard(operation)
+        session.operation = operation
+
+    def is_queued(self, interpreter: Interpreter) -> bool:
+        # Whether the interpreter is still waiting for admission
+        return id(interpreter) in self.admission and not self.admission.is_admitted(id(interpreter))
+
+    def _admission_tokens(self, interpreter: Interpreter) -> int:
+        # A request continuing a session also holds the conversation so far,
+        # whether it is still resident or has to be decoded again
+        tokens = interpreter.plan.kv_tokens(self.role_switch_tokens)
+        session = self.session_bindings.get(id(interpreter))
+        if session is not None and session.operation is not None:
+            tokens += len(session.operation.tokens)
+        return tokens
+
+    def check_operations(self, operations: List[Operation]):
+        # Raises ValueError for operations that can never be scheduled
+        for operation in operations:
+            if operation.name == "score" and len(operation.score.candidates) > self.seq_ids.size:
+                raise ValueError(f"score has more candidates than the {self.seq_ids.size} sequences")
+            elif operation.name == "branch":
+                for fork in operation.branch.forks:
+                    self.check_operations(fork)
+
+    def request_snapshot(self, interpreter: Interpreter, name: str, on_saved: Callable[[bool], None]):
+        # Once interpreter finishes, its prompt is saved as snapshot name. Must
+        # be called before the interpreter is first stepped.
+        if self.snapshots is None:
+            raise ValueError("No snapshot_dir configured")
+        self.snapshot_requests[id(interpreter)] = (name, on_saved)
+
+    def _save_snapshot(self, name: str, operations: List[LlamaOperation]) -> bool:
+        # The finished operation with the longest replayable history holds the
+        # whole prompt
+        best = None
+        for operation in operations:
+            if operation.seq_num < 0 or not operation.is_done or not operation.context.completed or \
+                    operation.reports is None or len(operation.reports) != len(operation.tokens):
+                continue
+            if best is None or len(operation.tokens) > len(best.tokens):
+                best = operation
+        if best is None or len(best.tokens) == 0:
+            return False
+        return self.snapshots.save(name, best.tokens.tolist(), best.reports, best.seq_num)
+
+    def _load_snapshot(self, snapshot: Snapshot) -> bool:
+        # Seeds the prefix cache with a pinned entry for snapshot
+        seq_num = self._allocate_seq_num()
+        if seq_num is None:
+            return False
+        reports = self.snapshots.load(snapshot, seq_num)
+        if reports is None:
+            self._free_seq_num(seq_num)
+            return False
+        cached, evicted = self.prefix_cache.insert(seq_num, list(snapshot.tokens), reports, pinned=True)
+        for entry in evicted:
+            self._free_seq_num(entry.seq_num)
+        if not cached:
+            self._free_seq_num(seq_num)
+            return False
+        logger.info("Loaded snapshot %s of %d tokens into seq %d", snapshot.name, len(snapshot.tokens), seq_num)
+        return True
+
+    def _constraint(self, operation: Operation) -> Optional[RegexConstraint]:
+        if operation.name != "completion" or operation.completion.constrained is None:
+            return None
+        pattern = operation.completion.constrained.get_pattern()
+        constraint = self.constraints.get(pattern)
+        if constraint is None:
+            if self.token_trie is None:
+                self.token_trie = TokenTrie(self.tokenizer.token_pieces())
+                self.eog_tokens = [token for token in range(self.vocab_size) if llama_cpp.llama_token_is_eog(self.model, token)]
+            constraint = RegexConstraint(pattern, self.token_trie, self.eog_tokens)
+            self.constraints.put(pattern, constraint)
+        return constraint
 
     def _schedule_runnable_operations(self):
         # For any new operations, assign a sequence number, copying from the
-        # parent operation if there is one.
-        for operation in self.operations.values():
+        # parent operation if there is one. Higher priorities go first.
+        for operation in sorted(self.active_operations.values(), key=self.preemption.rank, reverse=True):
             if operation.seq_num >= 0 or operation.is_done:
                 continue
 
-            new_seq_num = self.next_seq_num
+            new_seq_num = self._allocate_seq_num()
+            if new_seq_num is None:
+                # Out of sequences; wait for running operations to finish
+                break
+            candidate_seq_nums = []
+            if operation.context.operation.name == "score":
+                # Every candidate after the first needs a sequence of its own
+                candidate_seq_nums = self._allocate_seq_nums(len(operation.context.operation.score.candidates) - 1)
+                if candidate_seq_nums is None:
+                    self._free_seq_num(new_seq_num)
+                    break
 
-            if operation.parent is not None and operation.parent.seq_num >= 0:
+            if operation.swapped_state is not None:
+                # Put a preempted operation's KV cache back from host memory,
+                # decoding only what it sampled after being swapped out
+                logger.debug("Swapping in operation %s", operation.context.id)
+                if not self.preemption.swap_in(operation, new_seq_num) or (
+                        operation.swapped_length < len(operation.tokens) and
+                        not operation.restore_tokens(self.ctx, self.batch, self.batch_size, self.vocab_size, new_seq_num, operation.swapped_length)):
+                    # Still no room; wait for running operations to finish
+                    # rather than letting newer ones take the space
+                    logger.info("Cannot swap in operation %s", operation.context.id)
+                    self._free_seq_num(new_seq_num)
+                    break
+                self.preemption.discard(operation)
+
+            elif operation.parent is not None and operation.parent.seq_num >= 0:
                 # Copy the KV cache from the parent beam to the new beam
-                print(f"Copying KV cache from seq {operation.parent.seq_num} to {new_seq_num}")
+                logger.debug("Copying KV cache from seq %d to %d", operation.parent.seq_num, new_seq_num)
                 llama_cpp.llama_kv_cache_seq_cp(self.ctx, operation.parent.seq_num, new_seq_num, -1, -1)
                 operation.logits = operation.parent.logits
                 operation.parent = None
@@ -78,92 +343,630 @@ class Llama(object):
             elif len(operation.tokens) > 0:
                 # If the operation has previously been descheduled, or the
                 # parent KV cache has been cleared, generate a new cache here
-                print(f"Restoring KV cache for operation {operation.context.id}")
-                if not operation.restore_tokens(self.ctx, self.batch, self.batch_size, new_seq_num):
-                    print(f"Cannot schedule operation {operation.context.id} due to error restoring KV cache")
-                    llama_cpp.llama_kv_cache_seq_rm(self.ctx, new_seq_num, -1, -1)
-                    continue
+                logger.debug("Restoring KV cache for operation %s", operation.context.id)
+                start = self._restore_cached_prefix(operation.tokens.tolist(), new_seq_num)
+                if not operation.restore_tokens(self.ctx, self.batch, self.batch_size, self.vocab_size, new_seq_num, start, self._make_room):
+                    logger.warning("Cannot schedule operation %s due to error restoring KV cache", operation.context.id)
+                    self._free_seq_num(new_seq_num)
+                    for seq_num in candidate_seq_nums:
+                        self._free_seq_num(seq_num)
+                    break
 
-            print(f"Assigning operation {operation.context.id} seq_num {new_seq_num}")
+            logger.debug("Assigning operation %s seq_num %d", operation.context.id, new_seq_num)
             operation.seq_num = new_seq_num
-            self.next_seq_num += 1
+            if operation.context.operation.name == "score":
+                self._begin_scoring(operation, candidate_seq_nums)
+
+        # Now we are safe to clear KV cache from any operations that are done,
+        # handing prompts over to the prefix cache
+        finished = []
+        for operation in self.active_operations.values():
+            if not operation.is_done:
+                continue
+            if operation.seq_num >= 0:
+                logger.debug("Descheduling operation %s because it is done", operation.context.id)
+                self._deschedule(operation)
+            self.preemption.discard(operation)
+            finished.append(operation.context.id)
+        for context_id in finished:
+            del self.active_operations[context_id]
+
+    def _allocate_seq_num(self):
+        seq_num = self.seq_ids.allocate()
+        while seq_num is None and self._free_cached():
+            seq_num = self.seq_ids.allocate()
+        return seq_num
+
+    def _allocate_seq_nums(self, n: int) -> Optional[List[int]]:
+        # All n or none
+        seq_nums = []
+        while len(seq_nums) < n:
+            seq_num = self._allocate_seq_num()
+            if seq_num is None:
+                for seq_num in seq_nums:
+                    self._free_seq_num(seq_num)
+                return None
+            seq_nums.append(seq_num)
+        return seq_nums
+
+    def _free_cached(self) -> bool:
+        # Frees a sequence that nothing is running on: cached prompts go
+        # first, pinned ones last, then idle sessions
+        entry = self.prefix_cache.evict_lru()
+        if entry is not None:
+            self._free_seq_num(entry.seq_num)
+            return True
+        return self._release_idle_session()
+
+    def _free_seq_num(self, seq_num: int):
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq_num, -1, -1)
+        self.seq_ids.release(seq_num)
+
+    def _deschedule(self, operation: LlamaOperation):
+        if operation.scoring is not None:
+            self._end_scoring(operation)
+        # Finished prompts keep their KV cache in the prefix cache
+        if not (operation.is_done and self._cache_prefix(operation)):
+            self._free_seq_num(operation.seq_num)
+        operation.seq_num = -1
+
+    def _cache_prefix(self, operation: LlamaOperation) -> bool:
+        if operation.reports is None or len(operation.reports) != len(operation.tokens):
+            return False
+        cached, evicted = self.prefix_cache.insert(operation.seq_num, operation.tokens.tolist(), operation.reports)
+        for entry in evicted:
+            self._free_seq_num(entry.seq_num)
+        return cached
 
-        # Now we are safe to clear KV cache from any operations that are done
-        for operation in self.operations.values():
-            if operation.seq_num >= 0 and operation.is_done:
-                print(f"Descheduling operation {operation.context.id} because it is done")
-                llama_cpp.llama_kv_cache_seq_rm(self.ctx, operation.seq_num, -1, -1)
-                operation.seq_num = -1
+    def _make_room(self, requester: LlamaOperation, pending_tokens: Optional[Dict[LlamaOperation, int]] = None) -> bool:
+        # Frees some KV cache space on behalf of requester after llama_decode
+        # ran out. Cached prompts go first, then idle sessions, then running
+        # operations ranked below the requester are swapped out. Returns False
+        # if nothing could be freed.
+        if self._free_cached():
+            return True
+        victim = self.preemption.select_victim(self.active_operations.values(), requester)
+        if victim is None:
+            return False
+        self._preempt(victim, (pending_tokens or {}).get(victim))
+        return True
+
+    def _preempt(self, operation: LlamaOperation, pending_token: Optional[int] = None):
+        # pending_token was sampled by the operation but not decoded yet, so
+        # it is not part of the saved state
+        logger.info("Preempting operation %s from seq %d", operation.context.id, operation.seq_num)
+        if not operation.prefilled:
+            # Only whole prefills are kept
+            llama_cpp.llama_kv_cache_seq_rm(self.ctx, operation.seq_num, len(operation.tokens), -1)
+            operation.reset_prefill()
+        if operation.logits_row >= 0:
+            operation.logits = operation.logits.copy()
+            operation.logits_row = -1
+            self.batch_logits_operations.remove(operation)
+        if not self.preemption.swap_out(operation):
+            # Fall back to decoding its history again when it is rescheduled
+            logger.warning("Could not save state for operation %s", operation.context.id)
+        self._free_seq_num(operation.seq_num)
+        operation.seq_num = -1
+        if pending_token is not None:
+            operation.tokens.append(pending_token)
+            if len(operation.forced_tokens) > 0:
+                operation.report_forced(self.model, None)
+
+    def _restore_cached_prefix(self, tokens: List[int], seq_num: int) -> int:
+        # Returns the position from which tokens still need to be decoded
+        entry, length = self.prefix_cache.match(tokens)
+        self.prefix_cache.record_lookup(len(tokens), max(length - 1, 0))
+        if entry is None or length < 2:
+            return 0
+        llama_cpp.llama_kv_cache_seq_cp(self.ctx, entry.seq_num, seq_num, 0, length - 1)
+        self.prefix_cache.touch(entry)
+        return length - 1
+
+    def _reuse_cached_prefix(self, operation: LlamaOperation):
+        tokens = operation.get_prefill_tokens(self.tokens_for_role)
+        if len(tokens) < 2 or operation.reports is None:
+            return
+        start = len(operation.tokens)
+        history = operation.tokens + tokens
+        if self.snapshots is not None:
+            self._load_matching_snapshot(history)
+        entry, length = self.prefix_cache.match(history)
+        if entry is not None:
+            # Reports scored with fewer alternatives than the operation wants
+            # are scored again
+            length = start + replayable_length(entry.reports[start:length], operation.prefill_top_n())
+        # The last matched token is decoded again to get its logits
+        reused = length - start
+        self.prefix_cache.record_lookup(len(tokens), max(reused - 1, 0))
+        if entry is None or reused < 2:
+            return
+        logger.debug("Reusing %d cached tokens from seq %d for operation %s", reused - 1, entry.seq_num, operation.context.id)
+        llama_cpp.llama_kv_cache_seq_cp(self.ctx, entry.seq_num, operation.seq_num, start, length - 1)
+        self.prefix_cache.touch(entry)
+        operation.reuse_prefix(entry.reports[start:length], reused)
+
+    def _load_matching_snapshot(self, tokens: List[int]):
+        # Loads the snapshot for a prompt starting with tokens on first use,
+        # or again after its pinned entry was evicted
+        snapshot = self.snapshots.match(tokens)
+        if snapshot is None:
+            return
+        _, length = self.prefix_cache.match(list(snapshot.tokens))
+        if length < len(snapshot.tokens):
+            self._load_snapshot(snapshot)
 
     def _decode_operation_tokens(self):
-        for operation in self.operations.values():
-            if operation.seq_num < 0:
+        # Whole prompts, until they exceed the step's token budget; the rest
+        # wait for the next step
+        budget = self.step_token_budget
+        for operation in self.active_operations.values():
+            if operation.seq_num < 0 or operation.prefilled:
                 continue
+            if budget <= 0:
+                break
 
-            if not operation.decode_tokens(self.ctx, self.model, self.vocab_size, self.candidates_p, self.batch, self.batch_size, self.tokens_for_role):
-                # There was an error decoding tokens, so deschedule the beam for now
-                print(f"Descheduling operation {operation.context.id} due to error")
-                llama_cpp.llama_kv_cache_seq_rm(self.ctx, operation.seq_num, -1, -1)
-                operation.seq_num = -1
-                operation.logits = None
+            if operation.prefill_done == 0:
+                self._reuse_cached_prefix(operation)
+
+            fed = len(operation.tokens)
+            if operation.decode_tokens(self.ctx, self.model, self.vocab_size, self.batch, self.batch_size, self.tokens_for_role, self._make_room):
+                self.metrics.prefill_tokens.inc(len(operation.tokens) - fed)
+                budget -= len(operation.tokens) - fed
+            else:
+                # Nothing else could be preempted, so swap this operation out
+                # until there is room
+                logger.info("Preempting operation %s due to error", operation.context.id)
+                self._preempt(operation)
     
-    def _decode_batch(self):
-        self.batch.n_tokens = 0
-        # Map each token index to the operation that produced it
-        operation_result_indices = {}
+    def _begin_scoring(self, operation: LlamaOperation, candidate_seq_nums: List[int]):
+        # The first candidate continues on the operation's own sequence, the
+        # others on copies of it
+        for seq_num in candidate_seq_nums:
+            llama_cpp.llama_kv_cache_seq_cp(self.ctx, operation.seq_num, seq_num, -1, -1)
+        operation.scoring = CandidateScoring(
+            operation.get_prefill_tokens(self.tokens_for_role),
+            operation.context.operation.score.candidates,
+            len(operation.tokens),
+            [operation.seq_num] + candidate_seq_nums,
+        )
+        self.metrics.scored_tokens.inc(operation.scoring.begin(operation.logits, operation.context, operation.context.operation.get_top_p()))
+
+    def _end_scoring(self, operation: LlamaOperation):
+        # Leaves the operation's sequence with only its own history
+        for seq_num in operation.scoring.seq_nums[1:]:
+            self._free_seq_num(seq_num)
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, operation.seq_num, len(operation.tokens), -1)
+        operation.scoring = None
+
+    def _decode_scoring(self):
+        # Score operations decode in batches of their own, together taking up
+        # to the step's token budget
+        budget = self.step_token_budget
+        for operation in self.active_operations.values():
+            scoring = operation.scoring
+            if scoring is None or operation.is_done:
+                continue
+            top_n = operation.context.operation.get_top_p()
+            while budget > 0 and not scoring.is_done():
+                self._detach_batch_logits()
+                n_entries = scoring.fill_batch(self.batch, budget)
+                ret = llama_cpp.llama_decode(self.ctx, self.batch)
+                while ret == 1 and self._free_cached():
+                    ret = llama_cpp.llama_decode(self.ctx, self.batch)
+                if ret == 1:
+                    # Running operations are not preempted for scoring; it
+                    # goes on once they have made room
+                    logger.info("Out of KV cache space for scoring operation %s", operation.context.id)
+                    return
+                if ret != 0:
+                    raise Exception("LLAMA ERROR " + str(ret))
+                logits = get_logits(self.ctx, scoring.n_outputs(n_entries), self.vocab_size)
+                self.metrics.scored_tokens.inc(scoring.decoded(n_entries, logits, operation.context, top_n))
+                self.metrics.prefill_tokens.inc(n_entries)
+                budget -= n_entries
+            if not scoring.is_done():
+                return
+            self._end_scoring(operation)
+            operation.is_done = True
+            operation.context.complete()
+
+    def _detach_batch_logits(self):
+        # Any llama_decode call overwrites the batch logits, so operations that
+        # are still waiting to sample from them need their own copy first.
+        for operation in self.batch_logits_operations:
+            if operation.logits_row >= 0:
+                operation.logits = operation.logits.copy()
+                operation.logits_row = -1
+        self.batch_logits = None
+        self.batch_logits_operations = []
+
+    def _logits_matrix(self, operations: List[LlamaOperation]) -> np.ndarray:
+        rows = [operation.logits_row for operation in operations]
+        if self.batch_logits is not None and min(rows) >= 0:
+            if len(rows) == len(self.batch_logits) and rows == list(range(len(rows))):
+                return self.batch_logits
+            return self.batch_logits[rows]
+        return np.stack([operation.logits for operation in operations])
+
+    def _fill_batch(self, entries: List[Tuple[LlamaOperation, List[int]]], chunks: List[Tuple[LlamaOperation, int, int]]):
+        i = 0
+        for operation, tokens in entries:
+            for j, token in enumerate(tokens):
+                self.batch.token[i] = token
+                self.batch.pos[i] = len(operation.tokens) + j
+                self.batch.n_seq_id[i] = 1
+                self.batch.seq_id[i][0] = operation.seq_num
+                self.batch.logits[i] = True
+                i += 1
+        for operation, start, end in chunks:
+            for j in range(start, end):
+                self.batch.token[i] = operation.prefill_tokens[j]
+                self.batch.pos[i] = len(operation.tokens) + j
+                self.batch.n_seq_id[i] = 1
+                self.batch.seq_id[i][0] = operation.seq_num
+                self.batch.logits[i] = True
+                i += 1
+        self.batch.n_tokens = i
+
+    def _prefill_chunks(self, used: int) -> List[Tuple[LlamaOperation, int, int]]:
+        # In chunked prefill mode, the next chunk of every scheduled prompt,
+        # oldest first, that fits in the step's token budget after the used
+        # tokens of running operations
+        room = self.step_token_budget - used
+        chunks = []
+        for operation in self.active_operations.values():
+            if room < 1:
+                break
+            if operation.seq_num < 0 or operation.prefilled or operation.is_done:
+                continue
+            if operation.prefill_next is None and operation.prefill_done == 0:
+                self._reuse_cached_prefix(operation)
+            if len(operation.get_prefill_tokens(self.tokens_for_role)) == 0:
+                operation.prefilled = True
+                continue
+            start, end = operation.next_prefill_chunk(self.tokens_for_role, min(self.prefill_chunk_tokens, room))
+            chunks.append((operation, start, end))
+            room -= end - start
+        return chunks
 
-        # Iterate over all operations and decode tokens
-        for operation in self.operations.values():
-            if operation.seq_num < 0:
+    def _add_forced(self, entries: List[Tuple[LlamaOperation, List[int]]]):
+        # Tokens that a constrained completion has no choice about follow its
+        # sampled token in the same batch, instead of taking a step each
+        room = self.step_token_budget - len(entries)
+        for operation, tokens in entries:
+            n = min(operation.remaining_tokens, room)
+            if operation.constraint is None or operation.is_done or n < 1:
                 continue
-            if operation.logits is None:
+            forced, state = operation.constraint.forced_tokens(operation.constraint_state, n)
+            if len(forced) == 0:
                 continue
-            next_token_id = operation.decode_next(
-                self.ctx,
-                    self.model,
-                    self.vocab_size,
-                    self.temperature,
-                    self.candidates_p,
-                )
-
-            if next_token_id is not None:
-                operation_result_indices[self.batch.n_tokens] = operation
-                self.batch.token[self.batch.n_tokens] = next_token_id
-                self.batch.pos[self.batch.n_tokens] = len(operation.tokens)
-                self.batch.n_seq_id[self.batch.n_tokens] = 1
-                self.batch.seq_id[self.batch.n_tokens][0] = operation.seq_num
-                self.batch.logits[self.batch.n_tokens] = True
-                self.batch.n_tokens += 1
-                operation.tokens.append(next_token_id)
-
-        if self.batch.n_tokens > 0:
+            operation.forced_tokens = forced
+            operation.constraint_state = state
+            tokens.extend(forced)
+            room -= len(forced)
+
+    def _add_drafts(self, entries: List[Tuple[LlamaOperation, List[int]]]):
+        # Speculatively extend each sampled token with draft tokens, as far as
+        # the operation's token budget and the batch allow
+        room = self.step_token_budget - sum(len(tokens) for _, tokens in entries)
+        requests = []
+        for operation, tokens in entries:
+            n = min(self.speculative_tokens, operation.remaining_tokens, room)
+            if operation.is_done or operation.constraint is not None or n < 1:
+                continue
+            requests.append((operation, tokens, n))
+            room -= n
+        if len(requests) == 0:
+            return
+        drafts = self.speculator.propose(requests)
+        by_operation = {operation.context.id: draft for (operation, _, _), draft in zip(requests, drafts)}
+        for operation, tokens in entries:
+            tokens.extend(by_operation.get(operation.context.id, []))
+
+    def _verify_drafts(self, drafted: List[Tuple[LlamaOperation, List[int], int]]):
+        # Row i of an operation's batch logits predicts the token after its
+        # i-th batch token. Sampling every row at once and keeping drafts only
+        # while they match the main model's own samples leaves the output
+        # distribution unchanged. The first sample that differs from the
+        # draft, or follows a fully accepted one, is decoded on the next step.
+        rows = []
+        operations = []
+        for operation, draft, first_row in drafted:
+            rows.extend(range(first_row, first_row + len(draft) + 1))
+            operations.extend([operation] * (len(draft) + 1))
+        sampled = self._sample(self.batch_logits[rows], operations)
+
+        row = 0
+        for operation, draft, first_row in drafted:
+            accepted = 0
+            for i in range(len(draft) + 1):
+                token = operation.report_sampled(sampled, row + i)
+                self._count_generated(operation)
+                if i < len(draft) and token == draft[i]:
+                    accepted += 1
+                    operation.tokens.append(token)
+                    operation.push_token(self.model, token)
+                    if operation.is_done:
+                        break
+                else:
+                    operation.pending_token = token
+                    break
+            row += len(draft) + 1
+            self.speculation.record(len(draft), accepted)
+
+            llama_cpp.llama_kv_cache_seq_rm(self.ctx, operation.seq_num, len(operation.tokens), -1)
+            self.speculator.rollback(operation, len(operation.tokens))
+            if operation.is_done:
+                operation.logits = self.batch_logits[first_row + accepted].copy()
+            else:
+                operation.logits = None
+            operation.logits_row = -1
+
+    def _sample(self, logits: np.ndarray, operations: List[LlamaOperation]):
+        start = time.perf_counter()
+        blocked = None
+        if any(operation.constraint is not None for operation in operations):
+            blocked = [
+                operation.constraint.blocked(operation.constraint_state) if operation.constraint is not None else None
+                for operation in operations
+            ]
+        sampled = self.sampler.sample(
+            logits,
+            np.array([operation.context.operation.get_temperature(self.temperature) for operation in operations]),
+            np.array([operation.context.operation.get_top_p() for operation in operations]),
+            blocked=blocked,
+        )
+        self.step_sample_seconds += time.perf_counter() - start
+        return sampled
+
+    def _count_generated(self, operation: LlamaOperation):
+        self.generated_tokens[operation.interpreter_key] = self.generated_tokens.get(operation.interpreter_key, 0) + 1
+        self.metrics.generated_tokens.inc()
+
+    def generated_token_count(self, interpreter: Interpreter) -> int:
+        # Tokens sampled so far for a running interpreter
+        return self.generated_tokens.get(id(interpreter), 0)
+
+    def _decode_batch(self):
+        # Operations and the tokens each adds to the batch, in batch order:
+        # the next token, followed by any forced or draft tokens
+        entries = []
+
+        # Sample the next token for every operation in a single pass
+        sampling = [
+            operation for operation in self.active_operations.values()
+            if operation.seq_num >= 0 and operation.logits is not None and operation.is_sampling()
+        ]
+        if len(sampling) > 0:
+            sampled = self._sample(self._logits_matrix(sampling), sampling)
+            for row, operation in enumerate(sampling):
+                next_token_id = operation.decode_next(self.model, sampled, row)
+                if next_token_id is None:
+                    continue
+                self._count_generated(operation)
+                entries.append((operation, [next_token_id]))
+
+        # Tokens sampled while verifying drafts on the previous step
+        for operation in self.active_operations.values():
+            if operation.seq_num >= 0 and operation.pending_token is not None:
+                next_token_id = operation.pending_token
+                operation.pending_token = None
+                operation.push_token(self.model, next_token_id)
+                entries.append((operation, [next_token_id]))
+
+        if len(entries) > 0:
+            self._add_forced(entries)
+        if self.speculator is not None and len(entries) > 0:
+            self._add_drafts(entries)
+
+        # Prompt chunks go after the sampled tokens, with whatever room is left
+        chunks = []
+        if self.prefill_chunk_tokens > 0:
+            chunks = self._prefill_chunks(sum(len(tokens) for _, tokens in entries))
+
+        if len(entries) > 0 or len(chunks) > 0:
+            # Operations left out of this batch, e.g. cancelled ones, keep a
+            # copy of the logits the decode is about to overwrite
+            batched = set(operation.context.id for operation, _ in entries)
+            for operation in self.batch_logits_operations:
+                if operation.logits_row >= 0 and operation.context.id not in batched:
+                    operation.logits = operation.logits.copy()
+                    operation.logits_row = -1
+
+            decode_start = time.perf_counter()
+            self._fill_batch(entries, chunks)
             ret = llama_cpp.llama_decode(self.ctx, self.batch)
+            while ret == 1:
+                # Out of KV cache space; swap out the lowest ranked operations
+                # until the rest of the batch fits, and retry without them
+                requester = max([operation for operation, _ in entries] + [operation for operation, _, _ in chunks], key=self.preemption.rank)
+                if not self._make_room(requester, {operation: tokens[0] for operation, tokens in entries}):
+                    if len(chunks) == 0:
+                        break
+                    # Nothing else could be freed, so the prompts wait,
+                    # swapped out, until there is room
+                    for operation, _, _ in chunks:
+                        self._preempt(operation)
+                for operation, _ in entries:
+                    if operation.seq_num < 0 and self.speculator is not None:
+                        self.speculator.rollback(operation, len(operation.tokens))
+                entries = [(operation, tokens) for operation, tokens in entries if operation.seq_num >= 0]
+                chunks = [(operation, start, end) for operation, start, end in chunks if operation.seq_num >= 0]
+                if len(entries) == 0 and len(chunks) == 0:
+                    return
+                self._fill_batch(entries, chunks)
+                ret = llama_cpp.llama_decode(self.ctx, self.batch)
             if ret != 0:
-                # TODO: Deschedule beams until this succeeds
                 raise Exception("LLAMA ERROR " + str(ret))
+            self.metrics.decode_seconds.observe(time.perf_counter() - decode_start)
+            self.metrics.decode_calls.inc()
+            self.metrics.record_batch(self.batch.n_tokens)
 
-            for operation in self.operations.values():
-                if operation.seq_num < 0:
+            self.batch_logits = get_logits(self.ctx, self.batch.n_tokens, self.vocab_size)
+            self.batch_logits_operations = []
+            drafted = []
+            token_idx = 0
+            for operation, tokens in entries:
+                operation.tokens.append(tokens[0])
+                if len(operation.forced_tokens) > 0:
+                    # Rows up to the last one predict the forced tokens
+                    n_forced = len(operation.forced_tokens)
+                    operation.report_forced(self.model, score_tokens(
+                        self.batch_logits[token_idx:token_idx + n_forced],
+                        operation.forced_tokens,
+                        operation.context.operation.get_top_p(),
+                    ))
+                    self.generated_tokens[operation.interpreter_key] = self.generated_tokens.get(operation.interpreter_key, 0) + n_forced
+                    self.metrics.forced_tokens.inc(n_forced)
+                    token_idx += n_forced
+                elif len(tokens) > 1:
+                    drafted.append((operation, tokens[1:], token_idx))
+                    token_idx += len(tokens)
                     continue
-                operation.logits = None
+                if operation.is_done:
+                    # Finished operations hand their logits on to whatever
+                    # runs next, which may be many decodes from now
+                    operation.logits = self.batch_logits[token_idx].copy()
+                    operation.logits_row = -1
+                else:
+                    operation.logits = self.batch_logits[token_idx]
+                    operation.logits_row = token_idx
+                    self.batch_logits_operations.append(operation)
+                token_idx += 1
 
-            for token_idx, operation in operation_result_indices.items():
-                operation.logits = llama_cpp.llama_get_logits_ith(self.ctx, token_idx)
+            for operation, start, end in chunks:
+                operation.prefill_chunk_decoded(start, end, self.batch_logits[token_idx:token_idx + end - start])
+                self.metrics.prefill_tokens.inc(end - start)
+                token_idx += end - start
+                if operation.prefilled and not operation.is_done:
+                    # Sampled from the batch on the next step like the rest
+                    operation.logits = self.batch_logits[token_idx - 1]
+                    operation.logits_row = token_idx - 1
+                    self.batch_logits_operations.append(operation)
+
+            if len(drafted) > 0:
+                self._verify_drafts(drafted)
 
     def run_loop(self, interpreter: Interpreter):
-        contexts = interpreter.loop()
+        self.step([interpreter])
+
+    def release_interpreter(self, interpreter: Interpreter):
+        # Drop every operation of a finished or abandoned interpreter, freeing
+        # the sequences they still hold
+        self.generated_tokens.pop(id(interpreter), None)
+        self.admission.release(id(interpreter))
+        # A session keeps the request's final operation, sequence and all
+        session = self.session_bindings.pop(id(interpreter), None)
+        kept = self._session_operation(interpreter) if session is not None else None
+        snapshot_request = self.snapshot_requests.pop(id(interpreter), None)
+        if snapshot_request is not None:
+            name, on_saved = snapshot_request
+            operations = [self.operations[context_id] for context_id in self.interpreter_operations.get(id(interpreter), [])]
+            on_saved(self._save_snapshot(name, operations))
+        for context_id in self.interpreter_operations.pop(id(interpreter), []):
+            operation = self.operations.pop(context_id)
+            self.active_operations.pop(context_id, None)
+            if operation is kept:
+                if operation.logits_row >= 0:
+                    operation.logits = operation.logits.copy()
+                    operation.logits_row = -1
+                    self.batch_logits_operations.remove(operation)
+                operation.parent = None
+                continue
+            if operation.seq_num >= 0:
+                self._deschedule(operation)
+            if operation.logits_row >= 0:
+                self.batch_logits_operations.remove(operation)
+            self.preemption.discard(operation)
+            operation.logits = None
+            operation.logits_row = -1
+            operation.parent = None
+        if session is not None:
+            self._end_session_request(session, kept)
+
+    def step(self, interpreters: List[Interpreter]):
+        start = time.perf_counter()
+        self.step_sample_seconds = 0.0
+
+        for session in self.sessions.drop_stale():
+            self._drop_session(session)
+
+        # New interpreters queue for admission, and only admitted ones run
+        for interpreter in interpreters:
+            self.open_session(interpreter)
+            if id(interpreter) not in self.admission:
+                self.admission.submit(id(interpreter), self._admission_tokens(interpreter), interpreter.priority, interpreter.client)
+        now = time.perf_counter()
+        for request in self.admission.admit():
+            self.metrics.admission_wait_seconds.observe(now - request.queued_time)
 
-        # Create any operations for operations that are not already created
-        for context in contexts:
-            if context.id not in self.operations:
-                self.operations[context.id] = LlamaOperation(
-                    context, self.operations.get(context.parent_id))
+        # Create any operations for operations that are not already created.
+        # Operations from every interpreter share the same batch.
+        for interpreter in interpreters:
+            if not self.admission.is_admitted(id(interpreter)):
+                continue
+            contexts = interpreter.loop()
+            if interpreter.is_done():
+                self.release_interpreter(interpreter)
+                continue
+            context_ids = self.interpreter_operations.setdefault(id(interpreter), [])
+            session = self.session_bindings.get(id(interpreter))
+            for context in contexts:
+                if context.id not in self.operations:
+                    parent = self.operations.get(context.parent_id)
+                    if context.parent_id is None and session is not None:
+                        # The first operations continue the conversation
+                        parent = session.operation
+                    operation = LlamaOperation(context, parent)
+                    self.operation_order += 1
+                    operation.order = self.operation_order
+                    operation.interpreter_key = id(interpreter)
+                    operation.priority = interpreter.priority
+                    operation.constraint = self._constraint(context.operation)
+                    if operation.constraint is not None:
+                        operation.constraint_state = operation.constraint.start
+                    self.operations[context.id] = operation
+                    self.active_operations[context.id] = operation
+                    context_ids.append(context.id)
+
+        # Operations whose contexts were cancelled, e.g. pruned beams, are
+        # finished early so that their sequences are freed below
+        for operation in self.active_operations.values():
+            if operation.context.cancelled and not operation.is_done:
+                logger.debug("Operation %s cancelled", operation.context.id)
+                operation.is_done = True
+                operation.pending_token = None
+
+        # Prefilling or restoring an operation will clobber the batch logits.
+        # Chunked prefills are decoded along with the batch instead.
+        if self.batch_logits is not None and any(
+                operation.seq_num < 0 or (not operation.prefilled and self.prefill_chunk_tokens == 0)
+                for operation in self.active_operations.values()
+                if not operation.is_done):
+            self._detach_batch_logits()
 
         # Schedule any runnable operations
+        schedule_start = time.perf_counter()
         self._schedule_runnable_operations()
 
         # Decode fixed tokens (e.g. prompts) for any runnable operations
-        self._decode_operation_tokens()
+        prefill_start = time.perf_counter()
+        if self.prefill_chunk_tokens == 0:
+            self._decode_operation_tokens()
+        self._decode_scoring()
 
         # Decode the next batch of tokens
-        self._decode_batch()
\ No newline at end of file
+        batch_start = time.perf_counter()
+        self._decode_batch()
+        end = time.perf_counter()
+
+        metrics = self.metrics
+        metrics.steps.inc()
+        metrics.step_seconds.observe(end - start)
+        metrics.schedule_seconds.observe(prefill_start - schedule_start)
+        metrics.prefill_seconds.observe(batch_start - prefill_start)
+        metrics.sample_seconds.observe(self.step_sample_seconds)
+        metrics.active_operations.set(len(self.active_operations))
+        metrics.running_sequences.set(sum(1 for operation in self.active_operations.values() if operation.seq_num >= 0))
+        metrics.kv_cells_used.set(llama_cpp.llama_get_kv_cache_used_cells(self.ctx))
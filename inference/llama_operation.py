@@ -1,11 +1,54 @@
-import ctypes
-from typing import Any, Optional, List, Dict
+import logging
+from typing import Any, Callable, Optional, List, Dict, Tuple
 
 import llama_cpp
+import numpy as np
 
+from .constraint import RegexConstraint
 from .interpreter import OperationContext
+from .sampler import SampledTokens
+from .scoring import TokenScores, score_tokens
+from .token_history import TokenHistory
+from .util import get_logits, get_logits_ith
+
+logger = logging.getLogger(__name__)
+
+# Prefill reports are (token, logits, logprob, rank, top_n), where top_n is
+# the number of alternatives the token was scored with. Reports without a rank
+# have no alternatives to trim.
+
+def replayable_length(reports: List[Any], top_n: int) -> int:
+    # Number of leading reports that were scored with at least top_n
+    # alternatives, and so can be replayed for an operation reporting top_n
+    for i, report in enumerate(reports):
+        if report[3] is not None and report[4] < top_n:
+            return i
+    return len(reports)
+
+def _trim_report(report: Any, top_n: int) -> Tuple[int, List[Any], Optional[float], Optional[int]]:
+    token, logits, logprob, rank, scored_top_n = report
+    if rank is None or top_n >= scored_top_n:
+        return token, logits, logprob, rank
+    # The alternatives are sorted, with the selected token appended if it
+    # ranks below them
+    trimmed = list(logits[:top_n])
+    if rank > top_n:
+        selected = next((pair for pair in logits if pair[0] == token), None)
+        if selected is not None:
+            trimmed.append(selected)
+    return token, trimmed, logprob, rank
 
 class LlamaOperation(object):
+    # Trees of operations can have many thousands of forks
+    __slots__ = (
+        "context", "parent", "tokens", "current_role", "reports", "seq_num",
+        "logits", "logits_row", "prefilled", "pending_token", "constraint",
+        "constraint_state", "forced_tokens", "ngram_index", "prefill_tokens",
+        "prefill_done", "prefill_next", "prefill_reports", "prefill_reported",
+        "priority", "order", "interpreter_key", "swapped_state",
+        "swapped_length", "scoring", "remaining_tokens", "is_done",
+    )
+
     def __init__(
             self,
             context: OperationContext,
@@ -14,62 +57,132 @@ class LlamaOperation(object):
         self.context = context
         self.parent = parent
         if parent is not None:
-            self.tokens = parent.tokens
+            self.tokens = parent.tokens.fork()
             self.current_role = parent.current_role
+            self.reports = parent.reports
         else:
-            self.tokens = []
+            self.tokens = TokenHistory()
             self.current_role = None
+            self.reports = []
+        # self.reports holds the reported scores for every token of the
+        # history while it has only ever been fed, never sampled, so that the
+        # prefix cache can replay them
         self.seq_num = -1
         self.logits = None
+        # Row of Llama.batch_logits that self.logits is a view of, or -1 if
+        # self.logits owns its data
+        self.logits_row = -1
+        self.prefilled = False
+        # Token already sampled and reported, to be decoded on the next step
+        # instead of sampling a new one
+        self.pending_token = None
+        # For constrained completions, the constraint and its automaton state
+        # after the tokens sampled so far, and the tokens it forces after the
+        # one being decoded, which go into the same batch
+        self.constraint: Optional[RegexConstraint] = None
+        self.constraint_state = 0
+        self.forced_tokens: List[int] = []
+        # speculative.NgramIndex over self.tokens, built on first use
+        self.ngram_index = None
+        self.prefill_tokens = None
+        self.prefill_done = 0
+        # In chunked prefill mode, the index of the next prefill token to
+        # decode, or None before the prefill has started
+        self.prefill_next = None
+        self.prefill_reports = None
+        self.prefill_reported = 0
+        # Preemption order: lower priority first, then the most recently
+        # created (highest order)
+        self.priority = 0
+        self.order = 0
+        # id() of the interpreter the operation belongs to
+        self.interpreter_key = 0
+        # KV cache state saved to host memory while preempted, and the number
+        # of tokens it covers
+        self.swapped_state = None
+        self.swapped_length = 0
+        # For score operations, the candidates.CandidateScoring once
+        # scheduled. They are decoded by Llama._decode_scoring rather than
+        # prefilled.
+        self.scoring = None
+        if context.operation.name == "score":
+            self.prefilled = True
         if context.operation.name == "completion":
             self.remaining_tokens = context.operation.completion.max_tokens
         else:
             self.remaining_tokens = 0
         self.is_done = False
 
+    def is_sampling(self) -> bool:
+        return self.prefilled and not self.is_done and self.pending_token is None and self.context.operation.name == "completion"
+
     def decode_next(
             self,
-            ctx: llama_cpp.llama_context_p,
             model: llama_cpp.llama_model_p,
-            vocab_size: int,
-            temperature: float,
-            candidates_p: llama_cpp.llama_token_data_array,
-        ) -> Optional[llama_cpp.llama_token]:
-        if self.is_done:
+            sampled: SampledTokens,
+            row: int,
+        ) -> Optional[int]:
+        if not self.is_sampling():
             return None
 
-        if self.context.operation.name == "completion":
-            # Do normal top-p sampling
-            for token_id in range(vocab_size):
-                candidates_p.contents.data[token_id].id = llama_cpp.llama_token(token_id)
-                candidates_p.contents.data[token_id].logit = llama_cpp.ctypes.c_float(self.logits[token_id])
-            candidates_p.contents.size = vocab_size
-            candidates_p.contents.sorted = False
-            llama_cpp.llama_sample_temp(ctx, candidates_p, temperature)
-            llama_cpp.llama_sample_top_p(ctx, candidates_p, 0.9, self.context.operation.get_top_p())
-            selected_token = llama_cpp.llama_sample_token(ctx, candidates_p)
-            self.context.report_token(selected_token, [
-                (tkn.id, tkn.logit)
-                for tkn in candidates_p.contents.data[:self.context.operation.get_top_p()]
-            ])
+        selected_token = self.report_sampled(sampled, row)
+        self.push_token(model, selected_token)
+        return selected_token
 
-            self.remaining_tokens -= 1
+    def report_sampled(self, sampled: SampledTokens, row: int) -> int:
+        selected_token = sampled.token(row)
+        # Sampled tokens are not replayable by the prefix cache
+        self.reports = None
+        self.context.report_token(selected_token, sampled.report(row), sampled.logprob(row), sampled.rank(row))
+        self.remaining_tokens -= 1
+        if self.constraint is not None:
+            self.constraint_state = self.constraint.advance(self.constraint_state, selected_token)
+        return selected_token
 
-            if llama_cpp.llama_token_is_eog(model, selected_token):
-                print(f"Operation {self.context.id} completed on EOG token")
-                self.is_done = True
-                self.context.completed = True
+    def report_forced(self, model: llama_cpp.llama_model_p, scores: Optional[TokenScores]):
+        # Called once the forced tokens went into the KV cache. They are scored
+        # with the logits of the batch rows before them when available.
+        for i, token in enumerate(self.forced_tokens):
+            if scores is not None:
+                self.context.report_token(token, scores.report(i), float(scores.logprobs[i]), int(scores.ranks[i]))
+            else:
+                self.context.report_token(token, [(token, 0.0)])
+            self.remaining_tokens -= 1
+        self.tokens.extend(self.forced_tokens)
+        self.push_token(model, self.forced_tokens[-1])
+        self.forced_tokens = []
 
-            elif self.remaining_tokens < 1:
-                print(f"Operation {self.context.id} completed on max tokens")
-                self.is_done = True
-                self.context.completed = True
+    def push_token(self, model: llama_cpp.llama_model_p, token: int):
+        # Called once a reported token goes into the KV cache
+        if llama_cpp.llama_token_is_eog(model, token):
+            logger.debug("Operation %s completed on EOG token", self.context.id)
+            self.is_done = True
+            self.context.complete()
 
-            return selected_token
+        elif self.remaining_tokens < 1:
+            logger.debug("Operation %s completed on max tokens", self.context.id)
+            self.is_done = True
+            self.context.complete()
 
-        else:
-            return None
+    def _report(self, report: Any, top_n: int):
+        # Prefill reports are kept so the prefix cache can replay them, and
+        # reported with top_n alternatives. A prefill that is retried after
+        # running out of KV cache space only reports what it has not reported
+        # already.
+        self.prefill_reports.append(report)
+        if len(self.prefill_reports) > self.prefill_reported:
+            self.prefill_reported = len(self.prefill_reports)
+            self.context.report_token(*_trim_report(report, top_n))
 
+    def _report_scores(self, scores: TokenScores, top_n: int):
+        for row in range(len(scores)):
+            self._report((
+                int(scores.tokens[row]),
+                scores.report(row),
+                float(scores.logprobs[row]),
+                int(scores.ranks[row]),
+                top_n,
+            ), top_n)
 
     def get_tokens_for_role_switch(self, tokens_for_role: Dict[str, List[int]], role: str) -> List[int]:
         if role == self.current_role:
@@ -83,56 +196,153 @@ class LlamaOperation(object):
             ctx: llama_cpp.llama_context_p,
             batch: llama_cpp.llama_batch,
             batch_size: int,
+            vocab_size: int,
             new_seq_num: int,
+            first: int = 0,
+            make_room: Optional[Callable[["LlamaOperation"], bool]] = None,
         ):
-        for start in range(0, len(self.tokens), batch_size):
+        # The history is copied into the batch a chunk at a time, straight
+        # from its buffers
+        batch_tokens = np.ctypeslib.as_array(batch.token, shape=(batch_size,))
+        batch_pos = np.ctypeslib.as_array(batch.pos, shape=(batch_size,))
+        batch_n_seq_id = np.ctypeslib.as_array(batch.n_seq_id, shape=(batch_size,))
+        batch_logits = np.ctypeslib.as_array(batch.logits, shape=(batch_size,))
+        for i in range(min(batch_size, len(self.tokens) - first)):
+            batch.seq_id[i][0] = new_seq_num
+        for start in range(first, len(self.tokens), batch_size):
             end = min(start + batch_size, len(self.tokens))
-            for i in range(start, end):
-                batch.token[i-start] = self.tokens[i]
-                batch.pos[i-start] = i
-                batch.n_seq_id[i-start] = 1
-                batch.seq_id[i-start][0] = new_seq_num
-                batch.logits[i-start] = (i == end - 1)
-            batch.n_tokens = end - start
+            n = end - start
+            self.tokens.copy_to(batch_tokens, start, end)
+            batch_pos[:n] = np.arange(start, end)
+            batch_n_seq_id[:n] = 1
+            batch_logits[:n] = 0
+            batch_logits[n - 1] = 1
+            batch.n_tokens = n
 
             ret = llama_cpp.llama_decode(ctx, batch)
+            while ret == 1 and make_room is not None and make_room(self):
+                ret = llama_cpp.llama_decode(ctx, batch)
             if ret != 0:
-                print(f"Llama error {ret} with batch size {end - start} after tokenizing {start} tokens")
+                logger.warning("Llama error %d with batch size %d after tokenizing %d tokens", ret, end - start, start)
                 return False
 
-        self.logits = llama_cpp.llama_get_logits_ith(ctx, end - start - 1)
+        self.logits = get_logits_ith(ctx, end - start - 1, vocab_size).copy()
+        self.logits_row = -1
 
         return True
 
+    def get_prefill_tokens(self, tokens_for_role: Dict[str, List[int]]) -> List[int]:
+        if self.prefill_tokens is None:
+            tokens = []
+            desired_role = self.context.operation.get_role()
+            if desired_role != self.current_role:
+                tokens = self.get_tokens_for_role_switch(tokens_for_role, desired_role)
+                logger.debug("Switching role to %s with tokens %s", desired_role, tokens)
+            if self.context.operation.name == "feed_tokens":
+                tokens = tokens + self.context.operation.feed_tokens.tokens
+                logger.debug("Feeding %d tokens", len(self.context.operation.feed_tokens.tokens))
+            elif self.context.operation.name == "score":
+                tokens = tokens + self.context.operation.score.tokens
+            self.prefill_tokens = tokens
+        return self.prefill_tokens
+
+    def reuse_prefix(self, reports: List[Any], length: int):
+        # The KV cache for the first `length` prefill tokens was copied from
+        # the prefix cache, except the last one, which still has to be decoded
+        # to get logits for the rest. The reports must be replayable with the
+        # operation's top_n.
+        top_n = self.prefill_top_n()
+        self.prefill_reports = []
+        for report in reports:
+            self._report(report, top_n)
+        self.prefill_done = length
+
+    def prefill_top_n(self) -> int:
+        if self.context.operation.name == "feed_tokens" and self.context.operation.feed_tokens.selected_only:
+            return 0
+        return self.context.operation.get_top_p()
+
+    def begin_prefill(self, tokens: List[int]) -> int:
+        # Reports the first prefill token, scored by the logits the operation
+        # starts from if it has any, and returns the index of the first token
+        # to decode
+        if self.prefill_done > 0:
+            return self.prefill_done - 1
+        self.prefill_reports = []
+        top_n = self.prefill_top_n()
+        if self.logits is not None:
+            self._report_scores(score_tokens(self.logits[None, :], tokens[:1], top_n), top_n)
+        else:
+            self._report((tokens[0], [(tokens[0], 0.0)], None, None, 0), top_n)
+        return 0
+
+    def reset_prefill(self):
+        # A partial prefill whose KV cache was dropped starts over; tokens
+        # already reported are not reported again
+        self.prefill_done = 0
+        self.prefill_next = None
+
+    def score_prefill_chunk(self, tokens: List[int], start: int, end: int, chunk_logits: np.ndarray):
+        # Row i of the chunk's logits predicts tokens[start + i + 1]. The
+        # last row of the final chunk predicts whatever comes next.
+        n_scored = min(end, len(tokens) - 1) - start
+        if n_scored > 0:
+            top_n = self.prefill_top_n()
+            self._report_scores(score_tokens(chunk_logits[:n_scored], tokens[start + 1:start + 1 + n_scored], top_n), top_n)
+
+    def finish_prefill(self, tokens: List[int], logits: np.ndarray):
+        self.tokens.extend(tokens)
+        if self.reports is not None:
+            self.reports = self.reports + self.prefill_reports
+        self.prefill_reports = None
+        self.prefill_done = len(tokens)
+        self.prefill_next = None
+        # Later decodes overwrite the logits buffer, so keep our own copy
+        self.logits = logits.copy()
+        self.logits_row = -1
+        self.current_role = self.context.operation.get_role()
+        self.prefilled = True
+
+        if self.context.operation.name == "feed_tokens":
+            self.context.complete()
+            self.is_done = True
+
+    def next_prefill_chunk(self, tokens_for_role: Dict[str, List[int]], max_tokens: int) -> Tuple[int, int]:
+        # The range of prefill tokens to put into the next batch
+        tokens = self.get_prefill_tokens(tokens_for_role)
+        if self.prefill_next is None:
+            self.prefill_next = self.begin_prefill(tokens)
+        return self.prefill_next, min(self.prefill_next + max_tokens, len(tokens))
+
+    def prefill_chunk_decoded(self, start: int, end: int, chunk_logits: np.ndarray):
+        tokens = self.prefill_tokens
+        self.score_prefill_chunk(tokens, start, end, chunk_logits)
+        self.prefill_next = end
+        if end == len(tokens):
+            self.finish_prefill(tokens, chunk_logits[end - start - 1])
+
     def decode_tokens(
             self,
             ctx: llama_cpp.llama_context_p,
             model: llama_cpp.llama_model_p,
             vocab_size: int,
-            candidates_p: llama_cpp.llama_token_data_array,
             batch: llama_cpp.llama_batch,
             batch_size: int,
             tokens_for_role: Dict[str, List[int]],
-        ) -> ctypes.Array[ctypes.c_float]:
+            make_room: Optional[Callable[["LlamaOperation"], bool]] = None,
+        ) -> bool:
         if self.is_done:
             return False
-        
-        tokens = []
-        desired_role = self.context.operation.get_role()
-        if desired_role != self.current_role:
-            tokens = self.get_tokens_for_role_switch(tokens_for_role, desired_role)
-            print(f"Switching role to {desired_role} with tokens {tokens}")
-        if self.context.operation.name == "feed_tokens":
-            tokens = tokens + self.context.operation.feed_tokens.tokens
-            print(f"Feeding {len(self.context.operation.feed_tokens.tokens)} tokens")
+
+        tokens = self.get_prefill_tokens(tokens_for_role)
         if len(tokens) == 0:
+            self.prefilled = True
             return True
 
-        self.context.report_token(tokens[0], [(tokens[0], 0.0)])
-
+        first = self.begin_prefill(tokens)
         pos = len(self.tokens)
 
-        for start in range(0, len(tokens), batch_size):
+        for start in range(first, len(tokens), batch_size):
             end = min(start + batch_size, len(tokens))
             for i in range(start, end):
                 batch.token[i-start] = tokens[i]
@@ -143,38 +353,18 @@ class LlamaOperation(object):
             batch.n_tokens = end - start
 
             ret = llama_cpp.llama_decode(ctx, batch)
+            # Out of KV cache space; retry once other sequences have been
+            # preempted
+            while ret == 1 and make_room is not None and make_room(self):
+                ret = llama_cpp.llama_decode(ctx, batch)
             if ret != 0:
                 #raise Exception(f"Llama error {ret} with batch size {end - start} after tokenizing {start} tokens")
-                print(f"Llama error {ret} with batch size {end - start} after tokenizing {start} tokens")
+                logger.warning("Llama error %d with batch size %d after tokenizing %d tokens", ret, end - start, start)
+                self.prefill_done = 0
                 return False
 
-            for idx in range(end - start - 1):
-                logits = llama_cpp.llama_get_logits_ith(ctx, idx)
-                selected = None
-                # Get top p logits and store their indices
-                for token_id in range(vocab_size):
-                    candidates_p.contents.data[token_id].id = llama_cpp.llama_token(token_id)
-                    candidates_p.contents.data[token_id].logit = llama_cpp.ctypes.c_float(logits[token_id])
-                    if token_id == tokens[idx + 1 + start]:
-                        selected = (token_id, logits[token_id])
-                candidates_p.contents.size = vocab_size
-                candidates_p.contents.sorted = False
-                llama_cpp.llama_sample_top_p(ctx, candidates_p, 0.9, self.context.operation.get_top_p())
-                logits = [
-                    (tkn.id, tkn.logit)
-                    # TODO: Should this just be the length of the candidates_p array?
-                    for tkn in candidates_p.contents.data[:self.context.operation.get_top_p()]
-                ]
-                if selected not in logits:
-                    logits.append(selected)
-                self.context.report_token(tokens[idx + 1 + start], logits)
-                self.tokens.append(tokens[idx + 1 + start])
-
-        self.logits = llama_cpp.llama_get_logits_ith(ctx, end - start - 1)
-        self.current_role = desired_role
+            chunk_logits = get_logits(ctx, end - start, vocab_size)
+            self.score_prefill_chunk(tokens, start, end, chunk_logits)
 
-        if self.context.operation.name == "feed_tokens":
-            self.context.completed = True
-            self.is_done = True
-
-        return True
\ No newline at end of file
+        self.finish_prefill(tokens, chunk_logits[end - start - 1])
+        return True
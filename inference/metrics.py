@@ -0,0 +1,169 @@
+import bisect
+import math
+from typing import Callable, List, Optional, Tuple
+
+# Minimal metrics in the Prometheus text exposition format. Metrics are only
+# updated from the inference thread; rendering from another thread may see a
+# histogram mid-update, which scrapers tolerate.
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+def _label_set(labels: str, extra: str = "") -> str:
+    # labels and extra are already formatted, e.g. 'worker="0"'
+    inner = ",".join(part for part in (labels, extra) if part)
+    return "{" + inner + "}" if inner else ""
+
+# A metric's samples ready to render: name, help, type and sample lines
+CollectedMetric = Tuple[str, str, str, List[str]]
+
+class Counter(object):
+    # Either incremented, or read from function at render time for counts
+    # kept elsewhere
+    type = "counter"
+
+    def __init__(self, name: str, help: str, function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+        self.function = function
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def samples(self, labels: str = "") -> List[str]:
+        value = self.function() if self.function is not None else self.value
+        return [f"{self.name}{_label_set(labels)} {_format_value(value)}"]
+
+class Gauge(Counter):
+    # Either set explicitly, or read from function at render time
+    type = "gauge"
+
+    def set(self, value: float):
+        self.value = value
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: List[float]):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, labels: str = "") -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [math.inf], self.counts):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{_label_set(labels, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_label_set(labels)} {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count{_label_set(labels)} {self.count}")
+        return lines
+
+def render_collected(collections: List[List[CollectedMetric]]) -> str:
+    # Merges the metrics collected from several registries, e.g. one per
+    # worker process, so that each metric is described once
+    merged = {}
+    for collected in collections:
+        for name, help, type, samples in collected:
+            if name not in merged:
+                merged[name] = (help, type, [])
+            merged[name][2].extend(samples)
+    lines = []
+    for name, (help, type, samples) in merged.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        lines.extend(samples)
+    lines.append("")
+    return "\n".join(lines)
+
+# Seconds, from well under a millisecond for a cheap step up to long prefills
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+TOKEN_RATE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+class MetricsRegistry(object):
+    def __init__(self, prefix: str = "llama_"):
+        self.prefix = prefix
+        self.metrics = []
+
+    def counter(self, name: str, help: str, function: Optional[Callable[[], float]] = None) -> Counter:
+        return self._add(Counter(self.prefix + name, help, function))
+
+    def gauge(self, name: str, help: str, function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._add(Gauge(self.prefix + name, help, function))
+
+    def histogram(self, name: str, help: str, buckets: List[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, help, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, labels: str = "") -> List[CollectedMetric]:
+        return [(metric.name, metric.help, metric.type, metric.samples(labels)) for metric in self.metrics]
+
+    def render(self) -> str:
+        return render_collected([self.collect()])
+
+class InferenceMetrics(object):
+    # Everything Llama and InferenceWorker measure. Gauges that mirror other
+    # components' stats are registered by their owners.
+    def __init__(self, batch_size: int):
+        self.registry = MetricsRegistry()
+        r = self.registry
+
+        self.step_seconds = r.histogram("step_seconds", "Duration of Llama.step")
+        self.schedule_seconds = r.histogram("schedule_seconds", "Time spent assigning and restoring sequences per step")
+        self.prefill_seconds = r.histogram("prefill_seconds", "Time spent decoding fixed tokens per step")
+        self.sample_seconds = r.histogram("sample_seconds", "Time spent sampling per step")
+        self.decode_seconds = r.histogram("decode_seconds", "Duration of batched llama_decode calls for sampled tokens")
+        self.steps = r.counter("steps_total", "Inference steps run")
+        self.decode_calls = r.counter("decode_calls_total", "Batched llama_decode calls for sampled tokens")
+        self.prefill_tokens = r.counter("prefill_tokens_total", "Fixed tokens decoded, e.g. prompts")
+        self.generated_tokens = r.counter("generated_tokens_total", "Tokens sampled")
+        self.scored_tokens = r.counter("scored_tokens_total", "Candidate tokens scored by score operations")
+        self.forced_tokens = r.counter("forced_tokens_total", "Tokens decoded without sampling because a constraint allowed nothing else")
+        self.batch_tokens = r.histogram(
+            "batch_tokens",
+            "Tokens per batched llama_decode call",
+            [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048],
+        )
+        self.batch_occupancy = r.gauge("batch_occupancy_ratio", "Fraction of the batch used by the last decode")
+        self.batch_size = batch_size
+        self.active_operations = r.gauge("active_operations", "Operations waiting to be scheduled or decoding")
+        self.running_sequences = r.gauge("running_sequences", "Sequences assigned to running operations")
+        self.kv_cells_used = r.gauge("kv_cells_used", "KV cache cells in use")
+        self.kv_cells_total = r.gauge("kv_cells_total", "KV cache size in cells")
+
+        self.requests = r.counter("requests_total", "Inference requests finished")
+        self.request_errors = r.counter("request_errors_total", "Inference requests finished with an error")
+        self.stopped_requests = r.counter("stopped_requests_total", "Inference requests cancelled or cut short by their deadline or token budget")
+        self.running_requests = r.gauge("running_requests", "Inference requests in flight")
+        self.admission_wait_seconds = r.histogram("admission_wait_seconds", "Time requests spent queued for admission")
+        self.time_to_first_token = r.histogram("time_to_first_token_seconds", "Time from submission to a request's first sampled token")
+        self.inter_token_latency = r.histogram("inter_token_latency_seconds", "Time between consecutive sampled tokens of a request")
+        self.request_seconds = r.histogram("request_seconds", "Time from submission to completion of a request")
+        self.request_tokens_per_second = r.histogram(
+            "request_tokens_per_second",
+            "Sampled tokens per second of a request, from its first token to completion",
+            TOKEN_RATE_BUCKETS,
+        )
+
+    def record_batch(self, n_tokens: int):
+        self.batch_tokens.observe(n_tokens)
+        self.batch_occupancy.set(n_tokens / self.batch_size)
+
+    def render(self) -> str:
+        return self.registry.render()
@@ -1,4 +1,5 @@
 import pydantic
+from typing import Optional
 
 # Example config:
 #    "name": "Phi3-mini-1.0",
@@ -7,6 +8,16 @@ import pydantic
 #    "temperature": 1.0,
 #    "batch_size": 512,
 #    "batch_max_tokens": 2048,
+#    "max_sequences": 64,
+#    "prefix_cache_tokens": 2048,
+#    "prefix_cache_entries": 8,
+#    "tokenize_cache_entries": 4096,
+#    "draft_model_filename": "./models/draft.gguf",
+#    "speculative_tokens": 4,
+#    "prompt_lookup_ngram": 3,
+#    "n_threads": 8,
+#    "snapshot_dir": "./snapshots",
+#    "prefill_chunk_tokens": 64,
 
 class ModelConfig(pydantic.BaseModel):
     name: str
@@ -14,5 +25,37 @@ class ModelConfig(pydantic.BaseModel):
     context_size: int
     temperature: float
     batch_size: int
+    # Tokens decoded per step, at most batch_size
     batch_max_tokens: int
-    
\ No newline at end of file
+    # Number of llama.cpp sequences, shared by running operations and the
+    # prefix cache
+    max_sequences: int = 64
+    # Budget for the KV cache of finished prompts kept around for reuse
+    prefix_cache_tokens: int = 2048
+    prefix_cache_entries: int = 8
+    # Number of tokenized texts to memoize
+    tokenize_cache_entries: int = 4096
+    # Smaller model with the same vocabulary that drafts speculative_tokens
+    # tokens per step for the main model to verify
+    draft_model_filename: Optional[str] = None
+    speculative_tokens: int = 4
+    # Without a draft model, draft by matching the last prompt_lookup_ngram
+    # tokens against the sequence's own history (0 disables)
+    prompt_lookup_ngram: int = 0
+    # CPU threads for llama.cpp (None keeps its default)
+    n_threads: Optional[int] = None
+    # Directory for prompt snapshots saved with /snapshots, and whether to
+    # load them all at startup rather than on first use
+    snapshot_dir: Optional[str] = None
+    preload_snapshots: bool = True
+    # Decode prompts this many tokens at a time, in the same batch as the
+    # sampled tokens of running operations, instead of whole before each
+    # step (0)
+    prefill_chunk_tokens: int = 0
+    # KV cache tokens that admitted requests may reserve between them, by
+    # their prompts and max_tokens (None for context_size); the rest queue
+    admission_kv_tokens: Optional[int] = None
+    # Conversations kept between requests with a session_id, and how long an
+    # unused one is kept
+    max_sessions: int = 16
+    session_idle_seconds: float = 600.0
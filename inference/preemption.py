@@ -0,0 +1,70 @@
+import ctypes
+from typing import Iterable, Optional
+
+import llama_cpp
+
+from .llama_operation import LlamaOperation
+
+class PreemptionManager(object):
+    # Frees KV cache space when llama_decode runs out by swapping whole
+    # sequences out to host memory with the per-sequence state API, so they
+    # can be put back later without decoding their history again.
+    def __init__(self, ctx: llama_cpp.llama_context_p):
+        self.ctx = ctx
+        self.swapped_out = 0
+        self.swapped_in = 0
+        self.failed_swap_ins = 0
+        self.swapped_bytes = 0
+        self.resident_bytes = 0
+
+    def select_victim(self, operations: Iterable[LlamaOperation], requester: Optional[LlamaOperation]) -> Optional[LlamaOperation]:
+        # Preempt the lowest priority operation, and among those the most
+        # recently created, but never one that outranks the requester
+        victim = None
+        for operation in operations:
+            # Score operations hold several sequences; they wait for room
+            # instead
+            if operation.seq_num < 0 or operation is requester or operation.scoring is not None:
+                continue
+            if requester is not None and self.rank(operation) > self.rank(requester):
+                continue
+            if victim is None or self.rank(operation) < self.rank(victim):
+                victim = operation
+        return victim
+
+    def swap_out(self, operation: LlamaOperation) -> bool:
+        size = llama_cpp.llama_state_seq_get_size(self.ctx, operation.seq_num)
+        state = (ctypes.c_uint8 * size)()
+        if llama_cpp.llama_state_seq_get_data(self.ctx, state, size, operation.seq_num) != size:
+            return False
+        operation.swapped_state = state
+        operation.swapped_length = len(operation.tokens)
+        self.swapped_out += 1
+        self.swapped_bytes += size
+        self.resident_bytes += size
+        return True
+
+    def swap_in(self, operation: LlamaOperation, seq_num: int) -> bool:
+        state = operation.swapped_state
+        if llama_cpp.llama_state_seq_set_data(self.ctx, state, len(state), seq_num) == 0:
+            self.failed_swap_ins += 1
+            return False
+        self.swapped_in += 1
+        return True
+
+    def discard(self, operation: LlamaOperation):
+        if operation.swapped_state is not None:
+            self.resident_bytes -= len(operation.swapped_state)
+            operation.swapped_state = None
+
+    def stats(self):
+        return {
+            "swapped_out": self.swapped_out,
+            "swapped_in": self.swapped_in,
+            "failed_swap_ins": self.failed_swap_ins,
+            "swapped_bytes": self.swapped_bytes,
+            "resident_bytes": self.resident_bytes,
+        }
+
+    def rank(self, operation: LlamaOperation):
+        return (operation.priority, -operation.order)
@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+class PrefixCacheEntry(object):
+    def __init__(self, seq_num: int, tokens: List[int], reports: List[Any], node: "_RadixNode", pinned: bool = False):
+        # The KV cache for tokens is held in llama.cpp under seq_num, which is
+        # owned by the cache until the entry is evicted
+        self.seq_num = seq_num
+        self.tokens = tokens
+        self.reports = reports
+        self.node = node
+        # Pinned entries, e.g. loaded from snapshots, are outside the token
+        # and entry budgets and only evicted once nothing else is left
+        self.pinned = pinned
+        self.last_used = 0
+
+class _RadixNode(object):
+    def __init__(self, tokens: List[int], parent: Optional["_RadixNode"]):
+        self.tokens = tokens
+        self.parent = parent
+        self.children: Dict[int, _RadixNode] = {}
+        self.entry: Optional[PrefixCacheEntry] = None
+
+def _common_length(a: List[int], a_start: int, b: List[int]) -> int:
+    n = min(len(a) - a_start, len(b))
+    i = 0
+    while i < n and a[a_start + i] == b[i]:
+        i += 1
+    return i
+
+class PrefixCache(object):
+    # Radix tree over the token histories of finished sequences whose KV cache
+    # is kept resident, so that new operations can copy the longest matching
+    # prefix instead of decoding it again.
+    def __init__(self, max_tokens: int, max_entries: int):
+        self.max_tokens = max_tokens
+        self.max_entries = max_entries
+        self.root = _RadixNode([], None)
+        self.entries: "OrderedDict[int, PrefixCacheEntry]" = OrderedDict()
+        self.total_tokens = 0
+        self.pinned_entries = 0
+        self.clock = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_tokens = 0
+        self.hit_tokens = 0
+        self.inserts = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, tokens: List[int]) -> Tuple[Optional[PrefixCacheEntry], int]:
+        # Returns the entry sharing the longest prefix with tokens, and the
+        # length of that prefix
+        node = self.root
+        length = 0
+        while length < len(tokens):
+            child = node.children.get(tokens[length])
+            if child is None:
+                break
+            common = _common_length(tokens, length, child.tokens)
+            length += common
+            node = child
+            if common < len(child.tokens):
+                break
+        if length == 0:
+            return None, 0
+        # Any entry below node shares the matched prefix; prefer the most
+        # recently used one
+        best = None
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if current.entry is not None:
+                if best is None or current.entry.last_used > best.last_used:
+                    best = current.entry
+            stack.extend(current.children.values())
+        return best, length
+
+    def record_lookup(self, n_tokens: int, n_reused: int):
+        self.lookups += 1
+        self.lookup_tokens += n_tokens
+        if n_reused > 0:
+            self.hits += 1
+            self.hit_tokens += n_reused
+
+    def touch(self, entry: PrefixCacheEntry):
+        self.clock += 1
+        entry.last_used = self.clock
+        self.entries.move_to_end(entry.seq_num)
+
+    def insert(self, seq_num: int, tokens: List[int], reports: List[Any], pinned: bool = False) -> Tuple[bool, List[PrefixCacheEntry]]:
+        # Returns whether the cache took ownership of seq_num, and the entries
+        # evicted to make room, whose sequences the caller must free
+        if len(tokens) == 0 or (not pinned and (len(tokens) > self.max_tokens or self.max_entries < 1)):
+            return False, []
+
+        node = self.root
+        length = 0
+        while length < len(tokens):
+            child = node.children.get(tokens[length])
+            if child is None:
+                new_node = _RadixNode(tokens[length:], node)
+                node.children[tokens[length]] = new_node
+                node = new_node
+                length = len(tokens)
+                break
+            common = _common_length(tokens, length, child.tokens)
+            if common < len(child.tokens):
+                # Split the edge at the point where the sequences diverge
+                split = _RadixNode(child.tokens[:common], node)
+                node.children[tokens[length]] = split
+                child.tokens = child.tokens[common:]
+                child.parent = split
+                split.children[child.tokens[0]] = child
+                child = split
+            node = child
+            length += common
+
+        if node.entry is not None or len(node.children) > 0:
+            # An existing entry already covers this whole sequence
+            return False, []
+
+        entry = PrefixCacheEntry(seq_num, tokens, reports, node, pinned)
+        node.entry = entry
+        self.entries[seq_num] = entry
+        self.touch(entry)
+        if pinned:
+            self.pinned_entries += 1
+        else:
+            self.total_tokens += len(tokens)
+        self.inserts += 1
+
+        # Entries that are a prefix of the new one are now redundant, unless
+        # they are pinned
+        evicted = []
+        ancestor = node.parent
+        while ancestor is not None:
+            if ancestor.entry is not None and not ancestor.entry.pinned:
+                evicted.append(ancestor.entry)
+            ancestor = ancestor.parent
+        for old_entry in evicted:
+            self._remove(old_entry)
+
+        while len(self.entries) - self.pinned_entries > self.max_entries or self.total_tokens > self.max_tokens:
+            evicted.append(self._remove(self._lru(pinned=False)))
+        return True, evicted
+
+    def _lru(self, pinned: bool) -> Optional[PrefixCacheEntry]:
+        for entry in self.entries.values():
+            if entry.pinned == pinned:
+                return entry
+        return None
+
+    def evict_lru(self) -> Optional[PrefixCacheEntry]:
+        entry = self._lru(pinned=False) or self._lru(pinned=True)
+        if entry is None:
+            return None
+        return self._remove(entry)
+
+    def evict_all(self) -> List[PrefixCacheEntry]:
+        evicted = list(self.entries.values())
+        for entry in evicted:
+            self._remove(entry)
+        return evicted
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "pinned_entries": self.pinned_entries,
+            "tokens": self.total_tokens,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups > 0 else 0.0,
+            "lookup_tokens": self.lookup_tokens,
+            "hit_tokens": self.hit_tokens,
+            "token_hit_rate": self.hit_tokens / self.lookup_tokens if self.lookup_tokens > 0 else 0.0,
+            "inserts": self.inserts,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, entry: PrefixCacheEntry) -> PrefixCacheEntry:
+        del self.entries[entry.seq_num]
+        if entry.pinned:
+            self.pinned_entries -= 1
+        else:
+            self.total_tokens -= len(entry.tokens)
+        self.evictions += 1
+        node = entry.node
+        node.entry = None
+        # Prune nodes that no longer lead to any entry
+        while node.parent is not None and node.entry is None and len(node.children) == 0:
+            del node.parent.children[node.tokens[0]]
+            node = node.parent
+        return entry
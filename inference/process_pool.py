@@ -0,0 +1,381 @@
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .interpreter import Interpreter, Operation
+from .metrics import MetricsRegistry, render_collected
+from .model_config import ModelConfig
+from .sessions import SessionBusy, SessionNotFound
+from .util import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Errors the front end recreates from a worker's reply, most specific first,
+# so that client errors can be told apart from failures
+_remote_errors = [SessionNotFound, SessionBusy, ValueError]
+
+def _encode_error(error: Exception) -> Tuple[str, str]:
+    for error_type in _remote_errors:
+        if isinstance(error, error_type):
+            return error_type.__name__, str(error)
+    return "Exception", str(error)
+
+def _decode_error(payload: Tuple[str, str]) -> Exception:
+    for error_type in _remote_errors:
+        if error_type.__name__ == payload[0]:
+            return error_type(payload[1])
+    return Exception(payload[1])
+
+def prefix_blocks(operations: List[Operation], block_size: int) -> List[int]:
+    # Chained hashes of the fixed prefix of a request: its leading feed_tokens
+    # operations, in blocks of block_size tokens. Two requests share the first
+    # n hashes only if they share that much of their prompt, roles included.
+    hashes = []
+    h = 0
+    for operation in operations:
+        if operation.name != "feed_tokens":
+            break
+        h = hash((h, operation.feed_tokens.role))
+        tokens = operation.feed_tokens.tokens
+        for start in range(0, len(tokens), block_size):
+            h = hash((h, tuple(tokens[start:start + block_size])))
+            hashes.append(h)
+    return hashes
+
+class PrefixRouter(object):
+    # Sends a request to the worker that most recently saw the longest prefix
+    # of its prompt, since that worker's prefix cache probably still holds the
+    # KV cache for it. Requests without a match, or whose best match is
+    # already max_imbalance requests busier than the least loaded worker, go
+    # to the least loaded one.
+    def __init__(self, n_workers: int, block_size: int = 64, max_blocks: int = 4096, max_imbalance: int = 4):
+        self.block_size = block_size
+        self.max_imbalance = max_imbalance
+        self.blocks = [LRUCache(max_blocks) for _ in range(n_workers)]
+        self.affinity_routes = 0
+        self.load_routes = 0
+
+    def route(self, operations: List[Operation], loads: List[Optional[int]]) -> int:
+        # loads[i] is None for workers that are gone
+        hashes = prefix_blocks(operations, self.block_size)
+        alive = [i for i, load in enumerate(loads) if load is not None]
+        if len(alive) == 0:
+            raise Exception("No inference workers left")
+        least_loaded = min(alive, key=lambda i: loads[i])
+
+        best = least_loaded
+        best_matched = 0
+        for i in alive:
+            matched = 0
+            for h in hashes:
+                if self.blocks[i].get(h) is None:
+                    break
+                matched += 1
+            if matched > best_matched or (matched == best_matched and matched > 0 and loads[i] < loads[best]):
+                best = i
+                best_matched = matched
+
+        if best_matched == 0 or loads[best] > loads[least_loaded] + self.max_imbalance:
+            best = least_loaded
+            self.load_routes += 1
+        else:
+            self.affinity_routes += 1
+        for h in hashes:
+            self.blocks[best].put(h, True)
+        return best
+
+def _run_worker(index: int, config: Dict[str, Any], log_level: str, requests, results):
+    # Entry point of a worker process: one Llama with its own context behind
+    # an InferenceWorker. Messages from the front end are
+    #   ("stream", request ID, operations, Accept header, timeout, token budget,
+    #    priority, client, session ID, new session)
+    #   ("cancel", request ID)
+    #   ("snapshot", request ID, name, operations)
+    #   ("metrics", request ID) and ("stats", request ID)
+    #   None to stop
+    # and the replies are ("frame", request ID, bytes), ("done", request ID,
+    # error or None), ("reply", request ID, value) and ("error", request ID,
+    # error) for a call that failed. Errors are (type name, message).
+    logging.basicConfig(level=log_level, format=f"%(asctime)s %(levelname)s worker-{index} %(name)s: %(message)s")
+    from .llama import Llama
+    from .worker import InferenceWorker
+
+    send_lock = threading.Lock()
+    def send(message):
+        with send_lock:
+            results.send(message)
+
+    llama = Llama(ModelConfig(**config))
+    worker = InferenceWorker(llama)
+    worker.start()
+    labels = f'worker="{index}"'
+    # Running streams by request ID, for cancellation
+    streams = {}
+    def done(request_id: int, error: Optional[Exception]):
+        streams.pop(request_id, None)
+        send(("done", request_id, None if error is None else _encode_error(error)))
+    def reply(request_id: int, future: concurrent.futures.Future):
+        if future.exception() is not None:
+            send(("error", request_id, _encode_error(future.exception())))
+        else:
+            send(("reply", request_id, future.result()))
+    try:
+        while True:
+            message = requests.recv()
+            if message is None:
+                break
+            kind, request_id = message[0], message[1]
+            # A bad request fails on its own rather than taking the process,
+            # and every request in flight on it, down
+            try:
+                if kind == "stream":
+                    operations = [Operation(**operation) for operation in message[2]]
+                    streams[request_id] = worker.stream(
+                        operations,
+                        message[3],
+                        lambda frame, request_id=request_id: send(("frame", request_id, frame)),
+                        lambda error, request_id=request_id: done(request_id, error),
+                        *message[4:],
+                    )
+                elif kind == "cancel":
+                    # The stream may have finished already
+                    request = streams.get(request_id)
+                    if request is not None:
+                        worker.cancel(request)
+                elif kind == "snapshot":
+                    operations = [Operation(**operation) for operation in message[3]]
+                    worker.snapshot(message[2], operations).add_done_callback(
+                        lambda future, request_id=request_id: reply(request_id, future))
+                elif kind == "metrics":
+                    # Read on the inference thread, which mutates what they cover
+                    worker.call(lambda: llama.metrics.registry.collect(labels)).add_done_callback(
+                        lambda future, request_id=request_id: reply(request_id, future))
+                elif kind == "stats":
+                    worker.stats().add_done_callback(
+                        lambda future, request_id=request_id: reply(request_id, future))
+            except Exception as e:
+                logger.warning("Rejected %s request %d: %s", kind, request_id, e)
+                if kind == "stream":
+                    done(request_id, e)
+                elif kind != "cancel":
+                    send(("error", request_id, _encode_error(e)))
+    except EOFError:
+        # The front end went away
+        pass
+    finally:
+        worker.stop()
+        llama.stop()
+
+class WorkerProcess(object):
+    def __init__(self, index: int, config: ModelConfig, log_level: str):
+        self.index = index
+        context = multiprocessing.get_context("spawn")
+        requests_reader, self.requests = context.Pipe(duplex=False)
+        self.results, results_writer = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=_run_worker,
+            args=(index, config.model_dump(), log_level, requests_reader, results_writer),
+            name=f"inference-worker-{index}",
+            daemon=True,
+        )
+        self.process.start()
+        # Only the child holds these ends now, so recv raises EOFError once
+        # it exits
+        requests_reader.close()
+        results_writer.close()
+        self.send_lock = threading.Lock()
+        # Requests in flight, or None once the process is gone
+        self.load = 0
+
+    def send(self, message):
+        with self.send_lock:
+            self.requests.send(message)
+
+class ProcessWorkerPool(object):
+    # Runs n_workers model processes, each with its own context and threads,
+    # behind the same interface as InferenceWorker. The model file is mmapped
+    # by every process, so its weights are shared through the page cache.
+    # Callbacks are invoked on the pool's reader threads.
+    def __init__(self, config: ModelConfig, n_workers: int, log_level: str = "INFO", router: Optional[PrefixRouter] = None):
+        self.config = config
+        self.log_level = log_level
+        self.router = router or PrefixRouter(n_workers)
+        self.workers: List[WorkerProcess] = []
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        # Request ID -> (worker index, on_frame, on_done)
+        self.streams: Dict[int, Tuple[int, Callable[[bytes], None], Callable[[Optional[Exception]], None]]] = {}
+        # Request ID -> (worker index, future)
+        self.calls: Dict[int, Tuple[int, concurrent.futures.Future]] = {}
+        self.readers: List[threading.Thread] = []
+        self.n_workers = n_workers
+        # Session ID -> index of the worker holding the session
+        self.session_workers = LRUCache(65536)
+
+        self.registry = MetricsRegistry()
+        self.registry.counter("pool_affinity_routes_total", "Requests routed to the worker holding their prefix",
+            lambda: self.router.affinity_routes)
+        self.registry.counter("pool_load_routes_total", "Requests routed to the least loaded worker",
+            lambda: self.router.load_routes)
+        self.registry.gauge("pool_workers", "Worker processes still running",
+            lambda: sum(1 for worker in self.workers if worker.load is not None))
+
+    def start(self):
+        for index in range(self.n_workers):
+            worker = WorkerProcess(index, self.config, self.log_level)
+            self.workers.append(worker)
+            reader = threading.Thread(target=self._read, args=(worker,), name=f"inference-pool-reader-{index}", daemon=True)
+            reader.start()
+            self.readers.append(reader)
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.load is not None:
+                try:
+                    worker.send(None)
+                except OSError:
+                    pass
+        for worker in self.workers:
+            worker.process.join()
+        for reader in self.readers:
+            reader.join()
+
+    def stream(
+            self,
+            operations: List[Operation],
+            accept: str,
+            on_frame: Callable[[bytes], None],
+            on_done: Callable[[Optional[Exception]], None],
+            timeout: Optional[float] = None,
+            token_budget: Optional[int] = None,
+            priority: int = 0,
+            client: str = "",
+            session_id: Optional[str] = None,
+            new_session: bool = False,
+        ) -> int:
+        # Invalid requests fail here rather than in the worker
+        Interpreter(operations, lambda record: None)
+        with self.lock:
+            # A session lives on one worker, so its requests all go there
+            index = self.session_workers.get(session_id) if session_id is not None else None
+            if index is None or new_session or self.workers[index].load is None:
+                index = self.router.route(operations, [worker.load for worker in self.workers])
+            if session_id is not None:
+                self.session_workers.put(session_id, index)
+            worker = self.workers[index]
+            request_id = next(self.request_ids)
+            self.streams[request_id] = (index, on_frame, on_done)
+            worker.load += 1
+        worker.send(("stream", request_id, [operation.model_dump() for operation in operations], accept, timeout, token_budget, priority, client, session_id, new_session))
+        return request_id
+
+    def cancel(self, request_id: int):
+        with self.lock:
+            stream = self.streams.get(request_id)
+        if stream is None:
+            return
+        try:
+            self.workers[stream[0]].send(("cancel", request_id))
+        except OSError:
+            # The reader ends the stream once it notices the exit
+            pass
+
+    def snapshot(self, name: str, operations: List[Operation]) -> concurrent.futures.Future:
+        # Every worker prefills and saves the snapshot, so that each has it
+        # loaded; they write the same file atomically
+        if self.config.snapshot_dir is None:
+            raise ValueError("No snapshot_dir configured")
+        if any(operation.name != "feed_tokens" for operation in operations):
+            raise ValueError("Snapshots can only be taken of feed_tokens operations")
+        Interpreter(operations, lambda record: None)
+        return self._broadcast("snapshot", lambda replies: len(replies) > 0 and all(replies),
+            name, [operation.model_dump() for operation in operations])
+
+    def metrics(self) -> concurrent.futures.Future:
+        # Every worker's metrics labelled with its index, plus the pool's own
+        return self._broadcast("metrics", lambda replies: render_collected(
+            [reply for reply in replies if reply is not None] + [self.registry.collect()]))
+
+    def stats(self) -> concurrent.futures.Future:
+        return self._broadcast("stats", lambda replies: {
+            "workers": replies,
+            "routing": {
+                "affinity_routes": self.router.affinity_routes,
+                "load_routes": self.router.load_routes,
+            },
+        })
+
+    def _broadcast(self, kind: str, combine: Callable[[List[Any]], Any], *args) -> concurrent.futures.Future:
+        # Asks every live worker, and resolves to combine() of the replies,
+        # with None for workers that exited before replying or failed the call
+        futures = []
+        for index, worker in enumerate(self.workers):
+            with self.lock:
+                if worker.load is None:
+                    continue
+                request_id = next(self.request_ids)
+                future = concurrent.futures.Future()
+                self.calls[request_id] = (index, future)
+            futures.append(future)
+            try:
+                worker.send((kind, request_id, *args))
+            except OSError:
+                # The reader fails the call once it notices the exit
+                pass
+
+        result = concurrent.futures.Future()
+        lock = threading.Lock()
+        def gather(_):
+            with lock:
+                if result.done() or not all(future.done() for future in futures):
+                    return
+                result.set_result(combine([future.result() if future.exception() is None else None for future in futures]))
+        if len(futures) == 0:
+            gather(None)
+        for future in futures:
+            future.add_done_callback(gather)
+        return result
+
+    def _read(self, worker: WorkerProcess):
+        # Dispatches everything a worker process sends, until it exits
+        try:
+            while True:
+                kind, request_id, payload = worker.results.recv()
+                if kind == "frame":
+                    self.streams[request_id][1](payload)
+                elif kind == "done":
+                    with self.lock:
+                        _, _, on_done = self.streams.pop(request_id)
+                        worker.load -= 1
+                    on_done(None if payload is None else _decode_error(payload))
+                elif kind == "reply":
+                    with self.lock:
+                        _, future = self.calls.pop(request_id)
+                    future.set_result(payload)
+                elif kind == "error":
+                    with self.lock:
+                        _, future = self.calls.pop(request_id)
+                    future.set_exception(_decode_error(payload))
+        except (EOFError, OSError):
+            pass
+        except Exception:
+            logger.exception("Error handling a message from worker %d", worker.index)
+
+        # Fail whatever was still waiting on this worker
+        with self.lock:
+            worker.load = None
+            streams = [(request_id, stream) for request_id, stream in self.streams.items() if stream[0] == worker.index]
+            for request_id, _ in streams:
+                del self.streams[request_id]
+            calls = [(request_id, call) for request_id, call in self.calls.items() if call[0] == worker.index]
+            for request_id, _ in calls:
+                del self.calls[request_id]
+        if len(streams) > 0 or len(calls) > 0:
+            logger.error("Worker %d exited with %d requests in flight", worker.index, len(streams))
+        for _, (_, _, on_done) in streams:
+            on_done(Exception(f"Worker {worker.index} exited"))
+        for _, (_, future) in calls:
+            future.set_exception(Exception(f"Worker {worker.index} exited"))
@@ -0,0 +1,147 @@
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+# Number of candidates considered for nucleus sampling. Almost all of the
+# probability mass lives here; rows whose nucleus is larger find it with a
+# histogram of their mass instead.
+DEFAULT_CANDIDATE_POOL = 64
+
+# Logit bins of that histogram. Only the tokens in the bin where the nucleus
+# ends are sorted.
+NUCLEUS_BINS = 1024
+
+class SampledTokens(object):
+    def __init__(self, tokens: np.ndarray, logprobs: np.ndarray, ranks: np.ndarray, top_ids: np.ndarray, top_logits: np.ndarray, top_k: np.ndarray):
+        self.tokens = tokens
+        self.logprobs = logprobs
+        self.ranks = ranks
+        self.top_ids = top_ids
+        self.top_logits = top_logits
+        self.top_k = top_k
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def token(self, row: int) -> int:
+        return int(self.tokens[row])
+
+    def logprob(self, row: int) -> float:
+        return float(self.logprobs[row])
+
+    def rank(self, row: int) -> int:
+        return int(self.ranks[row])
+
+    def report(self, row: int) -> List[Tuple[int, float]]:
+        k = self.top_k[row]
+        report = list(zip(self.top_ids[row, :k].tolist(), self.top_logits[row, :k].tolist()))
+        # Tokens masked out by a constraint are not candidates
+        if len(report) > 0 and report[-1][1] == -np.inf:
+            report = [(token, logit) for token, logit in report if logit != -np.inf]
+        return report
+
+class Sampler(object):
+    def __init__(self, vocab_size: int, seed: Optional[int] = None, candidate_pool: int = DEFAULT_CANDIDATE_POOL):
+        self.vocab_size = vocab_size
+        self.candidate_pool = candidate_pool
+        self.rng = np.random.default_rng(seed)
+
+    def sample(
+            self,
+            logits: np.ndarray,
+            temperature: Union[float, np.ndarray],
+            top_k: Union[int, np.ndarray],
+            top_p: Union[float, np.ndarray] = 0.9,
+            blocked: Optional[List[Optional[np.ndarray]]] = None,
+        ) -> SampledTokens:
+        # logits is an (n_rows, vocab_size) matrix, typically a zero-copy view
+        # of the llama.cpp output buffer. It is never written to. blocked has
+        # a boolean mask of the tokens a row cannot sample, or None, per row.
+        n_rows = logits.shape[0]
+        # A temperature of zero degenerates to (near) greedy sampling
+        temperature = np.maximum(np.broadcast_to(np.asarray(temperature, dtype=np.float32), (n_rows,)), 1e-4)
+        top_k = np.minimum(np.broadcast_to(np.asarray(top_k, dtype=np.int64), (n_rows,)), self.vocab_size)
+        top_p = np.broadcast_to(np.asarray(top_p, dtype=np.float32), (n_rows,))
+
+        scaled = logits / temperature[:, None]
+        if blocked is not None:
+            for row, row_blocked in enumerate(blocked):
+                if row_blocked is not None:
+                    np.putmask(scaled[row], row_blocked, -np.inf)
+        row_max = scaled.max(axis=1, keepdims=True)
+        scaled -= row_max
+        log_norm = np.log(np.exp(scaled).sum(axis=1))
+
+        rows = np.arange(n_rows)
+        pool = min(max(self.candidate_pool, int(top_k.max())), self.vocab_size)
+        ids, pool_logits, keep = self._nucleus(scaled, log_norm, pool, top_k, top_p)
+        chosen = self._choose(pool_logits, keep)
+        tokens = ids[rows, chosen]
+
+        # Rows whose nucleus did not fit in the candidate pool sample from
+        # every token at or above their nucleus threshold
+        for row in np.flatnonzero(keep > pool):
+            threshold = self._nucleus_threshold(scaled[row], log_norm[row], top_p[row])
+            candidates = np.flatnonzero(scaled[row] >= threshold)
+            cumulative = np.cumsum(np.exp(scaled[row, candidates]))
+            index = min(int(np.searchsorted(cumulative, self.rng.random() * cumulative[-1], side="right")), len(candidates) - 1)
+            tokens[row] = candidates[index]
+            chosen[row] = np.count_nonzero(scaled[row] > scaled[row, tokens[row]])
+
+        # Report the top-k candidates with their temperature-scaled logits,
+        # the same values llama_sample_temp would have left in candidates_p.
+        k_max = int(top_k.max())
+        return SampledTokens(
+            tokens,
+            scaled[rows, tokens] - log_norm,
+            chosen + 1,
+            ids[:, :k_max],
+            pool_logits[:, :k_max] + row_max,
+            top_k,
+        )
+
+    def _nucleus(self, scaled: np.ndarray, log_norm: np.ndarray, pool: int, top_k: np.ndarray, top_p: np.ndarray):
+        if pool < scaled.shape[1]:
+            ids = np.argpartition(-scaled, pool - 1, axis=1)[:, :pool]
+        else:
+            ids = np.broadcast_to(np.arange(scaled.shape[1]), scaled.shape)
+        pool_logits = np.take_along_axis(scaled, ids, axis=1)
+        order = np.argsort(-pool_logits, axis=1, kind="stable")
+        ids = np.take_along_axis(ids, order, axis=1)
+        pool_logits = np.take_along_axis(pool_logits, order, axis=1)
+
+        cumulative = np.cumsum(np.exp(pool_logits - log_norm[:, None]), axis=1)
+        keep = (cumulative < top_p[:, None]).sum(axis=1) + 1
+        # A row whose whole pool is still short of top_p needs more candidates
+        if pool < scaled.shape[1]:
+            keep[cumulative[:, -1] < top_p] = pool + 1
+        keep = np.maximum(keep, np.minimum(top_k, pool))
+        return ids, pool_logits, keep
+
+    def _nucleus_threshold(self, scaled: np.ndarray, log_norm: float, top_p: float) -> float:
+        # Smallest logit in the nucleus of one row, without sorting it: the
+        # mass above each logit bin locates the bin where the nucleus ends,
+        # and only that bin's logits are sorted to find where exactly
+        is_finite = np.isfinite(scaled)
+        low = float(scaled[is_finite].min())
+        if low == 0.0:
+            return low
+        probs = np.exp(scaled - log_norm)
+        # Masked out tokens have no mass, so their bin does not matter
+        bins = np.clip(((np.where(is_finite, scaled, low) - low) * (NUCLEUS_BINS / -low)).astype(np.int64), 0, NUCLEUS_BINS - 1)
+        above = np.cumsum(np.bincount(bins, weights=probs, minlength=NUCLEUS_BINS)[::-1])[::-1]
+        reached = np.flatnonzero(above >= top_p)
+        end = int(reached[-1]) if len(reached) > 0 else 0
+        mass_above = above[end + 1] if end + 1 < NUCLEUS_BINS else 0.0
+        in_bin = -np.sort(-scaled[(bins == end) & is_finite])
+        cumulative = mass_above + np.cumsum(np.exp(in_bin - log_norm))
+        return float(in_bin[min(int((cumulative < top_p).sum()), len(in_bin) - 1)])
+
+    def _choose(self, pool_logits: np.ndarray, keep: np.ndarray) -> np.ndarray:
+        keep = np.minimum(keep, pool_logits.shape[1])
+        weights = np.exp(pool_logits)
+        weights[np.arange(pool_logits.shape[1])[None, :] >= keep[:, None]] = 0.0
+        cumulative = np.cumsum(weights, axis=1)
+        threshold = self.rng.random(len(keep)) * cumulative[:, -1]
+        chosen = (cumulative <= threshold[:, None]).sum(axis=1)
+        return np.minimum(chosen, keep - 1)
@@ -0,0 +1,66 @@
+from typing import List, Tuple
+
+import numpy as np
+
+# Rows of the logits matrix processed at a time, which bounds the size of
+# the temporaries to a few MB even for a full 512-token chunk.
+SCORE_BLOCK_ROWS = 64
+
+class TokenScores(object):
+    def __init__(self, tokens: np.ndarray, logits: np.ndarray, logprobs: np.ndarray, ranks: np.ndarray, top_ids: np.ndarray, top_logits: np.ndarray):
+        self.tokens = tokens
+        self.logits = logits
+        self.logprobs = logprobs
+        self.ranks = ranks
+        self.top_ids = top_ids
+        self.top_logits = top_logits
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def report(self, row: int) -> List[Tuple[int, float]]:
+        token = int(self.tokens[row])
+        selected = (token, float(self.logits[row]))
+        if self.top_ids.shape[1] == 0:
+            return [selected]
+        logits = list(zip(self.top_ids[row].tolist(), self.top_logits[row].tolist()))
+        if self.ranks[row] > len(logits):
+            logits.append(selected)
+        return logits
+
+def score_tokens(logits: np.ndarray, tokens: np.ndarray, top_n: int) -> TokenScores:
+    # Row i of logits is the prediction for tokens[i]. Computes the
+    # log-softmax probability and rank of each token, and the top_n
+    # alternatives at each position unless top_n is 0.
+    n_rows, vocab_size = logits.shape
+    tokens = np.asarray(tokens, dtype=np.int64)
+    top_n = min(top_n, vocab_size)
+    selected = np.empty(n_rows, dtype=np.float32)
+    logprobs = np.empty(n_rows, dtype=np.float32)
+    ranks = np.empty(n_rows, dtype=np.int64)
+    top_ids = np.empty((n_rows, top_n), dtype=np.int64)
+    top_logits = np.empty((n_rows, top_n), dtype=np.float32)
+
+    for start in range(0, n_rows, SCORE_BLOCK_ROWS):
+        end = min(start + SCORE_BLOCK_ROWS, n_rows)
+        block = logits[start:end]
+        rows = np.arange(end - start)
+        block_selected = block[rows, tokens[start:end]]
+        row_max = block.max(axis=1)
+        log_norm = row_max + np.log(np.exp(block - row_max[:, None]).sum(axis=1))
+
+        selected[start:end] = block_selected
+        logprobs[start:end] = block_selected - log_norm
+        ranks[start:end] = (block > block_selected[:, None]).sum(axis=1) + 1
+
+        if top_n > 0:
+            if top_n < vocab_size:
+                ids = np.argpartition(-block, top_n - 1, axis=1)[:, :top_n]
+            else:
+                ids = np.broadcast_to(np.arange(vocab_size), block.shape)
+            values = np.take_along_axis(block, ids, axis=1)
+            order = np.argsort(-values, axis=1, kind="stable")
+            top_ids[start:end] = np.take_along_axis(ids, order, axis=1)
+            top_logits[start:end] = np.take_along_axis(values, order, axis=1)
+
+    return TokenScores(tokens, selected, logprobs, ranks, top_ids, top_logits)
@@ -0,0 +1,29 @@
+import heapq
+from typing import Optional
+
+class SeqIdPool(object):
+    # Hands out llama.cpp sequence IDs in [0, size), always reusing the lowest
+    # free ID so that the set of IDs in use stays dense.
+    def __init__(self, size: int):
+        self.size = size
+        self.free = list(range(size))
+        self.in_use = set()
+
+    def __len__(self):
+        return len(self.in_use)
+
+    def available(self) -> int:
+        return len(self.free)
+
+    def allocate(self) -> Optional[int]:
+        if len(self.free) == 0:
+            return None
+        seq_num = heapq.heappop(self.free)
+        self.in_use.add(seq_num)
+        return seq_num
+
+    def release(self, seq_num: int):
+        if seq_num not in self.in_use:
+            raise ValueError(f"Sequence {seq_num} is not allocated")
+        self.in_use.remove(seq_num)
+        heapq.heappush(self.free, seq_num)
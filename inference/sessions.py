@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from .llama_operation import LlamaOperation
+
+class SessionNotFound(ValueError):
+    pass
+
+class SessionBusy(ValueError):
+    pass
+
+class Session(object):
+    def __init__(self, session_id: str):
+        self.id = session_id
+        # The final operation of the last finished request, holding the
+        # conversation's tokens, logits and, while resident, its sequence
+        self.operation: Optional[LlamaOperation] = None
+        # id() of the interpreter running a request on the session, if any
+        self.interpreter_key: Optional[int] = None
+        self.last_used = time.monotonic()
+
+    def is_busy(self) -> bool:
+        return self.interpreter_key is not None
+
+class SessionStore(object):
+    # Conversations kept between requests, least recently used first.
+    # Sessions idle for idle_seconds are dropped, as are the least recently
+    # used idle ones beyond max_sessions.
+    def __init__(self, max_sessions: int, idle_seconds: float):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.resumed = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self.sessions.get(session_id)
+
+    def create(self, session_id: str) -> Session:
+        session = Session(session_id)
+        self.sessions[session_id] = session
+        return session
+
+    def remove(self, session_id: str) -> Optional[Session]:
+        return self.sessions.pop(session_id, None)
+
+    def touch(self, session: Session):
+        session.last_used = time.monotonic()
+        self.sessions.move_to_end(session.id)
+
+    def drop_stale(self) -> List[Session]:
+        # Removes and returns the sessions that expired or are over capacity
+        now = time.monotonic()
+        dropped = []
+        for session in list(self.sessions.values()):
+            if not session.is_busy() and now - session.last_used >= self.idle_seconds:
+                dropped.append(session)
+                self.expired += 1
+        over = len(self.sessions) - len(dropped) - self.max_sessions
+        for session in self.sessions.values():
+            if over <= 0:
+                break
+            if not session.is_busy() and session not in dropped:
+                dropped.append(session)
+                self.evicted += 1
+                over -= 1
+        for session in dropped:
+            del self.sessions[session.id]
+        return dropped
+
+    def idle_resident(self) -> Optional[Session]:
+        # The least recently used idle session still holding a sequence
+        for session in self.sessions.values():
+            if not session.is_busy() and session.operation is not None and session.operation.seq_num >= 0:
+                return session
+        return None
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "resident": sum(1 for session in self.sessions.values() if session.operation is not None and session.operation.seq_num >= 0),
+            "resumed": self.resumed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
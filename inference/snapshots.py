@@ -0,0 +1,174 @@
+import ctypes
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+import llama_cpp
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Snapshot file layout, integers little-endian: magic "KVSN", uint32 version,
+# uint32 metadata length, UTF-8 JSON metadata {"name", "tokens", "reports"},
+# then the llama_state_seq_get_data bytes up to the end of the file.
+SNAPSHOT_MAGIC = b"KVSN"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_SUFFIX = ".kv"
+_header = struct.Struct("<4sII")
+
+def model_fingerprint(model_filename: str) -> str:
+    # Size plus the first and last MiB of the model file. Hashing all of a
+    # multi-gigabyte model on every start would cost more than the prefills
+    # the snapshots save, and any re-quantization or different model changes
+    # the header or the tail.
+    chunk = 1 << 20
+    h = hashlib.sha1()
+    with open(model_filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(str(size).encode("utf-8"))
+        h.update(f.read(chunk))
+        f.seek(max(size - chunk, 0))
+        h.update(f.read(chunk))
+    return h.hexdigest()[:16]
+
+def tokens_key(tokens: List[int]) -> str:
+    return hashlib.sha1(np.asarray(tokens, dtype=np.int32).tobytes()).hexdigest()[:20]
+
+class Snapshot(object):
+    def __init__(self, name: str, tokens: Tuple[int, ...], path: str):
+        self.name = name
+        self.tokens = tokens
+        self.path = path
+
+class SnapshotStore(object):
+    # Named prompt snapshots on disk: the per-sequence KV cache state of a
+    # prefilled prompt, with the token reports needed to replay it. Files
+    # live under a directory named after the model's fingerprint, so a
+    # changed model never sees snapshots taken with another one; those are
+    # deleted when the store is opened.
+    def __init__(self, root: str, model_filename: str, ctx: llama_cpp.llama_context_p):
+        self.ctx = ctx
+        self.fingerprint = model_fingerprint(model_filename)
+        self.directory = os.path.join(root, self.fingerprint)
+        os.makedirs(self.directory, exist_ok=True)
+        self.snapshots: Dict[str, Snapshot] = {}
+        self.saved = 0
+        self.loaded = 0
+        self.failed_loads = 0
+        self.loaded_bytes = 0
+        self._remove_stale(root)
+        self._scan()
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def _remove_stale(self, root: str):
+        for name in os.listdir(root):
+            directory = os.path.join(root, name)
+            if name == self.fingerprint or not os.path.isdir(directory):
+                continue
+            files = os.listdir(directory)
+            if len(files) == 0 or not all(file.endswith(SNAPSHOT_SUFFIX) for file in files):
+                # Not ours
+                continue
+            logger.info("Removing %d snapshots of another model in %s", len(files), directory)
+            for file in files:
+                os.remove(os.path.join(directory, file))
+            os.rmdir(directory)
+
+    def _scan(self):
+        for file in sorted(os.listdir(self.directory)):
+            if not file.endswith(SNAPSHOT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, file)
+            try:
+                with open(path, "rb") as f:
+                    metadata, _ = self._read_header(f.read(_header.size), f)
+            except (OSError, ValueError) as e:
+                logger.warning("Removing unreadable snapshot %s: %s", path, e)
+                os.remove(path)
+                continue
+            self.snapshots[metadata["name"]] = Snapshot(metadata["name"], tuple(metadata["tokens"]), path)
+        logger.info("Found %d snapshots in %s", len(self.snapshots), self.directory)
+
+    def _read_header(self, header: bytes, f) -> Tuple[Dict[str, Any], int]:
+        # Returns the metadata and the offset of the state data
+        if len(header) != _header.size:
+            raise ValueError("truncated header")
+        magic, version, length = _header.unpack(header)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"not a version {SNAPSHOT_VERSION} snapshot")
+        return json.loads(f.read(length).decode("utf-8")), _header.size + length
+
+    def match(self, tokens: List[int]) -> Optional[Snapshot]:
+        # The longest snapshot whose tokens are a prefix of tokens
+        best = None
+        for snapshot in self.snapshots.values():
+            n = len(snapshot.tokens)
+            if n <= len(tokens) and (best is None or n > len(best.tokens)) and tuple(tokens[:n]) == snapshot.tokens:
+                best = snapshot
+        return best
+
+    def save(self, name: str, tokens: List[int], reports: List[Any], seq_num: int) -> bool:
+        size = llama_cpp.llama_state_seq_get_size(self.ctx, seq_num)
+        state = (ctypes.c_uint8 * size)()
+        if llama_cpp.llama_state_seq_get_data(self.ctx, state, size, seq_num) != size:
+            return False
+        metadata = json.dumps({"name": name, "tokens": list(tokens), "reports": reports}).encode("utf-8")
+        path = os.path.join(self.directory, tokens_key(tokens) + SNAPSHOT_SUFFIX)
+        # Written under a temporary name and renamed, so other processes only
+        # ever see complete files
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(metadata)))
+            f.write(metadata)
+            f.write(state)
+        os.replace(temp_path, path)
+
+        previous = self.snapshots.get(name)
+        if previous is not None and previous.path != path and os.path.exists(previous.path):
+            os.remove(previous.path)
+        self.snapshots[name] = Snapshot(name, tuple(tokens), path)
+        self.saved += 1
+        logger.info("Saved snapshot %s of %d tokens (%d bytes of state)", name, len(tokens), size)
+        return True
+
+    def load(self, snapshot: Snapshot, seq_num: int) -> Optional[List[Any]]:
+        # Puts the snapshot's KV cache into seq_num straight from the mapped
+        # file, and returns its reports, or None on failure
+        try:
+            with open(snapshot.path, "rb") as f:
+                metadata, offset = self._read_header(f.read(_header.size), f)
+                # Copy-on-write, so ctypes can wrap it without a copy
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError) as e:
+            logger.warning("Cannot read snapshot %s: %s", snapshot.path, e)
+            self.snapshots.pop(snapshot.name, None)
+            self.failed_loads += 1
+            return None
+        size = len(mapped) - offset
+        state = (ctypes.c_uint8 * size).from_buffer(mapped, offset)
+        ret = llama_cpp.llama_state_seq_set_data(self.ctx, state, size, seq_num)
+        del state
+        mapped.close()
+        if ret == 0:
+            # Either no room in the KV cache or state from different context
+            # parameters; the file stays for the next attempt
+            self.failed_loads += 1
+            return None
+        self.loaded += 1
+        self.loaded_bytes += size
+        return metadata["reports"]
+
+    def stats(self):
+        return {
+            "snapshots": len(self.snapshots),
+            "saved": self.saved,
+            "loaded": self.loaded,
+            "failed_loads": self.failed_loads,
+            "loaded_bytes": self.loaded_bytes,
+        }
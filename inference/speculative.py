@@ -0,0 +1,196 @@
+import logging
+from typing import Dict, List, Tuple
+
+import llama_cpp
+import numpy as np
+
+from .llama_operation import LlamaOperation
+from .token_history import TokenHistory
+from .util import get_logits_ith
+
+logger = logging.getLogger(__name__)
+
+class SpeculationStats(object):
+    def __init__(self):
+        self.verifications = 0
+        self.drafted = 0
+        self.accepted = 0
+
+    def record(self, drafted: int, accepted: int):
+        self.verifications += 1
+        self.drafted += drafted
+        self.accepted += accepted
+
+    def stats(self):
+        return {
+            "verifications": self.verifications,
+            "drafted": self.drafted,
+            "accepted": self.accepted,
+            "acceptance_rate": self.accepted / self.drafted if self.drafted > 0 else 0.0,
+            # Each verification also yields the main model's own next token,
+            # so this is the speedup over decoding one token per step
+            "tokens_per_step": 1.0 + self.accepted / self.verifications if self.verifications > 0 else 1.0,
+        }
+
+# A request for up to n draft tokens continuing the operation's history
+# followed by the pending tokens about to be decoded
+DraftRequest = Tuple[LlamaOperation, List[int], int]
+
+def _window(history: TokenHistory, pending: List[int], start: int, end: int) -> List[int]:
+    # Tokens [start, end) of history followed by pending, without copying the
+    # rest of the history
+    n = len(history)
+    return history[start:min(end, n)] + pending[max(start - n, 0):max(end - n, 0)]
+
+class NgramIndex(object):
+    # Maps every n-gram of a token history to where it last ended, extended
+    # incrementally as the history grows
+    def __init__(self, n: int):
+        self.n = n
+        self.ends: Dict[Tuple[int, ...], int] = {}
+        # n-grams ending at or before this position are indexed
+        self.indexed = 0
+
+    def extend(self, history: TokenHistory, pending: List[int], end: int):
+        start = max(self.indexed + 1, self.n)
+        if start > end:
+            return
+        tokens = _window(history, pending, start - self.n, end)
+        for i in range(start, end + 1):
+            self.ends[tuple(tokens[i - start:i - start + self.n])] = i
+        self.indexed = max(self.indexed, end)
+
+    def propose(self, history: TokenHistory, pending: List[int], n_tokens: int) -> List[int]:
+        # Continue the last n tokens the way their latest earlier occurrence
+        # was continued
+        length = len(history) + len(pending)
+        if length <= self.n:
+            return []
+        self.extend(history, pending, length - 1)
+        end = self.ends.get(tuple(_window(history, pending, length - self.n, length)))
+        if end is None:
+            return []
+        return _window(history, pending, end, min(end + n_tokens, length))
+
+class PromptLookupSpeculator(object):
+    # Drafts by copying from the sequence's own history, e.g. spans of the
+    # prompt that the completion is quoting. Needs no model.
+    def __init__(self, n: int):
+        self.n = n
+
+    def stop(self):
+        pass
+
+    def propose(self, requests: List[DraftRequest]) -> List[List[int]]:
+        drafts = []
+        for operation, pending, n_tokens in requests:
+            if operation.ngram_index is None:
+                operation.ngram_index = NgramIndex(self.n)
+            drafts.append(operation.ngram_index.propose(operation.tokens, pending, n_tokens))
+        return drafts
+
+    def rollback(self, operation: LlamaOperation, length: int):
+        # Rejected drafts never enter the history, so there is nothing to undo
+        pass
+
+class DraftModelSpeculator(object):
+    # Drafts greedily with a smaller model sharing the main model's
+    # vocabulary. The draft context uses the same sequence IDs as the main
+    # one, and each sequence's draft KV cache is brought up to date lazily.
+    def __init__(
+            self,
+            model_filename: str,
+            model_params: llama_cpp.llama_model_params,
+            params: llama_cpp.llama_context_params,
+            batch_size: int,
+            vocab_size: int,
+        ):
+        self.model = llama_cpp.llama_load_model_from_file(model_filename.encode('utf-8'), model_params)
+        self.ctx = llama_cpp.llama_new_context_with_model(self.model, params)
+        self.vocab_size = llama_cpp.llama_n_vocab(self.model)
+        if self.vocab_size != vocab_size:
+            raise ValueError(f"Draft model vocabulary size {self.vocab_size} does not match {vocab_size}")
+        self.batch_size = batch_size
+        self.batch = llama_cpp.llama_batch_init(batch_size, 0, 1)
+        # Sequence ID -> (context ID of the operation, number of its tokens in
+        # the draft KV cache)
+        self.owners: Dict[int, Tuple[str, int]] = {}
+
+    def stop(self):
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+
+    def propose(self, requests: List[DraftRequest]) -> List[List[int]]:
+        drafts = [[] for _ in requests]
+
+        # Feed each sequence whatever the draft model has not seen yet. Only
+        # the last token of each sequence needs logits.
+        feeds = []
+        lengths = [len(operation.tokens) + len(pending) for operation, pending, _ in requests]
+        for i, (operation, pending, _) in enumerate(requests):
+            length = lengths[i]
+            owner = self.owners.get(operation.seq_num)
+            if owner is None or owner[0] != operation.context.id:
+                # The sequence ID was reused by another operation
+                llama_cpp.llama_kv_cache_seq_rm(self.ctx, operation.seq_num, -1, -1)
+                owner = (operation.context.id, 0)
+            elif owner[1] >= length:
+                owner = (operation.context.id, length - 1)
+                llama_cpp.llama_kv_cache_seq_rm(self.ctx, operation.seq_num, owner[1], -1)
+            self.owners[operation.seq_num] = owner
+            for pos, token in enumerate(_window(operation.tokens, pending, owner[1], length), owner[1]):
+                feeds.append((i, operation.seq_num, token, pos, pos == length - 1))
+
+        for start in range(0, len(feeds), self.batch_size):
+            chunk = feeds[start:start + self.batch_size]
+            if not self._decode(chunk):
+                return [[] for _ in requests]
+            for j, (i, _, _, _, last) in enumerate(chunk):
+                if last:
+                    drafts[i].append(self._argmax(j))
+
+        # Then extend all drafts one token per decode
+        active = [i for i, (_, _, n) in enumerate(requests) if n > 1]
+        while len(active) > 0:
+            chunk = [
+                (i, requests[i][0].seq_num, drafts[i][-1], lengths[i] + len(drafts[i]) - 1, True)
+                for i in active
+            ]
+            if not self._decode(chunk):
+                return [[] for _ in requests]
+            for j, i in enumerate(active):
+                drafts[i].append(self._argmax(j))
+            active = [i for i in active if len(drafts[i]) < requests[i][2]]
+
+        # Every draft token but the last is now in the draft KV cache
+        for (operation, _, _), length, draft in zip(requests, lengths, drafts):
+            self.owners[operation.seq_num] = (operation.context.id, length + len(draft) - 1)
+        return drafts
+
+    def rollback(self, operation: LlamaOperation, length: int):
+        # Forget draft KV entries past the first length tokens of operation
+        owner = self.owners.get(operation.seq_num)
+        if owner is not None and owner[0] == operation.context.id and owner[1] > length:
+            llama_cpp.llama_kv_cache_seq_rm(self.ctx, operation.seq_num, length, -1)
+            self.owners[operation.seq_num] = (owner[0], length)
+
+    def _decode(self, chunk: List[Tuple[int, int, int, int, bool]]) -> bool:
+        # chunk holds (request index, sequence, token, position, logits)
+        for j, (_, seq_num, token, pos, logits) in enumerate(chunk):
+            self.batch.token[j] = token
+            self.batch.pos[j] = pos
+            self.batch.n_seq_id[j] = 1
+            self.batch.seq_id[j][0] = seq_num
+            self.batch.logits[j] = logits
+        self.batch.n_tokens = len(chunk)
+        ret = llama_cpp.llama_decode(self.ctx, self.batch)
+        if ret != 0:
+            # Drafting is best effort; start over with an empty cache
+            logger.warning("Draft model error %d, clearing its KV cache", ret)
+            llama_cpp.llama_kv_cache_clear(self.ctx)
+            self.owners = {}
+            return False
+        return True
+
+    def _argmax(self, j: int) -> int:
+        return int(np.argmax(get_logits_ith(self.ctx, j, self.vocab_size)))
@@ -0,0 +1,104 @@
+import json
+import struct
+from typing import Callable, Dict, List, Optional, Tuple
+
+# A reported token: operation ID, token index, token, [(token, logit), ...],
+# and the token's logprob and rank, which are None if not known
+TokenRecord = Tuple[str, int, int, List[Tuple[int, float]], Optional[float], Optional[int]]
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+BINARY_CONTENT_TYPE = "application/vnd.token-stream"
+
+class NDJSONEncoder(object):
+    # One JSON array per line: [operation ID, index, token, logits] followed
+    # by logprob and rank when known. A request that fails mid-stream ends
+    # with an {"error": message} line.
+    content_type = NDJSON_CONTENT_TYPE
+
+    def encode_error(self, message: str) -> bytes:
+        return (json.dumps({"error": message}) + "\n").encode("utf-8")
+
+    def encode(self, records: List[TokenRecord]) -> bytes:
+        lines = []
+        for operation_id, index, token, logits, logprob, rank in records:
+            if logprob is None:
+                lines.append(json.dumps([operation_id, index, token, logits]))
+            else:
+                lines.append(json.dumps([operation_id, index, token, logits, logprob, rank]))
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+# Binary frames, all little-endian: uint32 length of the rest of the frame,
+# then a sequence of records, each starting with a uint8 kind.
+#   RECORD_OPERATION: uint32 ref, uint32 length, UTF-8 operation ID. Assigns
+#     a ref to an operation ID; sent once per stream before its first token.
+#   RECORD_TOKEN: uint32 ref, uint32 index, int32 token, uint32 logit count,
+#     uint8 flags, then (int32 token, float32 logit) per logit, then float32
+#     logprob and uint32 rank if flags has FLAG_LOGPROB.
+#   RECORD_ERROR: uint16 length, UTF-8 message. Ends a stream whose request
+#     failed after tokens were sent.
+RECORD_OPERATION = 0
+RECORD_TOKEN = 1
+RECORD_ERROR = 2
+FLAG_LOGPROB = 1
+
+_frame_header = struct.Struct("<I")
+_operation_header = struct.Struct("<BII")
+_token_header = struct.Struct("<BIIiIB")
+_logprob = struct.Struct("<fI")
+_error_header = struct.Struct("<BH")
+
+class BinaryEncoder(object):
+    content_type = BINARY_CONTENT_TYPE
+
+    def __init__(self):
+        self.operation_refs: Dict[str, int] = {}
+
+    def encode(self, records: List[TokenRecord]) -> bytes:
+        parts = []
+        for operation_id, index, token, logits, logprob, rank in records:
+            ref = self.operation_refs.get(operation_id)
+            if ref is None:
+                ref = len(self.operation_refs)
+                self.operation_refs[operation_id] = ref
+                encoded_id = operation_id.encode("utf-8")
+                parts.append(_operation_header.pack(RECORD_OPERATION, ref, len(encoded_id)))
+                parts.append(encoded_id)
+            flags = FLAG_LOGPROB if logprob is not None else 0
+            parts.append(_token_header.pack(RECORD_TOKEN, ref, index, token, len(logits), flags))
+            if len(logits) > 0:
+                parts.append(struct.pack("<" + "if" * len(logits), *[value for pair in logits for value in pair]))
+            if flags & FLAG_LOGPROB:
+                parts.append(_logprob.pack(logprob, rank))
+        body = b"".join(parts)
+        return _frame_header.pack(len(body)) + body
+
+    def encode_error(self, message: str) -> bytes:
+        encoded = message.encode("utf-8")[:0xFFFF]
+        body = _error_header.pack(RECORD_ERROR, len(encoded)) + encoded
+        return _frame_header.pack(len(body)) + body
+
+def negotiate_encoder(accept: str):
+    # Binary only when the client asks for it, so existing clients keep
+    # getting NDJSON
+    if BINARY_CONTENT_TYPE in accept:
+        return BinaryEncoder()
+    return NDJSONEncoder()
+
+class TokenStream(object):
+    # Gathers the tokens reported during an inference step, so that they are
+    # encoded and handed to on_frame together once the step is over. Both
+    # methods are called on the inference thread.
+    def __init__(self, encoder, on_frame: Callable[[bytes], None]):
+        self.encoder = encoder
+        self.on_frame = on_frame
+        self.records: List[TokenRecord] = []
+
+    def report(self, record: TokenRecord):
+        self.records.append(record)
+
+    def flush(self):
+        if len(self.records) > 0:
+            records = self.records
+            self.records = []
+            self.on_frame(self.encoder.encode(records))
@@ -0,0 +1,67 @@
+import itertools
+from array import array
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+
+class TokenHistory(object):
+    # Copy-on-write token history of an operation. A fork shares the history
+    # so far as an array that is never modified again, and appends to a tail
+    # of its own, so forking takes O(1) time and memory however long the
+    # history is. Forking a history whose tail is not empty first merges the
+    # tail into a new shared array, once for all of its forks.
+    __slots__ = ("shared", "tail")
+
+    def __init__(self, shared: Optional[array] = None):
+        self.shared = shared if shared is not None else array("i")
+        self.tail = array("i")
+
+    def __len__(self) -> int:
+        return len(self.shared) + len(self.tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.tolist()[index]
+            # Only the sliced tokens are copied
+            n_shared = len(self.shared)
+            return self.shared[start:min(stop, n_shared)].tolist() + \
+                self.tail[max(start - n_shared, 0):max(stop - n_shared, 0)].tolist()
+        if index < 0:
+            index += len(self)
+        if index < len(self.shared):
+            return self.shared[index]
+        return self.tail[index - len(self.shared)]
+
+    def __iter__(self) -> Iterator[int]:
+        return itertools.chain(self.shared, self.tail)
+
+    def __add__(self, other: Iterable[int]) -> List[int]:
+        return self.tolist() + list(other)
+
+    def append(self, token: int):
+        self.tail.append(token)
+
+    def extend(self, tokens: Iterable[int]):
+        self.tail.extend(tokens)
+
+    def fork(self) -> "TokenHistory":
+        if len(self.tail) > 0:
+            self.shared = self.shared + self.tail
+            self.tail = array("i")
+        return TokenHistory(self.shared)
+
+    def tolist(self) -> List[int]:
+        return self.shared.tolist() + self.tail.tolist()
+
+    def copy_to(self, dest: np.ndarray, start: int, end: int):
+        # Copies tokens [start, end) into dest straight from the underlying
+        # buffers
+        n_shared = len(self.shared)
+        if start < n_shared:
+            split = min(end, n_shared)
+            dest[:split - start] = np.frombuffer(self.shared, dtype=np.intc)[start:split]
+        if end > n_shared:
+            split = max(start, n_shared)
+            dest[split - start:end - start] = np.frombuffer(self.tail, dtype=np.intc)[split - n_shared:end - n_shared]
@@ -0,0 +1,85 @@
+import ctypes
+import gzip
+import hashlib
+import json
+import struct
+from typing import List
+
+import llama_cpp
+
+# Binary layout, all integers little-endian uint32:
+#   magic "TMAP", version, token count N, N + 1 offsets into the string data,
+#   followed by the UTF-8 string data itself. Token i is data[offsets[i]:offsets[i + 1]].
+TOKEN_MAP_MAGIC = b"TMAP"
+TOKEN_MAP_VERSION = 1
+
+def token_pieces(model: llama_cpp.llama_model_p, vocab_size: int) -> List[bytes]:
+    # Like util.token_to_string for every token, but reusing a single buffer
+    # for the whole vocabulary and keeping the raw bytes
+    size = 64
+    buf = ctypes.create_string_buffer(size)
+    pieces = []
+    for token_id in range(vocab_size):
+        n = llama_cpp.llama_token_to_piece(model, token_id, buf, size, 0, False)
+        if n < 0:
+            size = max(-n, size * 2)
+            buf = ctypes.create_string_buffer(size)
+            n = llama_cpp.llama_token_to_piece(model, token_id, buf, size, 0, False)
+        pieces.append(buf.raw[:n])
+    return pieces
+
+def token_strings(pieces: List[bytes]) -> List[str]:
+    strings = []
+    for piece in pieces:
+        try:
+            strings.append(piece.decode('utf-8'))
+        except UnicodeDecodeError:
+            strings.append("?")
+    return strings
+
+def encode_token_map(strings: List[str]) -> bytes:
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    header = TOKEN_MAP_MAGIC + struct.pack(f"<II{len(offsets)}I", TOKEN_MAP_VERSION, len(strings), *offsets)
+    return header + b"".join(encoded)
+
+def decode_token_map(data: bytes) -> List[str]:
+    if data[:4] != TOKEN_MAP_MAGIC:
+        raise ValueError("Not a token map")
+    version, count = struct.unpack_from("<II", data, 4)
+    if version != TOKEN_MAP_VERSION:
+        raise ValueError(f"Unsupported token map version {version}")
+    offsets = struct.unpack_from(f"<{count + 1}I", data, 12)
+    base = 12 + 4 * (count + 1)
+    return [data[base + offsets[i]:base + offsets[i + 1]].decode('utf-8') for i in range(count)]
+
+class TokenMapBody(object):
+    # One encoding of the token map, ready to be served as-is
+    def __init__(self, data: bytes, content_type: str):
+        self.data = data
+        self.gzipped = gzip.compress(data, mtime=0)
+        self.content_type = content_type
+        digest = hashlib.sha1(data).hexdigest()
+        # Each representation has its own ETag, so that caches never answer
+        # for one with the other
+        self.etag = '"' + digest + '"'
+        self.gzipped_etag = '"' + digest + '-gz"'
+
+class TokenMap(object):
+    # The string for every token of the vocabulary, built once per model,
+    # along with the encoded bodies served by /token_map
+    def __init__(self, strings: List[str]):
+        self.strings = strings
+        self.json = TokenMapBody(
+            json.dumps({token_id: string for token_id, string in enumerate(strings)}).encode('utf-8'),
+            "application/json; charset=UTF-8",
+        )
+        self.binary = TokenMapBody(encode_token_map(strings), "application/octet-stream")
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, token_id: int) -> str:
+        return self.strings[token_id]
@@ -0,0 +1,54 @@
+from typing import List
+
+import llama_cpp
+
+from .token_map import TokenMap, token_pieces, token_strings
+from .util import LRUCache
+
+class Tokenizer(object):
+    # Tokenization and the token map for a loaded model. Safe to call from
+    # any thread.
+    def __init__(self, model: llama_cpp.llama_model_p, cache_entries: int):
+        self.model = model
+        self.vocab_size = llama_cpp.llama_n_vocab(model)
+        self.cache = LRUCache(cache_entries)
+        self._token_pieces = None
+        self._token_map = None
+
+    @classmethod
+    def from_file(cls, model_filename: str, cache_entries: int) -> "Tokenizer":
+        # Loads only the vocabulary, for processes that never run the model
+        params = llama_cpp.llama_model_default_params()
+        params.vocab_only = True
+        model = llama_cpp.llama_load_model_from_file(model_filename.encode('utf-8'), params)
+        return cls(model, cache_entries)
+
+    def token_pieces(self) -> List[bytes]:
+        # The bytes of every token, built on first use and kept for the
+        # lifetime of the model
+        if self._token_pieces is None:
+            self._token_pieces = token_pieces(self.model, self.vocab_size)
+        return self._token_pieces
+
+    def token_map(self) -> TokenMap:
+        if self._token_map is None:
+            self._token_map = TokenMap(token_strings(self.token_pieces()))
+        return self._token_map
+
+    def tokenize(self, text: str) -> List[int]:
+        cached = self.cache.get(text)
+        if cached is not None:
+            return list(cached)
+        encoded = text.encode('utf-8')
+        # Room for one token per byte plus BOS, which is almost always enough;
+        # otherwise llama_tokenize returns the negated number needed
+        n_max = len(encoded) + 2
+        tokens = (llama_cpp.llama_token * n_max)()
+        n_tokens = llama_cpp.llama_tokenize(self.model, encoded, len(encoded), tokens, n_max, True, False)
+        if n_tokens < 0:
+            n_max = -n_tokens
+            tokens = (llama_cpp.llama_token * n_max)()
+            n_tokens = llama_cpp.llama_tokenize(self.model, encoded, len(encoded), tokens, n_max, True, False)
+        result = tokens[:n_tokens]
+        self.cache.put(text, tuple(result))
+        return result
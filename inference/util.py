@@ -1,6 +1,10 @@
 import ctypes
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
 
 import llama_cpp
+import numpy as np
 
 def token_to_string(model: llama_cpp.llama_model_p, token_id: llama_cpp.llama_token):
     try:
@@ -14,3 +18,51 @@ def token_to_string(model: llama_cpp.llama_model_p, token_id: llama_cpp.llama_to
         return buf.value[:size].decode('utf-8')
     except UnicodeDecodeError:
         return "?"
+
+def get_logits(ctx: llama_cpp.llama_context_p, n_rows: int, vocab_size: int) -> np.ndarray:
+    # Zero-copy view of the logits from the last llama_decode call. Only valid
+    # until the next call to llama_decode.
+    return np.ctypeslib.as_array(llama_cpp.llama_get_logits(ctx), shape=(n_rows, vocab_size))
+
+def get_logits_ith(ctx: llama_cpp.llama_context_p, i: int, vocab_size: int) -> np.ndarray:
+    return np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(ctx, i), shape=(vocab_size,))
+
+class LRUCache(object):
+    # Bounded, thread-safe mapping that drops the least recently used key
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Any:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_entries < 1:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
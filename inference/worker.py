@@ -0,0 +1,267 @@
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from .interpreter import Interpreter, Operation
+from .llama import Llama
+from .stream import TokenStream, negotiate_encoder
+
+logger = logging.getLogger(__name__)
+
+class InferenceRequest(object):
+    def __init__(
+            self,
+            interpreter: Interpreter,
+            on_done: Callable[[Optional[Exception]], None],
+            max_steps: int = 4096,
+            on_step: Optional[Callable[[], None]] = None,
+            deadline: Optional[float] = None,
+            token_budget: Optional[int] = None,
+        ):
+        self.interpreter = interpreter
+        self.on_done = on_done
+        # Called after every step, e.g. to send the tokens it reported
+        self.on_step = on_step
+        self.max_steps = max_steps
+        self.steps = 0
+        # The request is cut short at the perf_counter() time deadline, once
+        # token_budget tokens have been sampled, or when cancelled, which may
+        # happen from any thread
+        self.deadline = deadline
+        self.token_budget = token_budget
+        self.cancelled = False
+        # perf_counter() times for latency metrics, and the number of tokens
+        # sampled as of the last step
+        self.submitted_time = time.perf_counter()
+        self.first_token_time = None
+        self.last_token_time = None
+        self.generated_tokens = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_done(self) -> bool:
+        return self.interpreter.is_done() or self.steps >= self.max_steps
+
+    def stop_reason(self, now: float) -> Optional[str]:
+        if self.cancelled:
+            return "cancelled"
+        if self.deadline is not None and now >= self.deadline:
+            return "deadline"
+        if self.token_budget is not None and self.generated_tokens >= self.token_budget:
+            return "token budget"
+        return None
+
+class WorkerCall(object):
+    # A function to run on the worker thread between steps, for anything that
+    # reads state the worker mutates
+    def __init__(self, function: Callable[[], Any]):
+        self.function = function
+        self.future = concurrent.futures.Future()
+
+    def run(self):
+        try:
+            self.future.set_result(self.function())
+        except Exception as e:
+            self.future.set_exception(e)
+
+class InferenceWorker(object):
+    # Owns the Llama context on a dedicated thread. Every step merges the
+    # runnable operations of all in-flight requests into the same batch, so
+    # new requests join the running batch instead of waiting for it to drain.
+    def __init__(self, llama: Llama):
+        self.llama = llama
+        self.submitted = queue.Queue()
+        self.requests: List[InferenceRequest] = []
+        self.thread = threading.Thread(target=self._run, name="inference-worker", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.submitted.put(None)
+        self.thread.join()
+
+    def submit(self, request: InferenceRequest):
+        # May be called from any thread. Reporting callbacks and on_done are
+        # invoked on the worker thread.
+        self.submitted.put(request)
+
+    def stream(
+            self,
+            operations: List[Operation],
+            accept: str,
+            on_frame: Callable[[bytes], None],
+            on_done: Callable[[Optional[Exception]], None],
+            timeout: Optional[float] = None,
+            token_budget: Optional[int] = None,
+            priority: int = 0,
+            client: str = "",
+            session_id: Optional[str] = None,
+            new_session: bool = False,
+        ) -> InferenceRequest:
+        # Runs operations, handing on_frame the tokens of each step encoded as
+        # negotiated from the client's Accept header. Returns the handle to
+        # pass to cancel().
+        stream = TokenStream(negotiate_encoder(accept), on_frame)
+        request = InferenceRequest(
+            Interpreter(operations, stream.report, priority, client, session_id, new_session),
+            on_done,
+            on_step=stream.flush,
+            deadline=None if timeout is None else time.perf_counter() + timeout,
+            token_budget=token_budget,
+        )
+        self.submit(request)
+        return request
+
+    def cancel(self, request: InferenceRequest):
+        # Stops the request before the worker's next step, releasing its
+        # sequences. on_done is still called.
+        request.cancel()
+
+    def snapshot(self, name: str, operations: List[Operation]) -> concurrent.futures.Future:
+        # Prefills operations and saves the result as a named snapshot.
+        # Resolves to whether it was saved.
+        if any(operation.name != "feed_tokens" for operation in operations):
+            raise ValueError("Snapshots can only be taken of feed_tokens operations")
+        future = concurrent.futures.Future()
+        interpreter = Interpreter(operations, lambda record: None)
+        self.llama.request_snapshot(interpreter, name, future.set_result)
+        self.submit(InferenceRequest(interpreter, lambda error: None))
+        return future
+
+    def call(self, function: Callable[[], Any]) -> concurrent.futures.Future:
+        # Runs function on the worker thread before its next step
+        call = WorkerCall(function)
+        self.submitted.put(call)
+        return call.future
+
+    def metrics(self) -> concurrent.futures.Future:
+        return self.call(self.llama.metrics.render)
+
+    def stats(self) -> concurrent.futures.Future:
+        return self.call(self.llama.stats)
+
+    def _accept(self, block: bool) -> bool:
+        while True:
+            try:
+                request = self.submitted.get(block=block)
+            except queue.Empty:
+                return True
+            if request is None:
+                return False
+            block = False
+            if isinstance(request, WorkerCall):
+                request.run()
+                continue
+            try:
+                self.llama.check_operations(request.interpreter.operations)
+                self.llama.open_session(request.interpreter)
+            except ValueError as e:
+                self._finish(request, e)
+                continue
+            self.requests.append(request)
+            self.llama.metrics.running_requests.set(len(self.requests))
+
+    def _record_tokens(self, request: InferenceRequest, now: float):
+        # Tokens sampled during the same step are spread evenly over it for
+        # the inter-token latency
+        generated = self.llama.generated_token_count(request.interpreter)
+        new_tokens = generated - request.generated_tokens
+        if new_tokens <= 0:
+            return
+        metrics = self.llama.metrics
+        if request.first_token_time is None:
+            request.first_token_time = now
+            metrics.time_to_first_token.observe(now - request.submitted_time)
+            new_tokens -= 1
+        if new_tokens > 0:
+            gap = (now - (request.last_token_time or request.first_token_time)) / new_tokens
+            for _ in range(new_tokens):
+                metrics.inter_token_latency.observe(gap)
+        request.last_token_time = now
+        request.generated_tokens = generated
+
+    def _stop_requests(self, now: float):
+        # Requests that were cancelled or ran out of time or tokens leave the
+        # batch before the next step
+        running = []
+        for request in self.requests:
+            reason = request.stop_reason(now)
+            if reason is None:
+                running.append(request)
+                continue
+            logger.info("Stopping request after %d steps: %s", request.steps, reason)
+            self.llama.metrics.stopped_requests.inc()
+            request.interpreter.cancel()
+            self._finish(request)
+        self.requests = running
+
+    def _finish(self, request: InferenceRequest, error: Optional[Exception] = None):
+        now = time.perf_counter()
+        self._record_tokens(request, now)
+        metrics = self.llama.metrics
+        metrics.requests.inc()
+        if error is not None:
+            metrics.request_errors.inc()
+        metrics.request_seconds.observe(now - request.submitted_time)
+        if request.first_token_time is not None and now > request.first_token_time:
+            metrics.request_tokens_per_second.observe(request.generated_tokens / (now - request.first_token_time))
+
+        self.llama.release_interpreter(request.interpreter)
+        self._step_done(request)
+        try:
+            request.on_done(error)
+        except Exception:
+            logger.exception("Error in on_done callback")
+
+    def _step_done(self, request: InferenceRequest):
+        if request.on_step is None:
+            return
+        try:
+            request.on_step()
+        except Exception:
+            logger.exception("Error in on_step callback")
+
+    def _run(self):
+        while True:
+            # Sleep until there is work, otherwise just pick up new arrivals
+            if not self._accept(block=len(self.requests) == 0):
+                break
+            self._stop_requests(time.perf_counter())
+            if len(self.requests) == 0:
+                self.llama.metrics.running_requests.set(0)
+                continue
+
+            try:
+                self.llama.step([request.interpreter for request in self.requests])
+            except Exception as e:
+                logger.exception("Inference step failed")
+                for request in self.requests:
+                    self._finish(request, e)
+                self.requests = []
+                self.llama.metrics.running_requests.set(0)
+                continue
+
+            now = time.perf_counter()
+            running = []
+            for request in self.requests:
+                # Time spent queued for admission does not count
+                if not self.llama.is_queued(request.interpreter):
+                    request.steps += 1
+                self._record_tokens(request, now)
+                if request.is_done():
+                    self._finish(request)
+                    continue
+                self._step_done(request)
+                running.append(request)
+            self.requests = running
+            self._stop_requests(now)
+            self.llama.metrics.running_requests.set(len(self.requests))
+
+        for request in self.requests:
+            self._finish(request)
+        self.requests = []
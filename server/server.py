@@ -1,65 +1,330 @@
+import asyncio
+import concurrent.futures
+import functools
 import json
+import logging
+import os
 import time
 import tornado
+import tornado.ioloop
+import tornado.queues
+import tornado.util
+import tornado.web
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional, Union
 
+from inference.candidates import collect_scores
 from inference.llama import Llama
 from inference.model_config import ModelConfig
-from inference.interpreter import Interpreter, Operation
+from inference.interpreter import Operation
+from inference.process_pool import ProcessWorkerPool
+from inference.sessions import SessionBusy, SessionNotFound
+from inference.stream import NDJSON_CONTENT_TYPE, negotiate_encoder
+from inference.tokenizer import Tokenizer
+from inference.worker import InferenceWorker
+
+logger = logging.getLogger(__name__)
+
+def client_errors(post):
+    # Requests that are invalid, or name a session that is gone or busy, fail
+    # with a 4xx status rather than a 500 as if the server were at fault
+    @functools.wraps(post)
+    async def wrapper(self, *args, **kwargs):
+        try:
+            return await post(self, *args, **kwargs)
+        except ValueError as e:
+            if isinstance(e, SessionNotFound):
+                status = 404
+            elif isinstance(e, SessionBusy):
+                status = 409
+            else:
+                status = 400
+            # The reason goes in the status line, so it has to be one line
+            raise tornado.web.HTTPError(status, reason=" ".join(str(e).split())[:200]) from e
+    return wrapper
 
 class TokenizeInput(BaseModel):
     text: str
 
 class TokenizeHandler(tornado.web.RequestHandler):
-    def __init__(self, *args, llama: Llama=None, **kwargs):
+    def __init__(self, *args, tokenizer: Tokenizer=None, executor: concurrent.futures.Executor=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.llama = llama
+        self.tokenizer = tokenizer
+        self.executor = executor
 
-    def post(self):
+    @client_errors
+    async def post(self):
         input = TokenizeInput(**json.loads(self.request.body))
-        tokens = self.llama.tokenize(input.text)
+        tokens = await tornado.ioloop.IOLoop.current().run_in_executor(self.executor, self.tokenizer.tokenize, input.text)
         self.write(json.dumps(tokens))
 
+class TokenizeBatchInput(BaseModel):
+    texts: List[str]
+
+class TokenizeBatchHandler(tornado.web.RequestHandler):
+    def __init__(self, *args, tokenizer: Tokenizer=None, executor: concurrent.futures.Executor=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokenizer = tokenizer
+        self.executor = executor
+
+    @client_errors
+    async def post(self):
+        input = TokenizeBatchInput(**json.loads(self.request.body))
+        io_loop = tornado.ioloop.IOLoop.current()
+        results = await asyncio.gather(*[
+            io_loop.run_in_executor(self.executor, self.tokenizer.tokenize, text)
+            for text in input.texts
+        ])
+        self.write(json.dumps(results))
+
 
 class CompletionInput(BaseModel):
     operations: List[Operation]
+    # Seconds and sampled tokens after which the completion is cut short
+    timeout: Optional[float] = None
+    token_budget: Optional[int] = None
+    # Higher priorities are admitted first and preempted last
+    priority: int = 0
+    # Continues the conversation left by the last request with the same
+    # session_id, feeding only the new operations; new_session starts it over
+    session_id: Optional[str] = None
+    new_session: bool = False
 
 class StreamingCompletionHandler(tornado.web.RequestHandler):
-    def __init__(self, *args, llama: Llama=None, **kwargs):
+    # Streams one frame per inference step, as NDJSON or, if the client
+    # accepts it, the binary encoding in inference.stream. Frames are flushed
+    # once flush_bytes are pending or flush_interval seconds have passed.
+    # Closing the connection cancels the request. Requests are shared fairly
+    # between clients, identified by the X-Client-Id header or their address.
+    def __init__(self, *args, worker: Union[InferenceWorker, ProcessWorkerPool]=None, flush_interval: float=0.05, flush_bytes: int=65536, **kwargs):
         super().__init__(*args, **kwargs)
-        self.llama = llama
+        self.worker = worker
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.results = tornado.queues.Queue()
+        self.handle = None
+        self.closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+        if self.handle is not None:
+            self.worker.cancel(self.handle)
+        # Wake up post() so it stops writing
+        self.results.put_nowait(None)
 
+    @client_errors
     async def post(self):
         input = CompletionInput(**json.loads(self.request.body))
-        def write_callback(x):
-            self.write(x)
-            self.flush()
-        interpreter = Interpreter(input.operations, write_callback)
-        iter = 0
-        while not interpreter.is_done():
-            self.llama.run_loop(interpreter)
-            iter += 1
-            if iter > 4096:
+        accept = self.request.headers.get("Accept", "")
+        encoder = negotiate_encoder(accept)
+        self.set_header("Content-Type", encoder.content_type)
+        # Results are produced on the inference thread and handed back to the
+        # IOLoop through this queue. None marks the end of the stream.
+        io_loop = tornado.ioloop.IOLoop.current()
+        results = self.results
+        def frame_callback(frame):
+            io_loop.add_callback(results.put_nowait, frame)
+        def done_callback(error):
+            io_loop.add_callback(results.put_nowait, error)
+        if self.closed:
+            return
+        client = self.request.headers.get("X-Client-Id", self.request.remote_ip or "")
+        self.handle = self.worker.stream(
+            input.operations,
+            accept,
+            frame_callback,
+            done_callback,
+            input.timeout,
+            input.token_budget,
+            input.priority,
+            client,
+            input.session_id,
+            input.new_session,
+        )
+
+        pending = 0
+        written = False
+        last_flush = io_loop.time()
+        while True:
+            try:
+                result = await results.get(timeout=last_flush + self.flush_interval if pending > 0 else None)
+            except tornado.util.TimeoutError:
+                result = b""
+            if result is None or self.closed:
+                break
+            if isinstance(result, Exception):
+                if not written:
+                    raise result
+                # The response is already under way, so the error ends the
+                # stream instead of replacing it
+                logger.error("Completion failed mid-stream: %s", result)
+                self.write(encoder.encode_error(str(result)))
                 break
+            if len(result) > 0:
+                written = True
+            self.write(result)
+            pending += len(result)
+            if pending > 0 and (pending >= self.flush_bytes or io_loop.time() - last_flush >= self.flush_interval):
+                self.flush()
+                pending = 0
+                last_flush = io_loop.time()
+
+class ScoreInput(BaseModel):
+    operations: List[Operation]
+    timeout: Optional[float] = None
+    priority: int = 0
+
+class ScoreHandler(tornado.web.RequestHandler):
+    # Runs operations that include score operations and responds with every
+    # candidate's total and per-token logprobs at once, by operation ID
+    def __init__(self, *args, worker: Union[InferenceWorker, ProcessWorkerPool]=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker = worker
+        self.handle = None
+
+    def on_connection_close(self):
+        if self.handle is not None:
+            self.worker.cancel(self.handle)
+
+    @client_errors
+    async def post(self):
+        input = ScoreInput(**json.loads(self.request.body))
+        frames = []
+        done = concurrent.futures.Future()
+        client = self.request.headers.get("X-Client-Id", self.request.remote_ip or "")
+        self.handle = self.worker.stream(
+            input.operations,
+            NDJSON_CONTENT_TYPE,
+            frames.append,
+            done.set_result,
+            input.timeout,
+            None,
+            input.priority,
+            client,
+        )
+        error = await asyncio.wrap_future(done)
+        if error is not None:
+            raise error
+        records = [json.loads(line) for line in b"".join(frames).splitlines() if len(line) > 0]
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(collect_scores(input.operations, records)))
+
+class SnapshotInput(BaseModel):
+    name: str
+    operations: List[Operation]
+
+class SnapshotHandler(tornado.web.RequestHandler):
+    # Prefills a prompt and saves its KV cache to disk under a name, so that
+    # later requests starting with it skip the prefill, even after a restart
+    def __init__(self, *args, worker: Union[InferenceWorker, ProcessWorkerPool]=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker = worker
+
+    @client_errors
+    async def post(self):
+        input = SnapshotInput(**json.loads(self.request.body))
+        saved = await asyncio.wrap_future(self.worker.snapshot(input.name, input.operations))
+        self.write(json.dumps({"name": input.name, "saved": saved}))
+
+def accepts_encoding(accept_encoding: str, coding: str) -> bool:
+    # Whether an Accept-Encoding header allows coding, honoring q-values:
+    # "gzip;q=0" refuses gzip, and "*" stands for codings not listed
+    wildcard = None
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if name == "":
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        if name == coding:
+            return q > 0
+        if name == "*":
+            wildcard = q > 0
+    return bool(wildcard)
 
 class TokenMapHandler(tornado.web.RequestHandler):
-    def __init__(self, *args, llama: Llama=None, **kwargs):
+    # Serves one of the precomputed token map encodings. Clients revalidate
+    # with the ETag, so the body is only sent again if the model changed.
+    def __init__(self, *args, tokenizer: Tokenizer=None, binary: bool=False, **kwargs):
         super().__init__(*args, **kwargs)
-        self.llama = llama
+        self.tokenizer = tokenizer
+        self.binary = binary
+
+    def _body(self):
+        token_map = self.tokenizer.token_map()
+        return token_map.binary if self.binary else token_map.json
+
+    def _gzip(self) -> bool:
+        return accepts_encoding(self.request.headers.get("Accept-Encoding", ""), "gzip")
+
+    def compute_etag(self):
+        body = self._body()
+        return body.gzipped_etag if self._gzip() else body.etag
 
     def get(self):
-        self.write(json.dumps(self.llama.token_map()))
+        body = self._body()
+        self.set_header("Content-Type", body.content_type)
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Vary", "Accept-Encoding")
+        if self._gzip():
+            self.set_header("Content-Encoding", "gzip")
+            self.write(body.gzipped)
+        else:
+            self.write(body.data)
+
+class StatsHandler(tornado.web.RequestHandler):
+    def __init__(self, *args, worker: Union[InferenceWorker, ProcessWorkerPool]=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker = worker
+
+    async def get(self):
+        self.write(json.dumps(await asyncio.wrap_future(self.worker.stats())))
+
+class MetricsHandler(tornado.web.RequestHandler):
+    # Prometheus text exposition format
+    def __init__(self, *args, worker: Union[InferenceWorker, ProcessWorkerPool]=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker = worker
+
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(await asyncio.wrap_future(self.worker.metrics()))
 
-def make_app(llama: Llama):
+def make_app(
+        tokenizer: Tokenizer,
+        worker: Union[InferenceWorker, ProcessWorkerPool],
+        flush_interval: float = 0.05,
+        flush_bytes: int = 65536,
+    ):
+    # Tokenization runs off the IOLoop
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="tokenize")
     return tornado.web.Application([
-        (r"/tokenize", TokenizeHandler, {"llama": llama}),
-        (r"/streaming_completion", StreamingCompletionHandler, {"llama": llama}),
-        (r"/token_map", TokenMapHandler, {"llama": llama}),
+        (r"/tokenize", TokenizeHandler, {"tokenizer": tokenizer, "executor": executor}),
+        (r"/tokenize_batch", TokenizeBatchHandler, {"tokenizer": tokenizer, "executor": executor}),
+        (r"/streaming_completion", StreamingCompletionHandler, {"worker": worker, "flush_interval": flush_interval, "flush_bytes": flush_bytes}),
+        (r"/token_map", TokenMapHandler, {"tokenizer": tokenizer}),
+        (r"/token_map.bin", TokenMapHandler, {"tokenizer": tokenizer, "binary": True}),
+        (r"/score", ScoreHandler, {"worker": worker}),
+        (r"/snapshots", SnapshotHandler, {"worker": worker}),
+        (r"/stats", StatsHandler, {"worker": worker}),
+        (r"/metrics", MetricsHandler, {"worker": worker}),
         (r"/(.*)", tornado.web.StaticFileHandler, {"path": "client", "default_filename": "index.html"}),
     ])
 
 def server_main():
+    # LOG_LEVEL=DEBUG logs every scheduling decision
+    log_level = os.environ.get("LOG_LEVEL", "INFO")
+    logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # INFERENCE_PROCESSES=N runs the model in N worker processes, splitting
+    # the CPU threads between them
+    processes = int(os.environ.get("INFERENCE_PROCESSES", "0"))
     config = ModelConfig(
         name="Phi3-mini-1.0",
         model_filename="./models/Phi-3-mini-4k-instruct-q4.gguf",
@@ -68,7 +333,16 @@ def server_main():
         batch_size=512,
         batch_max_tokens=2048,
     )
-    llama = Llama(config)
-    app = make_app(llama)
+    if processes > 0:
+        config.n_threads = max(1, (os.cpu_count() or processes) // processes)
+        tokenizer = Tokenizer.from_file(config.model_filename, config.tokenize_cache_entries)
+        worker = ProcessWorkerPool(config, processes, log_level)
+    else:
+        llama = Llama(config)
+        tokenizer = llama.tokenizer
+        worker = InferenceWorker(llama)
+    tokenizer.token_map()
+    worker.start()
+    app = make_app(tokenizer, worker)
     app.listen(port=8888, address="0.0.0.0")
     tornado.ioloop.IOLoop.current().start()
\ No newline at end of file